@@ -1,9 +1,42 @@
 import re
 import socket
+import time
+from collections import deque
 from typing import Any
 
 from algo import create_algorithm_instance
+from arrays import uses_arrays
+from checkpoint import (
+    create_checkpointer,
+    restore_checkpoint,
+    save_checkpoint,
+    supports_checkpoint,
+)
+from compress import create_compressor, decompress_values
+from config import AgentConfig
+from custom import from_algorithm, to_algorithm
+from deadline import (
+    LastValues,
+    check_policy,
+    cycle_deadline,
+    late_reason,
+    remaining,
+)
+from delta import DeltaPush, InputCache
+from metrics import create_agent_metrics
+from plan import (
+    CyclePlan,
+    group_pull_connections,
+    group_push_connections,
+    match_pull_reply,
+)
+from pool import ConnectionPool
 from protocol import *
+from responder import DataResponder
+from shm import create_shm_transport, read_variables, segment_reader
+from tracer import create_tracer
+from uds import close_unix_listener, connect_unix, create_unix_listener
+from worker import create_runner
 
 
 def create_data_responder_socket():
@@ -18,7 +51,7 @@ def create_data_responder_socket():
         print(f"Error creating or binding socket: {e}")
 
 
-def connect_to_core(algoName, className, url, data_port):
+def parse_core_url(url):
     # "." Matches any character except a newline
     # "+" Matches 1 or more (greedy) repetitions of the preceding RE
     #  \d Matches any decimal digit; equivalent to the set [0-9] in
@@ -29,12 +62,22 @@ def connect_to_core(algoName, className, url, data_port):
     if not match:
         raise ValueError("Incorrect url format url" + url)
     host, port = match.groups()
-    port = int(port)
+    return host, int(port)
+
+
+def set_nodelay(sock):
+    # Cycles are lock-step request/reply exchanges of small frames: disable
+    # Nagle so none of them waits for the previous one to be acknowledged
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def connect_to_core(algoName, className, url, data_port):
+    host, port = parse_core_url(url)
 
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     try:
+        set_nodelay(sock)
         sock.connect((host, port))
-        print("sending reg pdu")
         sendRegPDU(sock, algoName, className, data_port)
         return sock
 
@@ -43,15 +86,50 @@ def connect_to_core(algoName, className, url, data_port):
         raise
 
 
-def connect_to_peer(addr, data_port):
+def connect_to_peer(addr, data_port, timeout=None):
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     try:
+        set_nodelay(sock)
+        sock.settimeout(timeout)
         sock.connect((addr, data_port))
+        sock.settimeout(None)
         return sock
     except OSError as e:
         print(f"Error while connecting: {e}")
 
 
+def peer_connector(codecs, unix_dir="", features=()):
+    """
+    Returns the connect function of the ConnectionPool: connect_to_peer,
+    preceded by an attempt at the Unix socket of peers on this host when
+    `unix_dir` is set, and followed by the negotiation of a wire codec when
+    `codecs` asks for more than DER or there are `features` to ask for.
+    """
+    negotiate = codecs != ["der"] or bool(features)
+    if not negotiate and not unix_dir:
+        return connect_to_peer
+
+    def connect(addr, data_port, timeout=None):
+        sock = None
+        if unix_dir:
+            sock = connect_unix(unix_dir, addr, data_port, timeout)
+        if sock is None:
+            sock = connect_to_peer(addr, data_port, timeout)
+        if sock is None or not negotiate:
+            return sock
+        try:
+            sock.settimeout(timeout)
+            negotiateCodec(sock, codecs, features)
+            sock.settimeout(None)
+        except (OSError, RuntimeError, ValueError) as e:
+            print(f"Error while negotiating a codec with {addr}:{data_port}: {e}")
+            sock.close()
+            return None
+        return sock
+
+    return connect
+
+
 # conn_pdu = {"push" : [{"localParamName": , "remoteAlgoName": ,
 # "remoteParamName": , "address": , "port" : }, {}, ..],
 # "pull" : [{}, {}, ..]}
@@ -73,24 +151,312 @@ def print_conn_pdu(algoName, conn_pdu):
             )
 
 
+def pull_values(peers, plan, metrics=None, deadline=None, late=None):
+    """
+    Send the batched pullValuesReq of the CyclePlan to every peer first,
+    then collect the replies, so the phase costs about one RTT instead of
+    one per connection. Returned variables are matched back to local names
+    by remoteParamName.
+    With a `deadline`, peers that are not connected, fail or do not answer
+    in time are appended to `late` instead of failing the phase, and their
+    connection is dropped at once: a reply arriving after the timeout would
+    otherwise be read as the one of the next peer sharing the socket.
+    """
+    started = time.perf_counter()
+    asked = []
+    for remote_algo, (names, frame) in plan.pull_requests.items():
+        try:
+            if deadline is None:
+                sock = peers[remote_algo]
+            else:
+                # Under a deadline, a dropped peer waits for the next cycle
+                sock = peers.get(remote_algo)
+                if sock is None:
+                    raise RuntimeError(f"{remote_algo} is not connected")
+                sock.settimeout(remaining(deadline))
+            codec = codecOf(sock)
+            if codec != "der":
+                frame = plan.pull_frame(remote_algo, codec)
+            sendEncodedPDU(sock, "pullValuesReq", frame)
+        except (OSError, RuntimeError):
+            if deadline is None:
+                raise
+            late.append(remote_algo)
+            drop_peers(peers, [remote_algo])
+            continue
+        asked.append((remote_algo, names))
+
+    values = {}
+    for remote_algo, names in asked:
+        try:
+            if deadline is None:
+                sock = peers[remote_algo]
+            else:
+                sock = peers.get(remote_algo)
+                if sock is None:
+                    raise RuntimeError(f"{remote_algo} was dropped")
+                sock.settimeout(remaining(deadline))
+            rep_pdu = recvPDU(sock)
+        except (OSError, RuntimeError, ValueError):
+            if deadline is None:
+                raise
+            late.append(remote_algo)
+            drop_peers(peers, [remote_algo])
+            continue
+        if metrics is not None:
+            metrics.peer_phase("pull", remote_algo, time.perf_counter() - started)
+        if rep_pdu[0] == "pullValuesRepLinuxSHM":
+            rep_pdu = ("pullValuesRep", read_variables(rep_pdu[1]))
+        if rep_pdu[0] != "pullValuesRep":
+            raise ValueError(
+                f"got {rep_pdu[0]} instead of pullValuesRep from {remote_algo}"
+            )
+        values.update(match_pull_reply(names, rep_pdu[1]))
+    return decompress_values(values)
+
+
+def push_values(
+    peers,
+    plan,
+    output_params,
+    window,
+    shm=None,
+    metrics=None,
+    delta=None,
+    compressor=None,
+    deadline=None,
+    late=None,
+):
+    """
+    Write one pushValues PDU per peer of the CyclePlan and collect the ack/nack statuses
+    afterwards, keeping at most `window` peers unanswered at a time.
+    Large values for co-located peers go through `shm` when given, large
+    values for other hosts are compressed by `compressor`, and with a
+    DeltaPush, whose cycle the caller starts, only the values that changed
+    are sent.
+    Returns a (remoteAlgoName, remoteParamName, reason) entry for every
+    variable a peer rejected. With a `deadline`, peers that are not
+    connected, fail or do not answer in time are also appended to `late`,
+    and their connection is dropped for the rest of the phase as in
+    pull_values.
+    """
+    pending: deque[tuple[str, list[dict], float]] = deque()
+    nacks = []
+
+    def give_up(remote_algo, variables, reason):
+        late.append(remote_algo)
+        drop_peers(peers, [remote_algo])
+        nacks.extend((remote_algo, var["name"], reason) for var in variables)
+        if delta is not None:
+            delta.forget(remote_algo)
+        if shm is not None:
+            # The peer may still read the segment: later pushes get a new one
+            shm.release(remote_algo)
+
+    def collect():
+        remote_algo, variables, sent_at = pending.popleft()
+        try:
+            if deadline is None:
+                sock = peers[remote_algo]
+            else:
+                sock = peers.get(remote_algo)
+                if sock is None:
+                    raise RuntimeError(f"{remote_algo} was dropped")
+                sock.settimeout(remaining(deadline))
+            ok, reason = recvStatusPDU(sock)
+        except (OSError, RuntimeError, ValueError) as e:
+            if deadline is None:
+                raise
+            give_up(remote_algo, variables, f"no status in time: {e}")
+            return
+        if metrics is not None:
+            metrics.peer_phase("push", remote_algo, time.perf_counter() - sent_at)
+        if not ok:
+            nacks.extend((remote_algo, var["name"], reason) for var in variables)
+            if delta is not None:
+                delta.forget(remote_algo)
+        elif delta is not None:
+            delta.ack(remote_algo, variables)
+
+    for remote_algo, variables in plan.push_variables(output_params):
+        if delta is not None:
+            variables = delta.changed(remote_algo, variables)
+        if not variables:
+            continue
+        if len(pending) >= max(window, 1):
+            collect()
+        sent_at = time.perf_counter()
+        try:
+            if deadline is None:
+                sock = peers[remote_algo]
+            else:
+                sock = peers.get(remote_algo)
+                if sock is None:
+                    raise RuntimeError("not connected")
+                sock.settimeout(remaining(deadline))
+            # Only peers that agreed to it get compressed values
+            if shm is not None and shm.wants(remote_algo, variables):
+                pdu = ("pushValuesLinuxSHM", shm.write(remote_algo, variables))
+            elif compressor is not None and COMPRESSION_FEATURE in featuresOf(sock):
+                pdu = ("pushValues", compressor.pack(remote_algo, variables))
+            else:
+                pdu = ("pushValues", variables)
+            sendPDU(sock, pdu)
+        except (OSError, RuntimeError) as e:
+            if deadline is None:
+                raise
+            give_up(remote_algo, variables, str(e))
+            continue
+        pending.append((remote_algo, variables, sent_at))
+
+    while pending:
+        collect()
+    return nacks
+
+
+def with_reconnect(peers, phase, *args, delta=None):
+    """
+    Runs a pull or push phase on `peers`, a ConnectionPool, and once more
+    on fresh connections when it failed: requests can safely be sent twice
+    and replies still in flight on the old connections are dropped with
+    them. What the old connections acknowledged to the DeltaPush `delta` is
+    dropped as well, since the peers behind them may have restarted.
+    """
+    try:
+        return phase(peers, *args)
+    except (OSError, RuntimeError, ValueError, struct.error):
+        peers.reset()
+        if delta is not None:
+            delta.forget_all()
+        return phase(peers, *args)
+
+
+def drop_peers(peers, late):
+    for remote_algo in set(late):
+        sock = peers.pop(remote_algo, None)
+        if sock is not None:
+            sock.close()
+
+
+def replay_cycle(control_socket):
+    """
+    Acknowledges a cycle already reflected in a restored checkpoint, and its
+    shiftValues, without running it. Returns False when the core went away.
+    """
+    try:
+        sendAckPDU(control_socket)
+        pdu = recvPDU(control_socket)
+        if pdu[0] != "shiftValues":
+            return False
+        sendAckPDU(control_socket)
+    except (ValueError, RuntimeError):
+        return False
+    return True
+
+
 # pullValuesReq = ["", "", ..]
 # SMM3NG-Variable = {"name": "<..>", "value": ("<..>", <..>)}
 # PullValuesRepPDU = [SMM3NG-Variable, SMM3NG-Variable, ..]
 output_params: dict[str, tuple[Any, Any]] = {}
-input_params = {}  # Stores received values
+input_params: dict[str, tuple[Any, Any]] = {}  # Stores received values
 
 
-def start_agent(algoName, className, url):
+def start_agent(algoName, className, url, config=None):
+    if config is None:
+        config = AgentConfig()
+    check_policy(config.stale_policy)
+    parseCodecs(config.wire_codec)
+    setMaxFrameSize(config.max_frame_size)
+    # Workers are forked before the agent starts any thread
+    runner = create_runner(className, config)
     # Create a socket for receiving data from other agents
     data_responder_socket = create_data_responder_socket()
     # Get the assigned port
     port = data_responder_socket.getsockname()[1]
-
+    unix_socket = None
+    if config.unix_socket_dir:
+        unix_socket = create_unix_listener(config.unix_socket_dir, port)
+
+    # Serve peers' pull/push requests from the start so that nobody who
+    # connects while we register with the core is left waiting
+    responder = DataResponder(
+        data_responder_socket,
+        create_shm_transport(config.shm_threshold),
+        create_compressor(config),
+        unix_socket,
+    )
+    responder.start()
+    shm = create_shm_transport(config.shm_threshold)
+    metrics, exporter = create_agent_metrics(algoName, config)
+    if metrics is not None:
+        metrics.install()
+        exporter.start()
+    tracer = create_tracer(algoName, config)
+    checkpointer = create_checkpointer(algoName, config)
+    # Peer connections, closed here however run_agent returns
+    peers = ConnectionPool(
+        peer_connector(
+            parseCodecs(config.wire_codec),
+            config.unix_socket_dir,
+            PEER_FEATURES if config.compression else (),
+        ),
+        config.connect_retries,
+        config.connect_backoff,
+    )
+    try:
+        run_agent(
+            algoName,
+            className,
+            url,
+            config,
+            port,
+            responder,
+            shm,
+            peers,
+            metrics,
+            tracer,
+            runner,
+            checkpointer,
+        )
+    finally:
+        peers.close()
+        if checkpointer is not None:
+            checkpointer.close()
+        if runner is not None:
+            runner.close()
+        if tracer is not None:
+            tracer.close()
+        if metrics is not None:
+            metrics.uninstall()
+            exporter.stop()
+        responder.stop()
+        data_responder_socket.close()
+        if unix_socket is not None:
+            close_unix_listener(unix_socket)
+        if shm is not None:
+            shm.close()
+        segment_reader.close()
+
+
+def run_agent(
+    algoName,
+    className,
+    url,
+    config,
+    port,
+    responder,
+    shm,
+    peers,
+    metrics=None,
+    tracer=None,
+    runner=None,
+    checkpointer=None,
+):
     try:
         control_socket = connect_to_core(algoName, className, url, port)
     except Exception as e:
         print(f"Error occured: {e}")
-        return control_socket
+        return
 
     # Receive connection info from the core
     try:
@@ -103,16 +469,62 @@ def start_agent(algoName, className, url):
         control_socket.close()
         return
     print_conn_pdu(algoName, conn_pdu[1])
-    peers = {}
+    for conn in conn_pdu[1]["push"] + conn_pdu[1]["pull"]:
+        peers.add(conn["remoteAlgoName"], conn["address"], conn["port"])
+
+    # Fail the setup now rather than in the first cycle using the peer
+    unreachable = peers.connect()
+    if unreachable:
+        reason = "cannot connect to " + ", ".join(
+            f"{address}:{port}" for address, port in unreachable
+        )
+        print(f"agent {algoName}: {reason}")
+        try:
+            sendNackPDU(control_socket, reason)
+        except RuntimeError:
+            pass
+        control_socket.close()
+        return
 
-    for conn in conn_pdu[1]["push"]:
-        remote_algo = conn["remoteAlgoName"]
-        if remote_algo not in peers:
-            peers[remote_algo] = connect_to_peer(conn["address"], conn["port"])
-    for conn in conn_pdu[1]["pull"]:
-        remote_algo = conn["remoteAlgoName"]
-        if remote_algo not in peers:
-            peers[remote_algo] = connect_to_peer(conn["address"], conn["port"])
+    if shm is not None:
+        for conn in conn_pdu[1]["push"]:
+            shm.add_peer(conn["remoteAlgoName"], conn["address"])
+    compressor = create_compressor(config)
+    if compressor is not None:
+        for conn in conn_pdu[1]["push"]:
+            compressor.add_peer(conn["remoteAlgoName"], conn["address"])
+
+    plan = CyclePlan(conn_pdu[1])
+
+    # In process mode the algorithm only exists in the runner's workers
+    algo = create_algorithm_instance(className) if runner is None else None
+    arrays_api = algo is not None and uses_arrays(algo)
+    source = algo if runner is None else runner
+    if checkpointer is not None and not supports_checkpoint(source):
+        print(f"agent {algoName}: {className} has no export_state/import_state")
+        checkpointer = None
+    # Cycles up to this nextCycle timestamp are in the restored state
+    resume_at = None
+    cycles = 0
+    if checkpointer is not None:
+        try:
+            snapshot = restore_checkpoint(checkpointer, source)
+        except RuntimeError as e:
+            print(f"agent {algoName}: {e}")
+            try:
+                sendNackPDU(control_socket, str(e))
+            except RuntimeError:
+                pass
+            control_socket.close()
+            return
+        if snapshot is not None:
+            print(
+                f"agent {algoName}: restored cycle {snapshot.cycle} "
+                f"(timestamp {snapshot.timestamp})"
+            )
+            responder.publish(snapshot.outputs)
+            resume_at = snapshot.timestamp
+            cycles = snapshot.cycle
 
     try:
         sendAckPDU(control_socket)
@@ -120,9 +532,20 @@ def start_agent(algoName, className, url):
         print(f"Error occured: {e}")
         return
 
-    algo = create_algorithm_instance()
+    for observer in (metrics, tracer):
+        if observer is not None:
+            observer.label_socket(control_socket, "core")
+            peers.add_observer(observer)
+
+    delta = DeltaPush(config.delta_refresh) if config.delta_push else None
+    input_cache = InputCache() if config.delta_push else None
+    deadlines = config.cycle_deadline > 0
+    fail_late = config.stale_policy == "fail"
+    last_values = LastValues() if deadlines and not fail_late else None
+    clock = time.perf_counter
 
     while True:
+        phase_start = clock()
         try:
             pdu = recvPDU(control_socket)
             if pdu[0] == "done":
@@ -138,41 +561,81 @@ def start_agent(algoName, className, url):
             control_socket.close()
             return
 
-        # Collect data from other agents (pull)
-
-        for conn in conn_pdu[1]["pull"]:
-            peer_sock = peers[conn["remoteAlgoName"]]
-            req_pdu = [conn["remoteParamName"]]
-            try:
-                sendPDU(peer_sock, ("pullValuesReq", req_pdu))
-            except (RuntimeError, socket.error, struct.error) as e:
-                print(f"agent {algoName}: cannot send values req")
-                control_socket.close()
-                return
-            try:
-                rep_pdu = recvPDU(peer_sock)
-                if rep_pdu[0] != "pullValuesRep":
-                    print(f"agent {algoName} got {rep_pdu[0]} instead of pullValuesRep")
+        if checkpointer is not None:
+            timestamp = pdu[1]["timestamp"]
+            if resume_at is not None and timestamp <= resume_at:
+                if not replay_cycle(control_socket):
+                    print(f"agent {algoName}: cannot replay cycle {timestamp}")
                     control_socket.close()
                     return
-                if len(rep_pdu[1]) == 0:
-                    continue
-                var = rep_pdu[1][0]
-                input_params[conn["localParamName"]] = var["value"]
-            except (ValueError, RuntimeError) as e:
-                print(f"agent {algoName}: cannot recv values reply")
-                control_socket.close()
-                return
-
-        output_params = algo.run(input_params.copy())
+                continue
+            resume_at = None
+
+        if metrics is not None:
+            metrics.phase("wait_next_cycle", clock() - phase_start)
+        phase_start = clock()
+
+        # Collect data from other agents (pull): one request per peer, all
+        # of them in flight before the first reply is read
+        if deadlines:
+            # Peers dropped for missing a deadline are connected again in
+            # the background, and late until then: waiting for them here
+            # would eat into the deadline of the peers that are up
+            peers.connect_in_background(config.cycle_deadline)
+        deadline = cycle_deadline(config.cycle_deadline)
+        late: list[str] = []
+        try:
+            pulled = with_reconnect(peers, pull_values, plan, metrics, deadline, late)
+        except (RuntimeError, ValueError, socket.error, struct.error) as e:
+            print(f"agent {algoName}: pull phase failed: {e}")
+            control_socket.close()
+            return
+        if late:
+            # A late reply would otherwise be read as the next cycle's one
+            drop_peers(peers, late)
+        if last_values is not None:
+            last_values.update(pulled)
+            pulled.update(last_values.stale_inputs(plan.pull_groups, late))
+        pushed = responder.take_inputs()
+        if input_cache is not None:
+            pushed = input_cache.merge(pushed)
+        input_params.update(pushed)
+        input_params.update(pulled)
+        if metrics is not None:
+            metrics.phase("pull", clock() - phase_start)
+        phase_start = clock()
+
+        # A cycle fails, and is nacked, when a late peer leaves it without
+        # inputs under the "fail" policy or when a worker's step failed
+        reason = None
+        output_params = {}
+        if late and fail_late:
+            reason = late_reason(late, config.cycle_deadline)
+        elif runner is not None:
+            try:
+                output_params = runner.run(input_params)
+            except RuntimeError as e:
+                reason = f"run failed: {e}"
+        else:
+            output_params = from_algorithm(
+                algo.run(to_algorithm(input_params, arrays_api)), arrays_api
+            )
+        failed_cycle = reason is not None
         input_params.clear()
+        if metrics is not None:
+            metrics.phase("run", clock() - phase_start)
 
         try:
-            sendAckPDU(control_socket)
+            if failed_cycle:
+                print(f"agent {algoName}: {reason}")
+                sendNackPDU(control_socket, reason)
+            else:
+                sendAckPDU(control_socket)
         except Exception as e:
             print(f"Error occured: {e}")
             return
 
+        phase_start = clock()
         try:
             pdu = recvPDU(control_socket)
             if pdu[0] != "shiftValues":
@@ -184,35 +647,56 @@ def start_agent(algoName, className, url):
             control_socket.close()
             return
 
-        # Propagate results to other agents (push)
-
-        for i in range(0, len(conn_pdu[1]["push"])):
-            conn = conn_pdu[1]["push"][i]
-            peer_sock = peers[conn["remoteAlgoName"]]
-            req_pdu = []
-
-            var = {
-                "name": conn["remoteParamName"],
-                "value": output_params[pdu[1][i]["value"]],
-            }
-
-            req_pdu.append(var)
+        if metrics is not None:
+            metrics.phase("wait_shift_values", clock() - phase_start)
+        phase_start = clock()
+
+        # A failed cycle has nothing new to publish or push: peers keep
+        # seeing the outputs of the last cycle that ran
+        late = []
+        if not failed_cycle:
+            # Peers pulling from us see the values of the cycle just shifted
+            responder.publish(output_params)
+
+            # Propagate results to other agents (push): one PDU per peer, all
+            # peers written before their statuses are collected
+            if delta is not None:
+                delta.start_cycle()
             try:
-                sendPDU(peer_sock, ("pushValues", req_pdu))
-            except (RuntimeError, socket.error, struct.error) as e:
-                print(f"agent {algoName}: cannot send values req")
+                nacks = with_reconnect(
+                    peers,
+                    push_values,
+                    plan,
+                    output_params,
+                    config.push_window,
+                    shm,
+                    metrics,
+                    delta,
+                    compressor,
+                    cycle_deadline(config.cycle_deadline),
+                    late,
+                    delta=delta,
+                )
+            except (RuntimeError, ValueError, socket.error, struct.error) as e:
+                print(f"agent {algoName}: push phase failed: {e}")
                 control_socket.close()
                 return
-            req_pdu.clear()
-            while True:
-                try:
-                    recvStatusPDU(peer_sock)
-                except (ValueError, RuntimeError) as e:
-                    print(f"Error occured: {e}")
-                break
+            for remote_algo, name, reason in nacks:
+                print(f"agent {algoName}: {remote_algo} rejected {name}: {reason}")
+            if late:
+                drop_peers(peers, late)
+            cycles += 1
+            if checkpointer is not None and checkpointer.due(cycles):
+                save_checkpoint(checkpointer, source, cycles, timestamp, output_params)
+        if metrics is not None:
+            metrics.phase("push", clock() - phase_start)
+            metrics.cycles.inc()
 
         try:
-            sendAckPDU(control_socket)
+            if late and fail_late:
+                sendNackPDU(control_socket, late_reason(late, config.cycle_deadline))
+            else:
+                sendAckPDU(control_socket)
         except Exception as e:
             print(f"Error occured: {e}")
             return
@@ -1,3 +1,11 @@
+# An algorithm is any class with a run(params) -> dict method. Agents started
+# with start-async also accept `async def run(params)`, which lets the step
+# await its own I/O while the agent keeps talking to the core and peers.
+# Classes setting `uses_arrays = True` exchange numpy arrays instead of
+# (type_name, value) tuples for numeric values, see arrays.py. Custom values
+# of OIDs with a registered codec are decoded for every class, see custom.py.
+
+
 class ConsumerAlgorithm:
 
     # to explicitly show possibilities for more complex algorithms
@@ -18,5 +26,14 @@ class ConsumerAlgorithm:
         return {}
 
 
-def create_algorithm_instance():
-    return ConsumerAlgorithm()
+# className -> zero-argument factory. Class names the agent does not know
+# keep getting the ConsumerAlgorithm, as before the registry existed.
+ALGORITHMS = {"ConsumerAlgorithm": ConsumerAlgorithm}
+
+
+def register_algorithm(className, factory):
+    ALGORITHMS[className] = factory
+
+
+def create_algorithm_instance(className=None):
+    return ALGORITHMS.get(className, ConsumerAlgorithm)()
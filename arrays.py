@@ -0,0 +1,132 @@
+import struct
+from typing import Any
+
+from deadline import stale_like
+
+# numpy is only imported, by require_numpy(), once an agent actually
+# exchanges arrays: importing it costs more than the rest of the agent
+np: Any = None
+
+# Typed numeric arrays travel as "custom" values (CustomType) whose type is
+# ARRAY_OID and whose data is
+#
+#     u8 dtype length | dtype string (numpy dtype.str, e.g. "<f8")
+#     u8 number of dimensions | u64 little-endian size of every dimension
+#     zero padding up to a multiple of ARRAY_ALIGNMENT | raw C-order elements
+#
+# The padding keeps the elements aligned, so they are decoded as a read-only
+# numpy.frombuffer view without copying or touching single elements.
+
+# Private arc of the SMM-3NG project for its CustomType OIDs
+SMM3NG_OID = "1.3.6.1.4.1.54321"
+ARRAY_OID = SMM3NG_OID + ".1.1"
+
+ARRAY_ALIGNMENT = 16
+# bool, signed / unsigned integers, floats and complex numbers
+ARRAY_KINDS = "biufc"
+DIMENSION = struct.Struct("<Q")
+
+
+def require_numpy():
+    global np
+    if np is None:
+        try:
+            import numpy
+        except ImportError:
+            raise RuntimeError("numpy is required for array values")
+        np = numpy
+    return np
+
+
+def is_array_value(value):
+    return value[0] == "custom" and value[1]["type"] == ARRAY_OID
+
+
+def encode_array(array):
+    """
+    Returns the ("custom", ...) SMM3NG-Type value of a numpy array.
+    """
+    require_numpy()
+    array = np.asarray(array)
+    if not array.flags.c_contiguous:
+        array = array.copy(order="C")
+    if array.dtype.kind not in ARRAY_KINDS:
+        raise ValueError(f"unsupported array dtype {array.dtype}")
+    dtype = array.dtype.str.encode("ascii")
+    header = bytearray((len(dtype),)) + dtype + bytes((array.ndim,))
+    for size in array.shape:
+        header += DIMENSION.pack(size)
+    header += bytes(-len(header) % ARRAY_ALIGNMENT)
+    data = b"".join((header, memoryview(array.reshape(-1)).cast("B")))
+    return ("custom", {"type": ARRAY_OID, "data": data})
+
+
+def decode_array(data):
+    """
+    Returns a read-only numpy array viewing the elements in `data`.
+    """
+    require_numpy()
+    try:
+        offset = 1 + data[0]
+        dtype = np.dtype(bytes(data[1:offset]).decode("ascii"))
+        ndim = data[offset]
+        offset += 1
+        shape = tuple(
+            DIMENSION.unpack_from(data, offset + i * DIMENSION.size)[0]
+            for i in range(ndim)
+        )
+    except (IndexError, struct.error, TypeError, UnicodeDecodeError) as e:
+        raise ValueError(f"malformed array header: {e}")
+    if dtype.kind not in ARRAY_KINDS:
+        raise ValueError(f"unsupported array dtype {dtype}")
+    offset += ndim * DIMENSION.size
+    offset += -offset % ARRAY_ALIGNMENT
+    count = 1
+    for size in shape:
+        count *= size
+    if len(data) - offset != count * dtype.itemsize:
+        raise ValueError(
+            f"array of shape {shape} and dtype {dtype} does not match "
+            f"{len(data) - offset} bytes of data"
+        )
+    return np.frombuffer(data, dtype, count, offset).reshape(shape)
+
+
+# Array API: algorithms with `uses_arrays = True` get every array, integer,
+# real and boolean input as a numpy array (0-d for scalars) and may return
+# numpy arrays, which are sent as array values. Other values keep the
+# (type_name, value) form.
+
+SCALAR_TYPES = ("integer", "real", "boolean")
+
+
+def uses_arrays(algo):
+    if getattr(algo, "uses_arrays", False) is not True:
+        return False
+    require_numpy()
+    return True
+
+
+def to_arrays(params):
+    require_numpy()
+    arrays = {}
+    for name, value in params.items():
+        if value[0] in SCALAR_TYPES:
+            arrays[name] = stale_like(value, np.asarray(value[1]))
+        elif is_array_value(value):
+            arrays[name] = stale_like(value, decode_array(value[1]["data"]))
+        else:
+            arrays[name] = value
+    return arrays
+
+
+def from_arrays(outputs):
+    require_numpy()
+    return {
+        name: (
+            encode_array(value)
+            if isinstance(value, (np.ndarray, np.generic))
+            else value
+        )
+        for name, value in outputs.items()
+    }
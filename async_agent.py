@@ -0,0 +1,621 @@
+import asyncio
+import inspect
+
+from agent import parse_core_url, print_conn_pdu
+from algo import create_algorithm_instance
+from arrays import uses_arrays
+from checkpoint import (
+    create_checkpointer,
+    restore_checkpoint,
+    save_checkpoint,
+    supports_checkpoint,
+)
+from compress import create_compressor, decompress_values
+from config import AgentConfig
+from custom import from_algorithm, to_algorithm
+from deadline import (
+    LastValues,
+    check_policy,
+    cycle_deadline,
+    late_reason,
+    remaining,
+)
+from delta import DeltaPush, InputCache
+from plan import CyclePlan, match_pull_reply
+from protocol import (
+    COMPRESSION_FEATURE,
+    PEER_FEATURES,
+    answerCodecRequest,
+    codecOf,
+    featuresOf,
+    negotiateCodecAsync,
+    parseCodecs,
+    recvPDUAsync,
+    sendEncodedPDUAsync,
+    sendPDUAsync,
+    setCodec,
+    setFeatures,
+    setMaxFrameSize,
+)
+from responder import answer_pdu
+from shm import is_local_address, read_variables
+from tracer import create_tracer
+from uds import (
+    create_unix_listener,
+    is_private_directory,
+    remove_unix_socket,
+    unix_socket_path,
+)
+from worker import create_runner
+
+
+async def run_algorithm(algo, params):
+    """
+    Run one step of the algorithm. `async def run(params)` is awaited on the
+    event loop, a plain `run(params)` is moved to the default executor so
+    the loop keeps serving the core and peers meanwhile.
+    """
+    arrays_api = uses_arrays(algo)
+    params = to_algorithm(params, arrays_api)
+    if inspect.iscoroutinefunction(algo.run):
+        outputs = await algo.run(params)
+    else:
+        loop = asyncio.get_running_loop()
+        outputs = await loop.run_in_executor(None, algo.run, params)
+    return from_algorithm(outputs, arrays_api)
+
+
+class AsyncAgent:
+    """
+    asyncio alternative to the blocking start_agent: the control socket,
+    peer connections and the data responder share one event loop, so pulls,
+    pushes and algorithm I/O of a cycle overlap instead of running in turn.
+    """
+
+    def __init__(self, algoName, className, url, config=None, host=None):
+        self.algoName = algoName
+        self.className = className
+        self.url = url
+        self.config = config if config is not None else AgentConfig()
+        # AgentHost this instance shares its process with, if any
+        self.host = host
+        self.outputs: dict = {}
+        self.inputs: dict = {}
+        self.peers: dict = {}
+        # remoteAlgoName -> co-hosted AsyncAgent, served in memory
+        self.local_peers: dict = {}
+        self.server = None
+        # Server of the Unix socket co-located peers connect to, see uds.py
+        self.unix_server = None
+        self.unix_path = None
+        self.delta = None
+        self.input_cache = None
+        if self.config.delta_push:
+            self.delta = DeltaPush(self.config.delta_refresh)
+            self.input_cache = InputCache()
+        self.compressor = create_compressor(self.config)
+        # WorkerPool running the algorithm in process mode
+        self.runner = None
+        self.checkpointer = None
+        # remoteAlgoName -> (address, port), to reconnect dropped peers
+        self.endpoints: dict = {}
+        # remoteAlgoName -> Task connecting a dropped peer again
+        self.reconnecting: dict = {}
+        # Wire codecs asked of peers, preferred first
+        self.codecs = parseCodecs(self.config.wire_codec)
+        # Features asked of peers: compressed values when compressing
+        self.features = PEER_FEATURES if self.compressor is not None else ()
+        self.last_values = None
+        if self.config.cycle_deadline > 0 and self.config.stale_policy == "stale":
+            self.last_values = LastValues()
+
+    async def serve_peer(self, reader, writer):
+        peer = writer.get_extra_info("peername")
+        if self.compressor is not None and isinstance(peer, tuple):
+            self.compressor.add_peer(writer, peer[0])
+        try:
+            while True:
+                pdu = await recvPDUAsync(reader)
+                negotiated = answerCodecRequest(pdu)
+                if negotiated is not None:
+                    reply, codec, features = negotiated
+                    await sendPDUAsync(writer, reply)
+                    setCodec(reader, codec)
+                    setCodec(writer, codec)
+                    setFeatures(writer, features)
+                    continue
+                reply = answer_pdu(pdu, self.outputs, self.inputs)
+                if (
+                    reply[0] == "pullValuesRep"
+                    and self.compressor is not None
+                    and COMPRESSION_FEATURE in featuresOf(writer)
+                ):
+                    reply = ("pullValuesRep", self.compressor.pack(writer, reply[1]))
+                await sendPDUAsync(writer, reply)
+        except ValueError:
+            pass  # peer closed the connection
+        except RuntimeError as e:
+            print(f"agent {self.algoName}: dropping peer connection: {e}")
+        finally:
+            if self.compressor is not None:
+                self.compressor.remove_peer(writer)
+            writer.close()
+
+    async def connect_peers(self, conn_pdu):
+        endpoints = {}
+        for conn in conn_pdu["push"] + conn_pdu["pull"]:
+            endpoints.setdefault(
+                conn["remoteAlgoName"], (conn["address"], conn["port"])
+            )
+        if self.host is not None:
+            for remote_algo, (addr, port) in list(endpoints.items()):
+                local = self.host.local_agent(addr, port)
+                if local is not None:
+                    self.local_peers[remote_algo] = local
+                    del endpoints[remote_algo]
+        streams = await asyncio.gather(
+            *(self.open_connection(addr, port) for addr, port in endpoints.values()),
+            return_exceptions=True,
+        )
+        failures = [str(s) for s in streams if isinstance(s, BaseException)]
+        if failures:
+            for stream in streams:
+                if not isinstance(stream, BaseException):
+                    stream[1].close()
+            raise RuntimeError(", ".join(failures))
+        self.peers = dict(zip(endpoints, streams))
+        self.endpoints = endpoints
+        if self.compressor is not None:
+            for remote_algo, (addr, _) in endpoints.items():
+                self.compressor.add_peer(remote_algo, addr)
+
+    async def open_connection(self, addr, port):
+        # Same retries and backoff as the blocking agent's ConnectionPool
+        for attempt in range(self.config.connect_retries + 1):
+            if attempt:
+                await asyncio.sleep(self.config.connect_backoff * 2 ** (attempt - 1))
+            try:
+                return await self.connect_stream(addr, port)
+            except (OSError, RuntimeError, ValueError) as e:
+                error = e
+        raise RuntimeError(f"cannot connect to {addr}:{port}: {error}")
+
+    async def connect_stream(self, addr, port):
+        stream = None
+        unix_dir = self.config.unix_socket_dir
+        if unix_dir and is_local_address(addr) and is_private_directory(unix_dir):
+            try:
+                stream = await asyncio.open_unix_connection(
+                    unix_socket_path(unix_dir, port)
+                )
+            except OSError:
+                pass  # no Unix socket there, over TCP
+        if stream is None:
+            stream = await asyncio.open_connection(addr, port)
+        reader, writer = stream
+        if self.codecs != ["der"] or self.features:
+            try:
+                await negotiateCodecAsync(reader, writer, self.codecs, self.features)
+            except BaseException:
+                writer.close()
+                raise
+        return reader, writer
+
+    async def pull_from(self, remote_algo, plan):
+        names = plan.pull_groups[remote_algo]
+        local = self.local_peers.get(remote_algo)
+        if local is not None:
+            rep_pdu = answer_pdu(
+                ("pullValuesReq", list(names)), local.outputs, local.inputs
+            )
+            return match_pull_reply(names, rep_pdu[1])
+        reader, writer = self.peers[remote_algo]
+        frame = plan.pull_frame(remote_algo, codecOf(writer))
+        await sendEncodedPDUAsync(writer, "pullValuesReq", frame)
+        rep_pdu = await recvPDUAsync(reader)
+        if rep_pdu[0] == "pullValuesRepLinuxSHM":
+            rep_pdu = ("pullValuesRep", read_variables(rep_pdu[1]))
+        if rep_pdu[0] != "pullValuesRep":
+            raise ValueError(
+                f"got {rep_pdu[0]} instead of pullValuesRep from {remote_algo}"
+            )
+        return decompress_values(match_pull_reply(names, rep_pdu[1]))
+
+    async def push_to(self, remote_algo, variables):
+        if self.delta is not None:
+            variables = self.delta.changed(remote_algo, variables)
+        if not variables:
+            return []
+        local = self.local_peers.get(remote_algo)
+        if local is not None:
+            status = answer_pdu(("pushValues", variables), local.outputs, local.inputs)
+        else:
+            reader, writer = self.peers[remote_algo]
+            sent = variables
+            if self.compressor is not None and COMPRESSION_FEATURE in featuresOf(
+                writer
+            ):
+                sent = self.compressor.pack(remote_algo, variables)
+            await sendPDUAsync(writer, ("pushValues", sent))
+            status = await recvPDUAsync(reader)
+        if status[0] == "ack":
+            if self.delta is not None:
+                self.delta.ack(remote_algo, variables)
+            return []
+        if status[0] == "nack":
+            if self.delta is not None:
+                self.delta.forget(remote_algo)
+            return [(remote_algo, var["name"], status[1]) for var in variables]
+        raise ValueError("Received PDU is neither an ack nor a nack")
+
+    def reconnect_peers(self):
+        # Peers dropped for missing a deadline are connected again in the
+        # background, and late until then: waiting for them here would eat
+        # into the deadline of the peers that are up
+        for remote_algo, task in list(self.reconnecting.items()):
+            if not task.done():
+                continue
+            del self.reconnecting[remote_algo]
+            if not task.cancelled() and task.exception() is None:
+                self.peers[remote_algo] = task.result()
+        for remote_algo, (addr, port) in self.endpoints.items():
+            if remote_algo in self.peers or remote_algo in self.reconnecting:
+                continue
+            self.reconnecting[remote_algo] = asyncio.ensure_future(
+                asyncio.wait_for(
+                    self.connect_stream(addr, port), self.config.cycle_deadline
+                )
+            )
+
+    async def within_deadline(self, remote_algo, exchange, late, deadline):
+        """
+        Awaits one peer exchange; with a cycle `deadline` a peer that fails
+        or misses it is dropped, added to `late` and the exchange returns
+        None.
+        """
+        if deadline is None:
+            return await exchange
+        try:
+            if remote_algo not in self.peers and remote_algo not in self.local_peers:
+                exchange.close()
+                raise RuntimeError(f"{remote_algo} is not connected")
+            return await asyncio.wait_for(exchange, remaining(deadline))
+        except (asyncio.TimeoutError, OSError, RuntimeError, ValueError):
+            late.append(remote_algo)
+            stream = self.peers.pop(remote_algo, None)
+            if stream is not None:
+                stream[1].close()
+            if self.delta is not None:
+                self.delta.forget(remote_algo)
+            return None
+
+    async def start_server(self):
+        self.server = await asyncio.start_server(self.serve_peer, "0.0.0.0", 0)
+        port = self.server.sockets[0].getsockname()[1]
+        if self.config.unix_socket_dir:
+            sock = create_unix_listener(self.config.unix_socket_dir, port)
+            if sock is not None:
+                self.unix_path = sock.getsockname()
+                self.unix_server = await asyncio.start_unix_server(
+                    self.serve_peer, sock=sock
+                )
+        return port
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+        if self.unix_server is not None:
+            self.unix_server.close()
+            remove_unix_socket(self.unix_path)
+            self.unix_server = None
+        for _, writer in self.peers.values():
+            writer.close()
+        for task in self.reconnecting.values():
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled() and task.exception() is None:
+                task.result()[1].close()
+        self.reconnecting.clear()
+
+    async def run(self):
+        check_policy(self.config.stale_policy)
+        setMaxFrameSize(self.config.max_frame_size)
+        self.runner = create_runner(self.className, self.config)
+        try:
+            self.checkpointer = create_checkpointer(self.algoName, self.config)
+            port = await self.start_server()
+            try:
+                await self.run_cycles(port)
+            finally:
+                self.close()
+        finally:
+            if self.checkpointer is not None:
+                self.checkpointer.close()
+            if self.runner is not None:
+                self.runner.close()
+
+    async def run_cycles(self, port):
+        algoName = self.algoName
+        host, core_port = parse_core_url(self.url)
+        reader, writer = await asyncio.open_connection(host, core_port)
+        try:
+            await sendPDUAsync(
+                writer,
+                (
+                    "reg",
+                    {"algoName": algoName, "className": self.className, "port": port},
+                ),
+            )
+            conn_pdu = await recvPDUAsync(reader)
+            if conn_pdu[0] != "setConn":
+                return
+            print_conn_pdu(algoName, conn_pdu[1])
+            try:
+                await self.connect_peers(conn_pdu[1])
+            except RuntimeError as e:
+                await sendPDUAsync(writer, ("nack", str(e)))
+                raise
+            plan = CyclePlan(conn_pdu[1])
+
+            algo = None
+            if self.runner is None:
+                algo = create_algorithm_instance(self.className)
+            source = algo if self.runner is None else self.runner
+            loop = asyncio.get_running_loop()
+            checkpointer = self.checkpointer
+            if checkpointer is not None and not supports_checkpoint(source):
+                print(
+                    f"agent {algoName}: {self.className} has no export_state/import_state"
+                )
+                checkpointer = None
+            # Cycles up to this nextCycle timestamp are in the restored state
+            resume_at = None
+            cycles = 0
+            if checkpointer is not None:
+                try:
+                    snapshot = await loop.run_in_executor(
+                        None, restore_checkpoint, checkpointer, source
+                    )
+                except RuntimeError as e:
+                    await sendPDUAsync(writer, ("nack", str(e)))
+                    raise
+                if snapshot is not None:
+                    print(
+                        f"agent {algoName}: restored cycle {snapshot.cycle} "
+                        f"(timestamp {snapshot.timestamp})"
+                    )
+                    self.outputs = dict(snapshot.outputs)
+                    resume_at = snapshot.timestamp
+                    cycles = snapshot.cycle
+            await sendPDUAsync(writer, ("ack", None))
+
+            fail_late = self.config.stale_policy == "fail"
+            while True:
+                pdu = await recvPDUAsync(reader)
+                if pdu[0] == "done":
+                    await sendPDUAsync(writer, ("ack", None))
+                    break
+                if pdu[0] != "nextCycle":
+                    print(f"agent {algoName} : cannot get nextCycle")
+                    return
+                if checkpointer is not None:
+                    timestamp = pdu[1]["timestamp"]
+                    if resume_at is not None and timestamp <= resume_at:
+                        # Already run before the restored snapshot
+                        await sendPDUAsync(writer, ("ack", None))
+                        pdu = await recvPDUAsync(reader)
+                        if pdu[0] != "shiftValues":
+                            print(f"agent {algoName}: cannot get shiftValues")
+                            return
+                        await sendPDUAsync(writer, ("ack", None))
+                        continue
+                    resume_at = None
+
+                input_params, self.inputs = self.inputs, {}
+                if self.input_cache is not None:
+                    input_params = self.input_cache.merge(input_params)
+                late: list[str] = []
+                if self.config.cycle_deadline > 0:
+                    self.reconnect_peers()
+                deadline = cycle_deadline(self.config.cycle_deadline)
+                for pulled in await asyncio.gather(
+                    *(
+                        self.within_deadline(
+                            remote_algo,
+                            self.pull_from(remote_algo, plan),
+                            late,
+                            deadline,
+                        )
+                        for remote_algo in plan.pull_requests
+                    )
+                ):
+                    if pulled is not None:
+                        input_params.update(pulled)
+                if self.last_values is not None:
+                    self.last_values.update(input_params)
+                    input_params.update(
+                        self.last_values.stale_inputs(plan.pull_groups, late)
+                    )
+
+                reason = None
+                if late and fail_late:
+                    reason = late_reason(late, self.config.cycle_deadline)
+                elif self.runner is not None:
+                    try:
+                        output_params = await loop.run_in_executor(
+                            None, self.runner.run, input_params
+                        )
+                    except RuntimeError as e:
+                        reason = f"run failed: {e}"
+                else:
+                    output_params = await run_algorithm(algo, input_params)
+                if reason is not None:
+                    print(f"agent {algoName}: {reason}")
+                    await sendPDUAsync(writer, ("nack", reason))
+                    pdu = await recvPDUAsync(reader)
+                    if pdu[0] != "shiftValues":
+                        print(f"agent {algoName}: cannot get shiftValues")
+                        return
+                    # Nothing new to publish or push for a failed cycle
+                    await sendPDUAsync(writer, ("ack", None))
+                    continue
+
+                await sendPDUAsync(writer, ("ack", None))
+
+                pdu = await recvPDUAsync(reader)
+                if pdu[0] != "shiftValues":
+                    print(f"agent {algoName}: cannot get shiftValues")
+                    return
+                self.outputs = dict(output_params)
+                late = []
+
+                window = asyncio.Semaphore(max(self.config.push_window, 1))
+                if self.delta is not None:
+                    self.delta.start_cycle()
+                # One deadline for the whole phase, however many rounds of
+                # `window` peers it takes
+                deadline = cycle_deadline(self.config.cycle_deadline)
+
+                async def push(remote_algo, variables):
+                    async with window:
+                        return await self.within_deadline(
+                            remote_algo,
+                            self.push_to(remote_algo, variables),
+                            late,
+                            deadline,
+                        )
+
+                for nacks in await asyncio.gather(
+                    *(
+                        push(remote_algo, variables)
+                        for remote_algo, variables in plan.push_variables(output_params)
+                    )
+                ):
+                    for remote_algo, name, reason in nacks or ():
+                        print(
+                            f"agent {algoName}: {remote_algo} rejected {name}: {reason}"
+                        )
+                cycles += 1
+                if checkpointer is not None and checkpointer.due(cycles):
+                    # A WorkerPool exports through its worker's pipe
+                    await loop.run_in_executor(
+                        None,
+                        save_checkpoint,
+                        checkpointer,
+                        source,
+                        cycles,
+                        timestamp,
+                        output_params,
+                    )
+                if late and fail_late:
+                    await sendPDUAsync(
+                        writer,
+                        ("nack", late_reason(late, self.config.cycle_deadline)),
+                    )
+                else:
+                    await sendPDUAsync(writer, ("ack", None))
+        except (ValueError, RuntimeError, OSError) as e:
+            print(f"agent {algoName}: {e}")
+        finally:
+            writer.close()
+
+
+class AgentHost:
+    """
+    Runs several algorithm instances in one process on one event loop. Each
+    instance still registers with the core on its own control connection and
+    listens on its own data port, so the core and remote peers see ordinary
+    agents, but pulls and pushes between co-hosted instances are answered in
+    memory without going through TCP or the codec.
+    """
+
+    def __init__(self, instances, url, config=None):
+        self.config = config if config is not None else AgentConfig()
+        self.agents = [
+            AsyncAgent(algoName, className, url, self.config, host=self)
+            for algoName, className in instances
+        ]
+        # data port -> AsyncAgent
+        self.ports: dict = {}
+        self.runners: list = []
+
+    def create_runners(self):
+        # Instances of a stateless algorithm share one pool of workers
+        shared: dict = {}
+        for agent in self.agents:
+            runner = shared.get(agent.className)
+            if runner is None:
+                runner = create_runner(agent.className, self.config)
+                if runner is None:
+                    return
+                self.runners.append(runner)
+                if runner.stateless:
+                    shared[agent.className] = runner
+            agent.runner = runner
+
+    def local_agent(self, address, port):
+        if not is_local_address(address):
+            return None
+        return self.ports.get(port)
+
+    async def run(self):
+        check_policy(self.config.stale_policy)
+        setMaxFrameSize(self.config.max_frame_size)
+        try:
+            self.create_runners()
+            for agent in self.agents:
+                agent.checkpointer = create_checkpointer(agent.algoName, self.config)
+            # Every port is known before any instance registers, so the
+            # connections the core hands out can be matched against them
+            ports = await asyncio.gather(
+                *(agent.start_server() for agent in self.agents)
+            )
+            self.ports = dict(zip(ports, self.agents))
+            await asyncio.gather(
+                *(agent.run_cycles(port) for agent, port in zip(self.agents, ports))
+            )
+        finally:
+            for agent in self.agents:
+                agent.close()
+                if agent.checkpointer is not None:
+                    agent.checkpointer.close()
+            for runner in self.runners:
+                runner.close()
+
+
+def parse_instances(specs):
+    """
+    Parses "algoName:className" command line arguments.
+    """
+    instances = []
+    for spec in specs:
+        algoName, sep, className = spec.partition(":")
+        if not sep or not algoName or not className:
+            raise ValueError(f"Invalid instance {spec}, expected algoName:className")
+        instances.append((algoName, className))
+    names = [algoName for algoName, _ in instances]
+    if len(set(names)) != len(names):
+        raise ValueError("Instance names must be unique")
+    return instances
+
+
+def start_agent_host(instances, url, config=None):
+    if config is None:
+        config = AgentConfig()
+    tracer = create_tracer("host", config)
+    try:
+        asyncio.run(AgentHost(instances, url, config).run())
+    finally:
+        if tracer is not None:
+            tracer.close()
+
+
+def start_async_agent(algoName, className, url, config=None):
+    if config is None:
+        config = AgentConfig()
+    tracer = create_tracer(algoName, config)
+    try:
+        asyncio.run(AsyncAgent(algoName, className, url, config).run())
+    finally:
+        if tracer is not None:
+            tracer.close()
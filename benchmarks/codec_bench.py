@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Wire codec benchmark: frame size and encode/decode time of every PDU type
+in each codec peers can negotiate, as JSON.
+
+    python3 -m benchmarks.codec_bench --codecs der,oer,uper --number 2000 \\
+        --output codecs.json
+
+"der" goes through the fastcodec fast path, like the agents do.
+"""
+
+import argparse
+import json
+import sys
+import timeit
+
+from protocol import WIRE_CODECS, decodePDU, encodePDU, parseCodecs
+
+
+def variables(count, value):
+    return [{"name": f"value{i}", "value": value} for i in range(count)]
+
+
+def connection(i):
+    return {
+        "localParamName": f"in{i}",
+        "remoteAlgoName": f"agent{i}",
+        "remoteParamName": "out",
+        "address": "10.0.0.1",
+        "port": 40000 + i,
+    }
+
+
+# (label, PDU) samples of what an agent exchanges with the core and peers
+SAMPLES = [
+    ("ack", ("ack", None)),
+    ("nack", ("nack", "run failed: timeout")),
+    ("reg", ("reg", {"algoName": "agent0", "className": "Algo", "port": 40000})),
+    (
+        "setConn",
+        ("setConn", {"push": [connection(i) for i in range(8)], "pull": []}),
+    ),
+    ("nextCycle", ("nextCycle", {"timestamp": 123456})),
+    ("pullValuesReq", ("pullValuesReq", [f"value{i}" for i in range(16)])),
+    ("pullValuesRep-integer16", ("pullValuesRep", variables(16, ("integer", 42)))),
+    ("pushValues-real16", ("pushValues", variables(16, ("real", 0.1)))),
+    ("pushValues-boolean16", ("pushValues", variables(16, ("boolean", True)))),
+    ("pushValues-blob1k", ("pushValues", variables(1, ("blob", b"\xa5" * 1024)))),
+    (
+        "pushValues-custom1k",
+        (
+            "pushValues",
+            variables(
+                1, ("custom", {"type": "1.3.6.1.4.1.54321.3.1", "data": b"\0" * 1024})
+            ),
+        ),
+    ),
+]
+
+
+def run_codec_benchmark(codecs=WIRE_CODECS, number=1000):
+    results = []
+    for label, pdu in SAMPLES:
+        for codec in codecs:
+            encoded = encodePDU(pdu, codec)
+            if decodePDU(encoded, codec) != pdu:
+                raise RuntimeError(f"{codec} does not round-trip {label}")
+            encode = timeit.timeit(lambda: encodePDU(pdu, codec), number=number)
+            decode = timeit.timeit(lambda: decodePDU(encoded, codec), number=number)
+            results.append(
+                {
+                    "pdu": label,
+                    "codec": codec,
+                    "bytes": len(encoded),
+                    "encode_us": encode / number * 1e6,
+                    "decode_us": decode / number * 1e6,
+                }
+            )
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--codecs", default=",".join(WIRE_CODECS))
+    parser.add_argument("--number", type=int, default=1000)
+    parser.add_argument("--output", help="write the JSON result to this file")
+    args = parser.parse_args(argv)
+
+    result = run_codec_benchmark(parseCodecs(args.codecs), args.number)
+    encoded = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(encoded + "\n")
+    print(encoded)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+End-to-end cycle benchmark: a stand-in core drives N real start_agent
+processes over loopback and reports cycles/s and per-cycle latency as JSON.
+
+    python3 -m benchmarks.cycle_bench --topology fan-in --agents 8 \\
+        --value real --mode pull --cycles 2000 --output result.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+from agent import start_agent
+from algo import register_algorithm
+from benchmarks.stand_in_core import StandInCore
+from config import AgentConfig
+
+VALUES = {
+    "integer": ("integer", 123456789),
+    "real": ("real", 3.141592653589793),
+    "blob1k": ("blob", b"\xa5" * 1024),
+    "blob1m": ("blob", b"\xa5" * 1024 * 1024),
+}
+
+TOPOLOGIES = ("chain", "fan-in", "fan-out", "mesh")
+
+
+class BenchAlgorithm:
+    """
+    Publishes one output of the configured value type every cycle and
+    ignores its inputs.
+    """
+
+    def __init__(self, value):
+        self.outputs = {"out": value}
+
+    def run(self, params):
+        return self.outputs
+
+
+for _value_name, _value in VALUES.items():
+    register_algorithm(
+        f"Bench-{_value_name}", lambda value=_value: BenchAlgorithm(value)
+    )
+
+
+def topology_edges(topology, count):
+    # (producer, consumer) index pairs
+    if topology == "chain":
+        return [(i, i + 1) for i in range(count - 1)]
+    if topology == "fan-in":
+        return [(i, 0) for i in range(1, count)]
+    if topology == "fan-out":
+        return [(0, i) for i in range(1, count)]
+    if topology == "mesh":
+        return [(i, j) for i in range(count) for j in range(count) if i != j]
+    raise ValueError(f"unknown topology {topology}")
+
+
+def agent_name(index):
+    return f"bench{index}"
+
+
+def build_connections(core, edges, count, mode):
+    connections = {agent_name(i): {"push": [], "pull": []} for i in range(count)}
+    for producer, consumer in edges:
+        src, dst = agent_name(producer), agent_name(consumer)
+        if mode == "pull":
+            connections[dst]["pull"].append(
+                core.connection(f"in{producer}", src, "out")
+            )
+        else:
+            conn = core.connection("out", dst, f"in{producer}")
+            connections[src]["push"].append(conn)
+    return connections
+
+
+def agent_process(name, className, url, config):
+    # Agents are chatty on stdout; keep the benchmark output clean
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    start_agent(name, className, url, config)
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def run_benchmark(
+    topology="chain",
+    agents=2,
+    value="integer",
+    mode="pull",
+    cycles=1000,
+    warmup=50,
+    config=None,
+):
+    if agents < 2:
+        raise ValueError("at least two agents are needed")
+    if config is None:
+        config = AgentConfig.from_env()
+    core = StandInCore()
+    context = multiprocessing.get_context("fork")
+    processes = [
+        context.Process(
+            target=agent_process,
+            args=(agent_name(i), f"Bench-{value}", core.url, config),
+            daemon=True,
+        )
+        for i in range(agents)
+    ]
+    samples = []
+    try:
+        with open(os.devnull, "w") as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                for process in processes:
+                    process.start()
+                core.accept_agents(agents)
+                edges = topology_edges(topology, agents)
+                core.setup(build_connections(core, edges, agents, mode))
+
+                for timestamp in range(warmup):
+                    core.cycle(timestamp)
+                started = time.perf_counter()
+                for timestamp in range(warmup, warmup + cycles):
+                    cycle_start = time.perf_counter()
+                    core.cycle(timestamp)
+                    samples.append(time.perf_counter() - cycle_start)
+                elapsed = time.perf_counter() - started
+                core.finish()
+            finally:
+                sys.stdout = stdout
+    finally:
+        core.close()
+        for process in processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+
+    return {
+        "topology": topology,
+        "agents": agents,
+        "edges": len(edges),
+        "value": value,
+        "mode": mode,
+        "cycles": cycles,
+        "cycles_per_sec": cycles / elapsed,
+        "latency_ms": {
+            "p50": percentile(samples, 0.50) * 1000,
+            "p99": percentile(samples, 0.99) * 1000,
+            "mean": sum(samples) / len(samples) * 1000,
+            "max": max(samples) * 1000,
+        },
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--topology", choices=TOPOLOGIES, default="chain")
+    parser.add_argument("--agents", type=int, default=4)
+    parser.add_argument("--value", choices=sorted(VALUES), default="integer")
+    parser.add_argument("--mode", choices=("pull", "push"), default="pull")
+    parser.add_argument("--cycles", type=int, default=1000)
+    parser.add_argument("--warmup", type=int, default=50)
+    parser.add_argument("--output", help="write the JSON result to this file")
+    args = parser.parse_args(argv)
+
+    result = run_benchmark(
+        args.topology, args.agents, args.value, args.mode, args.cycles, args.warmup
+    )
+    encoded = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(encoded + "\n")
+    print(encoded)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
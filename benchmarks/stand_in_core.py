@@ -0,0 +1,77 @@
+import socket
+
+from protocol import recvPDU, recvStatusPDU, sendPDU
+
+# Minimal Python stand-in for the SMM-3NG core: accepts agent registrations,
+# hands out connections and drives lock-step cycles with the real
+# reg / setConn / nextCycle / shiftValues / done protocol.
+
+
+class StandInCore:
+    def __init__(self, host="127.0.0.1"):
+        self.listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listen_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listen_sock.bind((host, 0))
+        self.listen_sock.listen(128)
+        self.host = host
+        # algoName -> (control socket, data responder port)
+        self.agents: dict[str, tuple[socket.socket, int]] = {}
+
+    @property
+    def url(self):
+        return "tcp://%s:%d" % self.listen_sock.getsockname()
+
+    def accept_agents(self, count, timeout=30.0):
+        self.listen_sock.settimeout(timeout)
+        while len(self.agents) < count:
+            sock, _ = self.listen_sock.accept()
+            sock.settimeout(timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            pdu = recvPDU(sock)
+            if pdu[0] != "reg":
+                sock.close()
+                raise RuntimeError(f"expected reg, got {pdu[0]}")
+            self.agents[pdu[1]["algoName"]] = (sock, pdu[1]["port"])
+
+    def connection(self, local_param, remote_algo, remote_param):
+        return {
+            "localParamName": local_param,
+            "remoteAlgoName": remote_algo,
+            "remoteParamName": remote_param,
+            "address": self.host,
+            "port": self.agents[remote_algo][1],
+        }
+
+    def setup(self, connections):
+        """
+        `connections` maps every algoName to its {"push": [..], "pull": [..]}
+        SetupConnectionsPDU.
+        """
+        for name, (sock, _) in self.agents.items():
+            sendPDU(sock, ("setConn", connections[name]))
+        self.expect_acks("setConn")
+
+    def expect_acks(self, phase):
+        for name, (sock, _) in self.agents.items():
+            ok, reason = recvStatusPDU(sock)
+            if not ok:
+                raise RuntimeError(f"{name} rejected {phase}: {reason}")
+
+    def cycle(self, timestamp):
+        for sock, _ in self.agents.values():
+            sendPDU(sock, ("nextCycle", {"timestamp": timestamp}))
+        self.expect_acks("nextCycle")
+        for sock, _ in self.agents.values():
+            sendPDU(sock, ("shiftValues", None))
+        self.expect_acks("shiftValues")
+
+    def finish(self):
+        for sock, _ in self.agents.values():
+            sendPDU(sock, ("done", None))
+        self.expect_acks("done")
+
+    def close(self):
+        for sock, _ in self.agents.values():
+            sock.close()
+        self.agents.clear()
+        self.listen_sock.close()
@@ -0,0 +1,258 @@
+import collections
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+from protocol import decodePDU, encodePDU
+
+# Algorithm state checkpoints (SMM3NG_CHECKPOINT_PATH): algorithm classes
+# opting in with export_state() -> bytes and import_state(bytes) have their
+# state written every SMM3NG_CHECKPOINT_INTERVAL cycles, together with the
+# outputs of that cycle and its nextCycle timestamp. An agent restarted with
+# the same file imports the last snapshot before acknowledging setConn,
+# publishes its outputs again and acknowledges the cycles up to its
+# timestamp without running them, so a simulation started over from cycle
+# zero catches up with where it stopped.
+#
+# The control loop only exports the state; a background thread copies it
+# into the file, which has two slots written in turn. A slot is described
+# by a SNAPSHOT_SLOT record that is only updated once the data it points to
+# is flushed, and its checksum covers that data, so a crash while writing
+# leaves the other slot, the previous snapshot, to restore from.
+#
+# File layout: the CHECKPOINT_HEADER and the two SNAPSHOT_SLOT records in the
+# first HEADER_SIZE bytes, then the slot data. A slot is moved to the end of
+# the file when a snapshot outgrows it.
+
+CHECKPOINT_MAGIC = b"SMM3CKP1"
+CHECKPOINT_HEADER = struct.Struct("<8s")
+# seq, timestamp, cycle, data offset, capacity, state size, outputs size,
+# crc32 of the state and outputs
+SNAPSHOT_SLOT = struct.Struct("<QqQQQQQI4x")
+SLOTS = 2
+HEADER_SIZE = mmap.PAGESIZE
+
+Snapshot = collections.namedtuple(
+    "Snapshot", ["cycle", "timestamp", "state", "outputs"]
+)
+
+
+def supports_checkpoint(source):
+    """
+    Whether `source`, an algorithm or the WorkerPool running it, has the
+    export_state/import_state checkpoint methods.
+    """
+    checkpointable = getattr(source, "checkpointable", None)
+    if checkpointable is not None:
+        return checkpointable is True
+    return all(
+        callable(getattr(type(source), method, None))
+        for method in ("export_state", "import_state")
+    )
+
+
+def slot_offset(index):
+    return CHECKPOINT_HEADER.size + index * SNAPSHOT_SLOT.size
+
+
+def encode_outputs(outputs):
+    return encodePDU(
+        (
+            "pushValues",
+            [{"name": name, "value": value} for name, value in outputs.items()],
+        )
+    )
+
+
+def decode_outputs(data):
+    if not data:
+        return {}
+    return {var["name"]: var["value"] for var in decodePDU(data)[1]}
+
+
+class SnapshotFile:
+    """
+    The two snapshot slots of a checkpoint file, created when missing.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.closed = False
+        self.fd = os.open(path, os.O_CREAT | os.O_RDWR, 0o644)
+        try:
+            size = os.fstat(self.fd).st_size
+            if size < HEADER_SIZE:
+                os.ftruncate(self.fd, HEADER_SIZE)
+                size = HEADER_SIZE
+            self.map = mmap.mmap(self.fd, size)
+            if self.map[: len(CHECKPOINT_MAGIC)] != CHECKPOINT_MAGIC:
+                if any(self.map[:HEADER_SIZE]):
+                    raise ValueError(f"{path} is not a checkpoint file")
+                CHECKPOINT_HEADER.pack_into(self.map, 0, CHECKPOINT_MAGIC)
+                self.map.flush()
+        except BaseException:
+            os.close(self.fd)
+            raise
+
+    def slot(self, index):
+        return SNAPSHOT_SLOT.unpack_from(self.map, slot_offset(index))
+
+    def valid(self, index):
+        seq, _, _, offset, capacity, state_size, outputs_size, crc = self.slot(index)
+        size = state_size + outputs_size
+        if seq == 0 or size > capacity or offset + capacity > len(self.map):
+            return False
+        return zlib.crc32(self.map[offset : offset + size]) == crc
+
+    def read(self):
+        """
+        Returns the last complete Snapshot, or None when there is none.
+        """
+        slots = [index for index in range(SLOTS) if self.valid(index)]
+        if not slots:
+            return None
+        index = max(slots, key=lambda index: self.slot(index)[0])
+        _, timestamp, cycle, offset, _, state_size, outputs_size, _ = self.slot(index)
+        state = self.map[offset : offset + state_size]
+        outputs = self.map[offset + state_size : offset + state_size + outputs_size]
+        return Snapshot(cycle, timestamp, state, decode_outputs(outputs))
+
+    def write(self, cycle, timestamp, state, outputs):
+        seqs = [self.slot(index)[0] for index in range(SLOTS)]
+        # The slot of the older snapshot is overwritten
+        index = seqs.index(min(seqs))
+        _, _, _, offset, capacity, _, _, _ = self.slot(index)
+        size = len(state) + len(outputs)
+        if size > capacity:
+            offset, capacity = self.grow(size)
+        self.map[offset : offset + len(state)] = state
+        self.map[offset + len(state) : offset + size] = outputs
+        crc = zlib.crc32(self.map[offset : offset + size])
+        # Flushed ranges must start on a page boundary
+        self.map.flush(offset, size)
+        SNAPSHOT_SLOT.pack_into(
+            self.map,
+            slot_offset(index),
+            max(seqs) + 1,
+            timestamp,
+            cycle,
+            offset,
+            capacity,
+            len(state),
+            len(outputs),
+            crc,
+        )
+        self.map.flush(0, HEADER_SIZE)
+
+    def grow(self, size):
+        # Room for the snapshot to double at the end of the file; the slot
+        # being replaced may still hold the only complete snapshot, so its
+        # data is left where it is
+        offset = len(self.map)
+        capacity = -(-2 * size // mmap.PAGESIZE) * mmap.PAGESIZE
+        os.ftruncate(self.fd, offset + capacity)
+        self.map.close()
+        self.map = mmap.mmap(self.fd, offset + capacity)
+        return offset, capacity
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.map.close()
+        os.close(self.fd)
+
+
+class Checkpointer:
+    """
+    Writes snapshots to a SnapshotFile from a background thread, every
+    `interval` cycles. A snapshot saved while the previous one is still
+    being written replaces it if that one has not been started yet.
+    """
+
+    def __init__(self, path, interval=100):
+        if interval <= 0:
+            raise ValueError("checkpoint interval must be positive")
+        self.interval = interval
+        self.file = SnapshotFile(path)
+        self.pending = None
+        self.closing = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(
+            target=self.write_loop, name="checkpoint", daemon=True
+        )
+        self.thread.start()
+
+    def restore(self):
+        return self.file.read()
+
+    def due(self, cycle):
+        return cycle % self.interval == 0
+
+    def save(self, cycle, timestamp, state, outputs):
+        # The outputs are encoded by the writer thread; the agent never
+        # changes a dict once published
+        with self.condition:
+            self.pending = (cycle, timestamp, bytes(state), dict(outputs))
+            self.condition.notify()
+
+    def write_loop(self):
+        while True:
+            with self.condition:
+                while self.pending is None and not self.closing:
+                    self.condition.wait()
+                if self.pending is None:
+                    return
+                cycle, timestamp, state, outputs = self.pending
+                self.pending = None
+            try:
+                self.file.write(cycle, timestamp, state, encode_outputs(outputs))
+            except (OSError, RuntimeError, ValueError, struct.error) as e:
+                print(f"checkpoint {self.file.path}: cannot write snapshot: {e}")
+
+    def close(self):
+        # The last snapshot saved is written before the file is closed
+        with self.condition:
+            self.closing = True
+            self.condition.notify()
+        self.thread.join()
+        self.file.close()
+
+
+def create_checkpointer(algoName, config):
+    """
+    Returns the Checkpointer of the agent, or None when no checkpoint_path
+    is configured.
+    """
+    if not config.checkpoint_path:
+        return None
+    path = config.checkpoint_path.replace("{agent}", algoName)
+    return Checkpointer(path, config.checkpoint_interval)
+
+
+def restore_checkpoint(checkpointer, source):
+    """
+    Imports the last snapshot into `source` and returns it, or None when
+    there is nothing to restore. Raises RuntimeError when the state is
+    rejected.
+    """
+    snapshot = checkpointer.restore()
+    if snapshot is None:
+        return None
+    try:
+        source.import_state(snapshot.state)
+    except Exception as e:
+        raise RuntimeError(f"cannot restore checkpoint of cycle {snapshot.cycle}: {e}")
+    return snapshot
+
+
+def save_checkpoint(checkpointer, source, cycle, timestamp, outputs):
+    # A failed snapshot must not fail the cycle; the next one is tried again
+    try:
+        state = source.export_state()
+    except Exception as e:
+        print(f"checkpoint of cycle {cycle} failed: {e}")
+        return
+    checkpointer.save(cycle, timestamp, state, outputs)
@@ -0,0 +1,196 @@
+import bz2
+import lzma
+import zlib
+
+import protocol
+from arrays import SMM3NG_OID
+from protocol import asn1_compiler
+from shm import is_local_address
+
+# Large blob and custom values sent to remote peers may be compressed. A
+# compressed value is a "custom" value whose type is the OID of the codec and
+# whose data is the compressed DER encoding of the original SMM3NG-Type, so
+# the receiver gets back exactly the value that was sent, whatever its type.
+# Every agent decompresses what it receives. Agents configured with
+# SMM3NG_COMPRESSION ask the peers they connect to for the "compress"
+# feature of the codec negotiation (protocol.negotiateCodec), and values are
+# only compressed on connections where the peer agreed to it, in both
+# directions: peers that do not know these OIDs get the values as they are.
+
+COMPRESSION_OID = SMM3NG_OID + ".2"
+CODEC_OIDS = {
+    "zlib": COMPRESSION_OID + ".1",
+    "lzma": COMPRESSION_OID + ".2",
+    "bz2": COMPRESSION_OID + ".3",
+}
+CODEC_NAMES = {oid: name for name, oid in CODEC_OIDS.items()}
+COMPRESSIBLE_TYPES = ("blob", "custom")
+
+# Adaptive mode: a peer whose values shrink to more than MIN_SAVING of their
+# size after PROBE_VALUES values is sent uncompressed values, and probed
+# again after BACKOFF_VALUES more
+MIN_SAVING = 0.9
+PROBE_VALUES = 8
+BACKOFF_VALUES = 256
+
+
+def compress_data(codec, data):
+    if codec == "zlib":
+        return zlib.compress(data, 1)
+    if codec == "lzma":
+        return lzma.compress(data, preset=0)
+    return bz2.compress(data, 1)
+
+
+def decompressor(codec):
+    if codec == "zlib":
+        return zlib.decompressobj()
+    if codec == "lzma":
+        return lzma.LZMADecompressor()
+    return bz2.BZ2Decompressor()
+
+
+def decompress_data(codec, data, limit):
+    # Never inflate past the frame size limit, whatever the peer sent
+    inflater = decompressor(codec)
+    decompressed = inflater.decompress(data, limit + 1)
+    if len(decompressed) > limit:
+        raise RuntimeError(f"compressed value exceeds {limit} bytes")
+    if codec == "zlib":
+        done = inflater.eof and not inflater.unconsumed_tail
+    else:
+        done = inflater.eof
+    if not done:
+        raise RuntimeError("truncated compressed value")
+    return decompressed
+
+
+def is_compressed(value):
+    return value[0] == "custom" and value[1]["type"] in CODEC_NAMES
+
+
+def decompress_value(value):
+    codec = CODEC_NAMES[value[1]["type"]]
+    try:
+        der = decompress_data(codec, value[1]["data"], protocol.max_frame_size)
+    except (zlib.error, lzma.LZMAError, OSError, EOFError) as e:
+        raise RuntimeError(f"cannot decompress {codec} value: {e}")
+    try:
+        return asn1_compiler.decode("SMM3NG-Type", der)
+    except Exception as e:
+        raise RuntimeError(f"cannot decode {codec} value: {e}")
+
+
+def decompress_values(params):
+    """
+    Returns `params` with compressed values replaced by the original ones.
+    """
+    if not any(is_compressed(value) for value in params.values()):
+        return params
+    return {
+        name: decompress_value(value) if is_compressed(value) else value
+        for name, value in params.items()
+    }
+
+
+class _PeerStats:
+    def __init__(self):
+        self.raw = 0
+        self.compressed = 0
+        self.values = 0
+        # Values left to send uncompressed before probing again
+        self.skip = 0
+
+
+class Compressor:
+    """
+    Compresses blob and custom values of at least `threshold` bytes sent to
+    peers that are not on this host. With `adaptive`, compression is turned
+    off for a peer while it does not save at least 10% of the bytes.
+    """
+
+    def __init__(self, codec="zlib", threshold=4096, adaptive=True):
+        if codec not in CODEC_OIDS:
+            raise ValueError(f"unknown compression codec {codec}")
+        self.codec = codec
+        self.oid = CODEC_OIDS[codec]
+        self.threshold = threshold
+        self.adaptive = adaptive
+        self.remote_peers = set()
+        self.stats: dict = {}
+        # name -> (value, compressed value) of the last value compressed, so
+        # a value sent to several peers is compressed once
+        self.cache: dict = {}
+
+    def add_peer(self, key, address):
+        if not is_local_address(address):
+            self.remote_peers.add(key)
+            self.stats[key] = _PeerStats()
+
+    def remove_peer(self, key):
+        self.remote_peers.discard(key)
+        self.stats.pop(key, None)
+
+    def pack(self, key, variables):
+        """
+        Returns `variables` with the values worth compressing compressed.
+        """
+        if key not in self.remote_peers:
+            return variables
+        stats = self.stats[key]
+        packed = None
+        for index, var in enumerate(variables):
+            value = var["value"]
+            size = self.value_size(value)
+            if size < self.threshold:
+                continue
+            if stats.skip > 0:
+                stats.skip -= 1
+                continue
+            compressed = self.compress(var["name"], value)
+            stats.values += 1
+            stats.raw += size
+            stats.compressed += len(compressed[1]["data"])
+            if self.adaptive and stats.values >= PROBE_VALUES:
+                worth_it = stats.compressed <= MIN_SAVING * stats.raw
+                stats.raw = stats.compressed = stats.values = 0
+                if not worth_it:
+                    stats.skip = BACKOFF_VALUES
+            if packed is None:
+                packed = list(variables)
+            packed[index] = {"name": var["name"], "value": compressed}
+        return variables if packed is None else packed
+
+    @staticmethod
+    def value_size(value):
+        if value[0] == "blob":
+            return len(value[1])
+        if value[0] == "custom" and value[1]["type"] not in CODEC_NAMES:
+            return len(value[1]["data"])
+        return 0
+
+    def compress(self, name, value):
+        cached = self.cache.get(name)
+        if cached is not None and cached[0] is value:
+            return cached[1]
+        try:
+            der = asn1_compiler.encode("SMM3NG-Type", value)
+        except Exception as e:
+            raise RuntimeError(f"PDU encoding failed: {e}")
+        compressed = (
+            "custom",
+            {"type": self.oid, "data": compress_data(self.codec, der)},
+        )
+        self.cache[name] = (value, compressed)
+        return compressed
+
+
+def create_compressor(config):
+    # An empty codec name leaves values uncompressed
+    if not config.compression:
+        return None
+    return Compressor(
+        config.compression,
+        config.compression_threshold,
+        config.compression_adaptive,
+    )
@@ -0,0 +1,104 @@
+import os
+import tempfile
+from dataclasses import dataclass
+from typing import Optional
+
+# The core starts every agent with the same fixed command line, so tuning
+# knobs are read from SMM3NG_* environment variables instead of arguments.
+ENV_PREFIX = "SMM3NG_"
+
+
+@dataclass
+class AgentConfig:
+    # Max number of peers whose pushValues status may be outstanding
+    push_window: int = 64
+    # Largest PDU accepted from the core or a peer, in bytes
+    max_frame_size: int = 256 * 1024 * 1024
+    # Values for peers on the same host go through shared memory once their
+    # payload reaches this many bytes; 0 keeps everything on TCP
+    shm_threshold: int = 64 * 1024
+    # Directory of the Unix sockets agents also serve their data port on,
+    # used instead of TCP by peers on the same host; empty turns them off
+    unix_socket_dir: str = os.path.join(tempfile.gettempdir(), f"smm3ng-{os.getuid()}")
+    # Prometheus textfile to write cycle metrics to, or "unix:/path" to serve
+    # them on a Unix socket; metrics are off when unset
+    metrics_path: Optional[str] = None
+    # Seconds between two textfile updates
+    metrics_interval: float = 5.0
+    # Push only the values that changed since the peer acknowledged them and
+    # keep the last pushed value of every input; all agents must agree on it
+    delta_push: bool = False
+    # With delta_push, push everything again every this many cycles (0: never)
+    delta_refresh: int = 100
+    # Codec (zlib, lzma or bz2) compressing large blob and custom values sent
+    # to peers on other hosts that agree to it; empty leaves them uncompressed
+    compression: str = ""
+    # Smallest value compressed, in bytes
+    compression_threshold: int = 4096
+    # Stop compressing for a peer while it does not pay off
+    compression_adaptive: bool = True
+    # Wire codecs (der, ber, per, uper, oer) asked of the peers this agent
+    # connects to, preferred first, e.g. "oer,uper"; peers that support none
+    # of them, and the core, are spoken to in DER
+    wire_codec: str = "der"
+    # Extra attempts at connecting to a peer before giving up
+    connect_retries: int = 3
+    # Seconds before the first extra attempt, doubled for every further one
+    connect_backoff: float = 0.05
+    # Seconds the pull and push phases of a cycle may each take before late
+    # peers are given up on; 0 waits for every peer however long it takes
+    cycle_deadline: float = 0.0
+    # What the algorithm gets for the inputs of a late peer: "stale" (the
+    # last value received, as a StaleValue) or "fail" (the cycle is nacked)
+    stale_policy: str = "stale"
+    # Where algo.run executes: "inline" in the agent, or "process" in worker
+    # processes that keep the agent responsive while a step runs
+    run_mode: str = "inline"
+    # Worker processes for algorithms declaring `stateless = True`
+    run_workers: int = 1
+    # Seconds a step may run in process mode before the cycle is nacked and
+    # the worker replaced; 0 waits however long it takes
+    run_timeout: float = 0.0
+    # File algorithm state snapshots are written to and restored from, see
+    # checkpoint.py; "{agent}" is replaced by the agent name. Checkpoints
+    # are off when unset
+    checkpoint_path: Optional[str] = None
+    # Cycles between two snapshots
+    checkpoint_interval: int = 100
+    # Ring file PDU events are traced to; tracing is off when unset
+    trace_path: Optional[str] = None
+    # Lowest traced level: error (nacks), info (core control PDUs) or debug
+    # (every PDU)
+    trace_level: str = "info"
+    # Keep one in this many debug events
+    trace_sample: int = 1
+    # Records in the ring before the oldest are overwritten
+    trace_records: int = 65536
+
+    @classmethod
+    def from_env(cls, environ=None):
+        if environ is None:
+            environ = os.environ
+        config = cls()
+        for name, value in vars(config).items():
+            raw = environ.get(ENV_PREFIX + name.upper())
+            if raw is None:
+                continue
+            try:
+                setattr(config, name, _parse(raw, type(value)))
+            except ValueError:
+                raise ValueError(f"Invalid value for {ENV_PREFIX}{name.upper()}: {raw}")
+        return config
+
+
+def _parse(raw, kind):
+    # Options that default to None (disabled) are paths or names
+    if kind is type(None):
+        return raw or None
+    if kind is bool:
+        if raw.lower() in ("1", "true", "yes", "on"):
+            return True
+        if raw.lower() in ("0", "false", "no", "off", ""):
+            return False
+        raise ValueError(raw)
+    return kind(raw)
@@ -0,0 +1,217 @@
+import array
+import collections
+import struct
+import sys
+
+from arrays import SMM3NG_OID, from_arrays, to_arrays
+from deadline import stale_like
+
+# CustomType codecs: applications register the OBJECT IDENTIFIER of their
+# custom values with an encode(obj) -> bytes / decode(bytes) -> obj pair, and
+# algorithms get and return the decoded objects instead of
+# ("custom", {"type": oid, "data": bytes}) tuples. Custom values of OIDs
+# nobody registered are left as they are.
+#
+# Outputs are matched to a codec by their Python type (and the codec's
+# `accepts` when several codecs share a type, as array.array vectors do).
+# A codec registered with `lazy=True` hands the algorithm a LazyCustom,
+# decoded on first access to its `value`; an algorithm forwarding it
+# unchanged sends the received bytes again without decoding them at all.
+#
+# Built in: float64 and int64 vectors as array.array("d") and
+# array.array("q"), little-endian on the wire, and register_record() for
+# fixed layouts of struct fields decoded to a namedtuple.
+
+CUSTOM_OID = SMM3NG_OID + ".3"
+FLOAT64_VECTOR_OID = CUSTOM_OID + ".1"
+INT64_VECTOR_OID = CUSTOM_OID + ".2"
+
+
+class CustomCodec:
+    def __init__(self, oid, encode, decode, types=(), lazy=False, accepts=None):
+        self.oid = oid
+        self.encode = encode
+        self.decode = decode
+        self.types = tuple(types)
+        self.lazy = lazy
+        self.accepts = accepts
+
+
+# oid -> CustomCodec
+CODECS: dict = {}
+# Python type -> [CustomCodec, ..] encoding values of that type
+ENCODERS: dict = {}
+
+
+def register_codec(oid, encode, decode, types=(), lazy=False, accepts=None):
+    """
+    Registers the codec of the custom values of type `oid`. Outputs that are
+    instances of one of `types` (and pass `accepts(value)`, when given) are
+    encoded with it.
+    """
+    codec = CustomCodec(oid, encode, decode, types, lazy, accepts)
+    unregister_codec(oid)
+    CODECS[oid] = codec
+    for kind in codec.types:
+        ENCODERS.setdefault(kind, []).append(codec)
+    return codec
+
+
+def unregister_codec(oid):
+    codec = CODECS.pop(oid, None)
+    if codec is None:
+        return
+    for kind in codec.types:
+        ENCODERS[kind].remove(codec)
+        if not ENCODERS[kind]:
+            del ENCODERS[kind]
+
+
+class LazyCustom:
+    """
+    A custom value decoded on first access to `value`. `data` holds the
+    bytes received.
+    """
+
+    __slots__ = ("oid", "data", "_decode", "_value")
+
+    def __init__(self, oid, data, decode):
+        self.oid = oid
+        self.data = data
+        self._decode = decode
+        self._value = LazyCustom
+
+    @property
+    def value(self):
+        if self._value is LazyCustom:
+            self._value = self._decode(self.data)
+        return self._value
+
+
+def encoder_of(value):
+    for codec in ENCODERS.get(type(value), ()):
+        if codec.accepts is None or codec.accepts(value):
+            return codec
+    return None
+
+
+def decode_values(params):
+    """
+    Returns a copy of `params` with the custom values of registered OIDs
+    decoded.
+    """
+    decoded = dict(params)
+    for name, value in params.items():
+        # StaleValue inputs are tuples too, and decoded like the others into
+        # a StaleObject
+        if not isinstance(value, tuple) or value[0] != "custom":
+            continue
+        codec = CODECS.get(value[1]["type"])
+        if codec is None:
+            continue
+        data = value[1]["data"]
+        if codec.lazy:
+            decoded[name] = stale_like(value, LazyCustom(codec.oid, data, codec.decode))
+            continue
+        try:
+            decoded[name] = stale_like(value, codec.decode(data))
+        except (ValueError, TypeError, struct.error) as e:
+            raise ValueError(f"cannot decode {name} as {codec.oid}: {e}")
+    return decoded
+
+
+def encode_values(outputs):
+    """
+    Returns `outputs` with the objects registered codecs know encoded as
+    custom values.
+    """
+    encoded = None
+    for name, value in outputs.items():
+        if type(value) is tuple:
+            continue  # already (type_name, value)
+        if type(value) is LazyCustom:
+            data, oid = value.data, value.oid
+        else:
+            codec = encoder_of(value)
+            if codec is None:
+                continue
+            try:
+                data, oid = codec.encode(value), codec.oid
+            except (ValueError, TypeError, struct.error) as e:
+                raise ValueError(f"cannot encode {name} as {codec.oid}: {e}")
+        if encoded is None:
+            encoded = dict(outputs)
+        encoded[name] = ("custom", {"type": oid, "data": data})
+    return outputs if encoded is None else encoded
+
+
+def to_algorithm(params, arrays_api=False):
+    """
+    Returns the inputs of algo.run for the received `params`.
+    """
+    if arrays_api:
+        params = to_arrays(params)
+    return decode_values(params)
+
+
+def from_algorithm(outputs, arrays_api=False):
+    """
+    Returns the (type_name, value) outputs of what algo.run returned.
+    """
+    outputs = encode_values(outputs)
+    return from_arrays(outputs) if arrays_api else outputs
+
+
+# Vectors
+
+BIG_ENDIAN = sys.byteorder == "big"
+
+
+def register_vector(oid, typecode):
+    """
+    Registers a codec for array.array vectors of `typecode`.
+    """
+
+    def encode(vector):
+        if BIG_ENDIAN:
+            vector = array.array(typecode, vector)
+            vector.byteswap()
+        return vector.tobytes()
+
+    def decode(data):
+        vector = array.array(typecode)
+        vector.frombytes(data)
+        if BIG_ENDIAN:
+            vector.byteswap()
+        return vector
+
+    def accepts(vector):
+        return vector.typecode == typecode
+
+    return register_codec(oid, encode, decode, (array.array,), accepts=accepts)
+
+
+register_vector(FLOAT64_VECTOR_OID, "d")
+register_vector(INT64_VECTOR_OID, "q")
+
+
+# Records
+
+
+def register_record(oid, typename, fields, lazy=False):
+    """
+    Registers a codec for records of `fields`, [(name, struct format
+    character), ..], packed little-endian without padding. Returns the
+    namedtuple class the records are decoded to, and encoded from.
+    """
+    record = collections.namedtuple(typename, [name for name, _ in fields])
+    layout = struct.Struct("<" + "".join(code for _, code in fields))
+
+    def encode(value):
+        return layout.pack(*value)
+
+    def decode(data):
+        return record._make(layout.unpack(data))
+
+    register_codec(oid, encode, decode, (record,), lazy)
+    return record
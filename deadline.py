@@ -0,0 +1,93 @@
+import time
+
+# Per-cycle deadline (SMM3NG_CYCLE_DEADLINE): pulls and push statuses not
+# received in time are given up on, the connection to the late peer is
+# dropped (its reply would otherwise arrive in the middle of the next
+# exchange) and opened again at the next cycle. With the "stale" policy the
+# algorithm gets the last value received for the parameters of late peers,
+# as StaleValue; with "fail" the cycle is answered with a nack.
+
+STALE_POLICIES = ("stale", "fail")
+
+
+class StaleValue(tuple):
+    """
+    A (type_name, value) pair received in an earlier cycle because its peer
+    missed the deadline of this one.
+    """
+
+    stale = True
+
+
+class StaleObject:
+    """
+    An input decoded from a StaleValue, such as a numpy array or the object
+    of a custom value codec, which cannot carry the flag itself. The
+    decoded input is in `value`.
+    """
+
+    __slots__ = ("value",)
+    stale = True
+
+    def __init__(self, value):
+        self.value = value
+
+    def __repr__(self):
+        return f"StaleObject({self.value!r})"
+
+
+def stale_like(value, decoded):
+    """
+    Returns `decoded`, decoded from the input `value`, flagged as stale
+    when `value` was.
+    """
+    return StaleObject(decoded) if is_stale(value) else decoded
+
+
+def check_policy(policy):
+    if policy not in STALE_POLICIES:
+        raise ValueError(f"unknown stale policy {policy}")
+
+
+def is_stale(value):
+    return isinstance(value, (StaleValue, StaleObject))
+
+
+def cycle_deadline(seconds):
+    # Absolute time.monotonic() deadline, or None when there is no limit
+    if seconds <= 0:
+        return None
+    return time.monotonic() + seconds
+
+
+def remaining(deadline):
+    # Socket timeouts of 0 would switch to non-blocking mode instead
+    return max(deadline - time.monotonic(), 1e-6)
+
+
+class LastValues:
+    """
+    Last value pulled for every local parameter, to stand in for the values
+    of peers that missed the deadline.
+    """
+
+    def __init__(self):
+        self.values: dict = {}
+
+    def update(self, pulled):
+        for name, value in pulled.items():
+            if not is_stale(value):
+                self.values[name] = value
+
+    def stale_inputs(self, pull_groups, late):
+        inputs = {}
+        for remote_algo in late:
+            for local_names in pull_groups.get(remote_algo, {}).values():
+                for local_name in local_names:
+                    if local_name in self.values:
+                        inputs[local_name] = StaleValue(self.values[local_name])
+        return inputs
+
+
+def late_reason(late, seconds):
+    return f"{', '.join(sorted(late))} missed the {seconds}s cycle deadline"
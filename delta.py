@@ -0,0 +1,69 @@
+import math
+
+# Delta push (SMM3NG_DELTA_PUSH): the sender leaves out the variables whose
+# value has not changed since the peer last acknowledged it, and the
+# receiver keeps the last pushed value of every input so the algorithm still
+# sees a full input set. Both sides must run with the option, since a
+# receiver without the cache would lose the inputs that were left out.
+
+
+def same_value(old, new):
+    if old is None or old[0] != new[0] or old[1] != new[1]:
+        return False
+    if old[0] == "real":
+        # 0.0 == -0.0, but the sign must still reach the peer
+        return math.copysign(1.0, old[1]) == math.copysign(1.0, new[1])
+    return True
+
+
+class DeltaPush:
+    """
+    Sender side: the last value each peer acknowledged, per remote variable.
+    Every `refresh` cycles (0: never) everything is sent again, which bounds
+    how long a peer that lost its cache can miss a value.
+    """
+
+    def __init__(self, refresh=0):
+        self.refresh = refresh
+        self.cycle = 0
+        # remoteAlgoName -> {remoteParamName: value}
+        self.acked: dict = {}
+
+    def start_cycle(self):
+        self.cycle += 1
+        if self.refresh > 0 and self.cycle % self.refresh == 0:
+            self.forget_all()
+
+    def changed(self, remote_algo, variables):
+        acked = self.acked.get(remote_algo)
+        if not acked:
+            return variables
+        return [
+            var
+            for var in variables
+            if not same_value(acked.get(var["name"]), var["value"])
+        ]
+
+    def ack(self, remote_algo, variables):
+        acked = self.acked.setdefault(remote_algo, {})
+        for var in variables:
+            acked[var["name"]] = var["value"]
+
+    def forget(self, remote_algo):
+        self.acked.pop(remote_algo, None)
+
+    def forget_all(self):
+        self.acked.clear()
+
+
+class InputCache:
+    """
+    Receiver side: the last value pushed to every input.
+    """
+
+    def __init__(self):
+        self.values: dict = {}
+
+    def merge(self, pushed):
+        self.values.update(pushed)
+        return dict(self.values)
@@ -0,0 +1,374 @@
+import math
+
+# Hand-written DER for the PDUs exchanged on every cycle. The output is byte
+# for byte what asn1tools produces for SMM3NG-PDU (see tests/fastcodec_tests.py);
+# anything outside the fast path makes encode()/decode() return None and the
+# caller falls back to the generic codec.
+#
+# Tags follow the AUTOMATIC TAGS numbering of the SMM3NG-PDU and SMM3NG-Type
+# CHOICE alternatives in asn1/*.asn1.
+
+ACK = b"\x80\x00"
+SHIFT_VALUES = b"\x85\x00"
+DONE = b"\x8c\x00"
+
+NULL_PDUS = {"ack": ACK, "shiftValues": SHIFT_VALUES, "done": DONE}
+NULL_DECODED = {
+    ACK: ("ack", None),
+    SHIFT_VALUES: ("shiftValues", None),
+    DONE: ("done", None),
+}
+
+NEXT_CYCLE_TAG = 0xA6
+# SET OF SMM3NG-Variable alternatives
+VARIABLES_TAGS = {"pushValues": 0xA7, "pullValuesRep": 0xAA}
+VARIABLES_NAMES = {tag: name for name, tag in VARIABLES_TAGS.items()}
+
+SEQUENCE_TAG = 0x30
+NAME_TAG = 0x80
+VALUE_TAG = 0xA1
+INTEGER_TAG = 0x80
+BOOLEAN_TAG = 0x81
+REAL_TAG = 0x83
+# CustomType SEQUENCE { type OBJECT IDENTIFIER, data OCTET STRING }
+CUSTOM_TAG = 0xA5
+CUSTOM_TYPE_TAG = 0x80
+CUSTOM_DATA_TAG = 0x81
+
+BOOLEAN_TRUE = b"\x81\x01\xff"
+BOOLEAN_FALSE = b"\x81\x01\x00"
+
+REAL_SPECIAL = {b"\x40": math.inf, b"\x41": -math.inf, b"\x43": -0.0}
+
+
+def encode_length(length):
+    if length < 0x80:
+        return bytes((length,))
+    encoded = length.to_bytes((length.bit_length() + 7) // 8, "big")
+    return bytes((0x80 | len(encoded),)) + encoded
+
+
+def tlv(tag, content):
+    return bytes((tag,)) + encode_length(len(content)) + content
+
+
+def encode_integer(number):
+    return number.to_bytes(
+        (8 + (number + (number < 0)).bit_length()) // 8, "big", signed=True
+    )
+
+
+def encode_real(number):
+    # X.690 binary encoding, base 2, with the same mantissa/exponent
+    # normalisation as asn1tools
+    if number == math.inf:
+        return b"\x40"
+    if number == -math.inf:
+        return b"\x41"
+    if math.isnan(number):
+        return b"\x42"
+    if number == 0.0:
+        return b""
+    negative_bit = 0x40 if number < 0 else 0
+    mantissa, exponent = math.frexp(abs(number))
+    mantissa = int(mantissa * 2**53)
+    lowest_set_bit = (mantissa & -mantissa).bit_length() - 1
+    mantissa >>= lowest_set_bit
+    exponent = 52 - lowest_set_bit - exponent
+    if -129 < exponent < 128:
+        head = bytes((0x80 | negative_bit, (0xFF - exponent) & 0xFF))
+    elif -32769 < exponent < 32768:
+        exponent = (0xFFFF - exponent) & 0xFFFF
+        head = bytes((0x81 | negative_bit, exponent >> 8, exponent & 0xFF))
+    else:
+        return None
+    return head + mantissa.to_bytes(mantissa.bit_length() // 8 + 1, "big")
+
+
+_oid_cache: dict = {}
+_oid_names: dict = {}
+
+
+def encode_oid(oid):
+    encoded = _oid_cache.get(oid)
+    if encoded is not None:
+        return encoded
+    parts = oid.split(".")
+    if not all(part.isascii() and part.isdigit() for part in parts):
+        return None
+    arcs = [int(part) for part in parts]
+    if len(arcs) < 2 or arcs[0] > 2 or (arcs[0] < 2 and arcs[1] >= 40):
+        return None
+    content = bytearray()
+    for arc in [40 * arcs[0] + arcs[1]] + arcs[2:]:
+        chunk = [arc & 0x7F]
+        arc >>= 7
+        while arc:
+            chunk.append(0x80 | (arc & 0x7F))
+            arc >>= 7
+        content += bytes(reversed(chunk))
+    encoded = tlv(CUSTOM_TYPE_TAG, bytes(content))
+    if len(_oid_cache) < 1024:
+        _oid_cache[oid] = encoded
+    return encoded
+
+
+def decode_oid(content):
+    oid = _oid_names.get(content)
+    if oid is not None:
+        return oid
+    arcs = []
+    arc = 0
+    for byte in content:
+        arc = (arc << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            arcs.append(arc)
+            arc = 0
+    if not arcs or content[-1] & 0x80 or content[0] == 0x80:
+        return None
+    first = min(arcs[0] // 40, 2)
+    oid = ".".join(map(str, [first, arcs[0] - 40 * first] + arcs[1:]))
+    if len(_oid_names) < 1024:
+        _oid_names[content] = oid
+    return oid
+
+
+def encode_custom(custom):
+    # Returns the value header and the payload separately, so a large payload
+    # is copied once, into the final frame
+    if type(custom) is not dict or len(custom) != 2:
+        return None
+    oid, data = custom.get("type"), custom.get("data")
+    if type(oid) is not str or type(data) is not bytes:
+        return None
+    encoded_oid = encode_oid(oid)
+    if encoded_oid is None:
+        return None
+    data_header = bytes((CUSTOM_DATA_TAG,)) + encode_length(len(data))
+    content_length = len(encoded_oid) + len(data_header) + len(data)
+    header = bytes((CUSTOM_TAG,)) + encode_length(content_length)
+    return header + encoded_oid + data_header, data
+
+
+def encode_value(value):
+    type_name, data = value
+    kind = type(data)
+    if type_name == "integer" and kind is int:
+        return tlv(INTEGER_TAG, encode_integer(data))
+    if type_name == "boolean" and kind is bool:
+        return BOOLEAN_TRUE if data else BOOLEAN_FALSE
+    if type_name == "real" and kind is float:
+        content = encode_real(data)
+        if content is not None:
+            return tlv(REAL_TAG, content)
+    return None
+
+
+_name_cache: dict = {}
+
+
+def encode_name(name):
+    # Variable names repeat every cycle, so their encoding is kept
+    if type(name) is not str:
+        return None
+    encoded = _name_cache.get(name)
+    if encoded is not None:
+        return encoded
+    if not name.isascii():
+        return None
+    encoded = tlv(NAME_TAG, name.encode("ascii"))
+    if len(_name_cache) < 4096:
+        _name_cache[name] = encoded
+    return encoded
+
+
+def encode_variables(variables):
+    # Returns the list of byte strings making up the content
+    parts = []
+    for var in variables:
+        encoded_name = encode_name(var["name"])
+        if encoded_name is None:
+            return None
+        value = var["value"]
+        if value[0] == "custom":
+            custom = encode_custom(value[1])
+            if custom is None:
+                return None
+            value_header, payload = custom
+            value_length = len(value_header) + len(payload)
+        else:
+            value_header = encode_value(value)
+            if value_header is None:
+                return None
+            payload = None
+            value_length = len(value_header)
+        value_tag = bytes((VALUE_TAG,)) + encode_length(value_length)
+        parts.append(
+            bytes((SEQUENCE_TAG,))
+            + encode_length(len(encoded_name) + len(value_tag) + value_length)
+            + encoded_name
+            + value_tag
+            + value_header
+        )
+        if payload is not None:
+            parts.append(payload)
+    return parts
+
+
+def encode(pdu):
+    choice, data = pdu
+    if choice in NULL_PDUS:
+        return NULL_PDUS[choice] if data is None else None
+    if choice == "nextCycle":
+        timestamp = data.get("timestamp") if type(data) is dict else None
+        if type(timestamp) is not int or len(data) != 1:
+            return None
+        return tlv(NEXT_CYCLE_TAG, tlv(INTEGER_TAG, encode_integer(timestamp)))
+    if choice in VARIABLES_TAGS and type(data) is list:
+        parts = encode_variables(data)
+        if parts is None:
+            return None
+        length = sum(len(part) for part in parts)
+        header = bytes((VARIABLES_TAGS[choice],)) + encode_length(length)
+        return b"".join([header] + parts)
+    return None
+
+
+def decode_length(data, offset, end):
+    # Returns (length, offset of the content), or None when malformed
+    if offset >= end:
+        return None
+    first = data[offset]
+    offset += 1
+    if first < 0x80:
+        return first, offset
+    size = first & 0x7F
+    if size == 0 or size > 4 or offset + size > end:
+        return None
+    return int.from_bytes(data[offset : offset + size], "big"), offset + size
+
+
+def decode_tlv(data, offset, end, tag):
+    # Returns (content start, content end) of the expected tag, or None
+    if offset >= end or data[offset] != tag:
+        return None
+    decoded = decode_length(data, offset + 1, end)
+    if decoded is None:
+        return None
+    length, start = decoded
+    if start + length > end:
+        return None
+    return start, start + length
+
+
+def decode_real(content):
+    if not content:
+        return 0.0
+    control = content[0]
+    if control & 0x80:
+        if control in (0x80, 0xC0) and len(content) > 2:
+            exponent = content[1] - 0x100 if content[1] & 0x80 else content[1]
+            offset = 2
+        elif control in (0x81, 0xC1) and len(content) > 3:
+            exponent = (content[1] << 8) | content[2]
+            if exponent & 0x8000:
+                exponent -= 0x10000
+            offset = 3
+        else:
+            return None
+        decoded = float(int.from_bytes(content[offset:], "big") * 2**exponent)
+        return -decoded if control & 0x40 else decoded
+    if len(content) == 1 and content in REAL_SPECIAL:
+        return REAL_SPECIAL[content]
+    return None
+
+
+def decode_value(data, start, end):
+    if end - start < 2:
+        return None
+    tag = data[start]
+    content = decode_tlv(data, start, end, tag)
+    if content is None or content[1] != end:
+        return None
+    content_start, content_end = content
+    if tag == INTEGER_TAG and content_end > content_start:
+        return (
+            "integer",
+            int.from_bytes(data[content_start:content_end], "big", signed=True),
+        )
+    if tag == BOOLEAN_TAG and content_end - content_start == 1:
+        flag = data[content_start]
+        if flag in (0x00, 0xFF):
+            return ("boolean", flag == 0xFF)
+        return None
+    if tag == REAL_TAG:
+        real = decode_real(bytes(data[content_start:content_end]))
+        if real is not None:
+            return ("real", real)
+    if tag == CUSTOM_TAG:
+        oid = decode_tlv(data, content_start, content_end, CUSTOM_TYPE_TAG)
+        if oid is None or oid[0] == oid[1]:
+            return None
+        payload = decode_tlv(data, oid[1], content_end, CUSTOM_DATA_TAG)
+        if payload is None or payload[1] != content_end:
+            return None
+        oid_name = decode_oid(bytes(data[oid[0] : oid[1]]))
+        if oid_name is None:
+            return None
+        return (
+            "custom",
+            {"type": oid_name, "data": bytes(data[payload[0] : payload[1]])},
+        )
+    return None
+
+
+def decode_variables(data, offset, end):
+    variables = []
+    while offset < end:
+        sequence = decode_tlv(data, offset, end, SEQUENCE_TAG)
+        if sequence is None:
+            return None
+        seq_start, seq_end = sequence
+        name = decode_tlv(data, seq_start, seq_end, NAME_TAG)
+        if name is None:
+            return None
+        value = decode_tlv(data, name[1], seq_end, VALUE_TAG)
+        if value is None or value[1] != seq_end:
+            return None
+        decoded = decode_value(data, value[0], value[1])
+        if decoded is None:
+            return None
+        try:
+            name_str = bytes(data[name[0] : name[1]]).decode("ascii")
+        except UnicodeDecodeError:
+            return None
+        variables.append({"name": name_str, "value": decoded})
+        offset = seq_end
+    return variables
+
+
+def decode(data):
+    size = len(data)
+    if size == 2 and bytes(data) in NULL_DECODED:
+        return NULL_DECODED[bytes(data)]
+    if size < 2:
+        return None
+    tag = data[0]
+    outer = decode_tlv(data, 0, size, tag)
+    if outer is None or outer[1] != size:
+        return None
+    start, end = outer
+    if tag == NEXT_CYCLE_TAG:
+        timestamp = decode_tlv(data, start, end, INTEGER_TAG)
+        if timestamp is None or timestamp[1] != end or timestamp[0] == end:
+            return None
+        return (
+            "nextCycle",
+            {"timestamp": int.from_bytes(data[timestamp[0] : end], "big", signed=True)},
+        )
+    if tag in VARIABLES_NAMES:
+        variables = decode_variables(data, start, end)
+        if variables is None:
+            return None
+        return (VARIABLES_NAMES[tag], variables)
+    return None
@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
 import sys
 import os
-from agent import start_agent
+from config import AgentConfig
+from zygote import launch, run_command, serve
+
+# Agent modules are imported only once it is clear that no zygote will start
+# the agent, since importing them compiles the ASN.1 schema.
 
 
 def usage():
@@ -10,6 +14,26 @@ def usage():
     print(
         "\tstart algoname instancename url  - start named module and connect to core url"
     )
+    print(
+        "\tstart-async algoname instancename url  - same as start, on the asyncio runtime"
+    )
+    print(
+        "\thost url algoname:instancename [...]  - run several instances in one process"
+    )
+    print(
+        "\tzygote [module ...]  - keep a pre-warmed process that forks agents for the commands above"
+    )
+
+
+def daemonize():
+    # Returns False in the processes that should exit
+    if os.fork() > 0:
+        return False  # Parent process exits
+
+    os.setsid()  # Create new session
+    if os.fork() > 0:
+        return False  # First child exits
+    return True
 
 
 def main():
@@ -19,21 +43,45 @@ def main():
 
     command = sys.argv[1]
 
-    if command == "start":
-        if len(sys.argv) < 5:
+    if command in ("start", "start-async", "host"):
+        if len(sys.argv) < (4 if command == "host" else 5):
             usage()
             return 1
+        # Validate the environment before detaching so errors stay visible
+        try:
+            config = AgentConfig.from_env()
+        except ValueError as e:
+            print(e)
+            return 1
 
-        # Run in the background (daemon mode)
-        if os.fork() > 0:
-            return 0  # Parent process exits
+        # A running zygote forks an agent that has everything imported already
+        try:
+            if launch(command, sys.argv[2:]) is not None:
+                return 0
+        except (OSError, RuntimeError) as e:
+            print(e)
+            return 1
 
-        os.setsid()  # Create new session
-        if os.fork() > 0:
-            return 0  # First child exits
+        if command == "host":
+            from async_agent import parse_instances
+
+            try:
+                parse_instances(sys.argv[3:])
+            except ValueError as e:
+                print(e)
+                return 1
+
+        # Run in the background (daemon mode)
+        if not daemonize():
+            return 0
 
         # Start the agent
-        start_agent(sys.argv[2], sys.argv[3], sys.argv[4])
+        run_command(command, sys.argv[2:], config)
+
+    elif command == "zygote":
+        if not daemonize():
+            return 0
+        serve(modules=sys.argv[2:])
 
     else:
         usage()
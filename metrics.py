@@ -0,0 +1,297 @@
+import bisect
+import os
+import socket
+import threading
+import weakref
+
+import protocol
+
+# Cycle phase timings and per-peer traffic counters, exported in the
+# Prometheus text format either to a textfile (for node_exporter's textfile
+# collector) or on a local Unix socket ("unix:/path").
+
+# Upper bounds in seconds, from 50us to 10s
+DEFAULT_BUCKETS = (
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    10.0,
+)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram: observe() is a bisect and two additions.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        # One extra slot for values above the last bound (+Inf)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(
+                f"{name}_bucket{format_labels(labels + (('le', repr(bound)),))} {cumulative}"
+            )
+        cumulative += self.counts[-1]
+        lines.append(
+            f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {cumulative}"
+        )
+        lines.append(f"{name}_sum{format_labels(labels)} {self.sum!r}")
+        lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+        return lines
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        # The control loop and the data responder count from their own
+        # threads, and += is not atomic
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def render(self, name, labels):
+        return [f"{name}{format_labels(labels)} {self.value}"]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        # name -> (type, help, {labels: metric})
+        self.families = {}
+        self.lock = threading.Lock()
+
+    def _get(self, kind, factory, name, help_text, labels):
+        labels = tuple(sorted(labels.items()))
+        family = self.families.get(name)
+        if family is None:
+            with self.lock:
+                family = self.families.setdefault(name, (kind, help_text, {}))
+        metrics = family[2]
+        metric = metrics.get(labels)
+        if metric is None:
+            with self.lock:
+                metric = metrics.setdefault(labels, factory())
+        return metric
+
+    def histogram(self, name, help_text, **labels):
+        return self._get("histogram", Histogram, name, help_text, labels)
+
+    def counter(self, name, help_text, **labels):
+        return self._get("counter", Counter, name, help_text, labels)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            families = [
+                (name, kind, help_text, list(metrics.items()))
+                for name, (kind, help_text, metrics) in self.families.items()
+            ]
+        for name, kind, help_text, metrics in families:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, metric in metrics:
+                lines.extend(metric.render(name, labels))
+        return "\n".join(lines) + "\n"
+
+
+class AgentMetrics:
+    """
+    Metrics of one agent: cycle phase durations, per-peer phase durations and
+    per-peer PDU / byte counters fed by the protocol PDU observers.
+    """
+
+    def __init__(self, algoName, registry=None):
+        self.algoName = algoName
+        self.registry = registry if registry is not None else MetricsRegistry()
+        # socket -> peer label used by the PDU counters
+        self.peer_labels = weakref.WeakKeyDictionary()
+        self.phases = {}
+        self.peer_phases = {}
+        self.pdu_counters = {}
+        self.cycles = self.registry.counter(
+            "smm3ng_cycles_total", "Completed cycles", agent=algoName
+        )
+
+    def label_socket(self, sock, peer):
+        self.peer_labels[sock] = peer
+
+    def phase(self, phase, seconds):
+        histogram = self.phases.get(phase)
+        if histogram is None:
+            histogram = self.phases[phase] = self.registry.histogram(
+                "smm3ng_phase_seconds",
+                "Duration of the agent's cycle phases",
+                agent=self.algoName,
+                phase=phase,
+            )
+        histogram.observe(seconds)
+
+    def peer_phase(self, phase, peer, seconds):
+        histogram = self.peer_phases.get((phase, peer))
+        if histogram is None:
+            histogram = self.peer_phases[(phase, peer)] = self.registry.histogram(
+                "smm3ng_peer_phase_seconds",
+                "Time until a peer answered in a pull or push phase",
+                agent=self.algoName,
+                phase=phase,
+                peer=peer,
+            )
+        histogram.observe(seconds)
+
+    def observe_pdu(self, direction, sock, choice, size):
+        peer = self.peer_labels.get(sock, "inbound")
+        key = (peer, direction, choice)
+        counters = self.pdu_counters.get(key)
+        if counters is None:
+            counters = self.pdu_counters[key] = (
+                self.registry.counter(
+                    "smm3ng_pdus_total",
+                    "PDUs exchanged",
+                    agent=self.algoName,
+                    peer=peer,
+                    direction=direction,
+                    pdu=choice,
+                ),
+                self.registry.counter(
+                    "smm3ng_bytes_total",
+                    "Frame bytes exchanged, headers included",
+                    agent=self.algoName,
+                    peer=peer,
+                    direction=direction,
+                ),
+            )
+        counters[0].inc()
+        counters[1].inc(size)
+
+    def install(self):
+        protocol.addPDUObserver(self.observe_pdu)
+
+    def uninstall(self):
+        protocol.removePDUObserver(self.observe_pdu)
+
+
+def write_textfile(registry, path):
+    # Write then rename so the collector never reads a half-written file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(registry.render())
+    os.replace(tmp_path, path)
+
+
+class MetricsExporter:
+    """
+    Periodically writes the registry to a textfile, or serves it to every
+    client connecting to a Unix socket when `target` is "unix:/path".
+    Runs in one background thread.
+    """
+
+    def __init__(self, registry, target, interval=5.0):
+        self.registry = registry
+        self.target = target
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+        self.server = None
+
+    def start(self):
+        if self.target.startswith("unix:"):
+            path = self.target[len("unix:") :]
+            if os.path.exists(path):
+                os.unlink(path)
+            self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.server.bind(path)
+            self.server.listen(5)
+            self.server.settimeout(0.2)
+            target = self.serve
+        else:
+            target = self.write_periodically
+        self.thread = threading.Thread(target=target, name="metrics", daemon=True)
+        self.thread.start()
+
+    def write_periodically(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def write(self):
+        try:
+            write_textfile(self.registry, self.target)
+        except OSError as e:
+            print(f"metrics: cannot write {self.target}: {e}")
+
+    def serve(self):
+        while not self.stopped.is_set():
+            try:
+                client, _ = self.server.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            with client:
+                try:
+                    client.sendall(self.registry.render().encode())
+                except OSError:
+                    pass
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.server is not None:
+            path = self.server.getsockname()
+            self.server.close()
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        else:
+            # Final snapshot with the last cycles
+            self.write()
+
+
+def create_agent_metrics(algoName, config):
+    """
+    Returns (AgentMetrics, MetricsExporter), or (None, None) when no
+    metrics_path is configured.
+    """
+    if not config.metrics_path:
+        return None, None
+    metrics = AgentMetrics(algoName)
+    # Agents started from the same environment share metrics_path; "{agent}"
+    # gives each of them its own file or socket
+    target = config.metrics_path.replace("{agent}", algoName)
+    exporter = MetricsExporter(metrics.registry, target, config.metrics_interval)
+    return metrics, exporter
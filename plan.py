@@ -0,0 +1,112 @@
+from protocol import encodeFrame
+
+# The connections of an agent never change after setConn, so everything the
+# pull and push phases derive from them is worked out once: the peers to
+# ask, the pullValuesReq frames (sent byte for byte every cycle), and where
+# every pushed value comes from. A cycle is then left with the I/O and the
+# encoding of the values themselves.
+
+
+def group_pull_connections(pull_conns):
+    """
+    Group pull connections by peer so that every peer gets a single
+    pullValuesReq per cycle:
+    {remoteAlgoName: {remoteParamName: [localParamName, ..]}}
+    """
+    groups: dict[str, dict[str, list[str]]] = {}
+    for conn in pull_conns:
+        names = groups.setdefault(conn["remoteAlgoName"], {})
+        names.setdefault(conn["remoteParamName"], []).append(conn["localParamName"])
+    return groups
+
+
+def match_pull_reply(names, variables):
+    """
+    Map the variables of a pullValuesRep back to local parameter names.
+    `names` is the {remoteParamName: [localParamName, ..]} group the
+    request was built from.
+    """
+    values = {}
+    requested = list(names)
+    for i, var in enumerate(variables):
+        # Responders that rename variables are matched by request order
+        if var["name"] in names:
+            remote_name = var["name"]
+        elif i < len(requested):
+            remote_name = requested[i]
+        else:
+            continue
+        for local_name in names[remote_name]:
+            values[local_name] = var["value"]
+    return values
+
+
+def group_push_connections(push_conns):
+    """
+    Group push connections by peer so that every peer gets a single
+    pushValues per cycle:
+    {remoteAlgoName: [(localParamName, remoteParamName), ..]}
+    """
+    groups: dict[str, list[tuple[str, str]]] = {}
+    for conn in push_conns:
+        groups.setdefault(conn["remoteAlgoName"], []).append(
+            (conn["localParamName"], conn["remoteParamName"])
+        )
+    return groups
+
+
+class CyclePlan:
+    """
+    The pull and push work of a cycle, compiled from the setConn data.
+
+    pull_requests: {remoteAlgoName: (names, frame)}, `names` being the
+        pull group of the peer and `frame` its encoded pullValuesReq
+    output_names: the local outputs pushed to any peer
+    push_bindings: {remoteAlgoName: [(index in output_names,
+        remoteParamName), ..]}
+    """
+
+    def __init__(self, conns):
+        self.pull_groups = group_pull_connections(conns["pull"])
+        self.push_groups = group_push_connections(conns["push"])
+        self.pull_requests = {
+            remote_algo: (names, encodeFrame(("pullValuesReq", list(names))))
+            for remote_algo, names in self.pull_groups.items()
+        }
+        # (remoteAlgoName, codec) -> pullValuesReq frame for peer connections
+        # that negotiated a codec other than DER
+        self.codec_frames: dict = {}
+        self.output_names: list[str] = []
+        indices: dict[str, int] = {}
+        self.push_bindings: dict[str, list[tuple[int, str]]] = {}
+        for remote_algo, bindings in self.push_groups.items():
+            resolved = self.push_bindings[remote_algo] = []
+            for local_name, remote_name in bindings:
+                if local_name not in indices:
+                    indices[local_name] = len(self.output_names)
+                    self.output_names.append(local_name)
+                resolved.append((indices[local_name], remote_name))
+
+    def pull_frame(self, remote_algo, codec="der"):
+        names, frame = self.pull_requests[remote_algo]
+        if codec == "der":
+            return frame
+        frame = self.codec_frames.get((remote_algo, codec))
+        if frame is None:
+            frame = self.codec_frames[remote_algo, codec] = encodeFrame(
+                ("pullValuesReq", list(names)), codec
+            )
+        return frame
+
+    def push_variables(self, output_params):
+        """
+        Yields (remoteAlgoName, variables) with the pushValues variables of
+        every push peer; outputs the algorithm did not return are left out.
+        """
+        values = [output_params.get(name) for name in self.output_names]
+        for remote_algo, bindings in self.push_bindings.items():
+            yield remote_algo, [
+                {"name": remote_name, "value": values[index]}
+                for index, remote_name in bindings
+                if values[index] is not None
+            ]
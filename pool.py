@@ -0,0 +1,180 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Connections to peers are keyed by their (address, port) endpoint rather
+# than by remoteAlgoName, so algorithms served from one endpoint share a
+# socket. Requests on a shared socket are answered in the order they were
+# sent, which is the order pull_values and push_values read the replies in;
+# a connection on which one reply timed out is dropped for that reason.
+
+MAX_CONNECT_WORKERS = 32
+
+
+class ConnectionPool:
+    """
+    Peer connections, usable as the remoteAlgoName -> socket mapping that
+    pull_values and push_values take. Indexing a peer whose connection was
+    dropped connects it again; get() only returns live connections.
+
+    `connect(address, port[, timeout])` returns a connected socket or None,
+    and is tried `retries` more times after a failure, waiting `backoff`
+    seconds and twice as long after every further failure.
+    """
+
+    def __init__(self, connect, retries=3, backoff=0.05, timeout=None):
+        self.connect_fn = connect
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        # remoteAlgoName -> (address, port)
+        self.endpoints: dict = {}
+        # (address, port) -> socket
+        self.sockets: dict = {}
+        # Metrics and tracer labelling every connection
+        self.observers: list = []
+        # (address, port) -> Future of a connection opened in the background
+        self.pending: dict = {}
+        self.executor = None
+
+    def add(self, remote_algo, address, port):
+        self.endpoints.setdefault(remote_algo, (address, port))
+
+    def names(self, endpoint):
+        return sorted(name for name, ep in self.endpoints.items() if ep == endpoint)
+
+    def open(self, endpoint, retries, timeout):
+        address, port = endpoint
+        for attempt in range(retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            if timeout is None:
+                sock = self.connect_fn(address, port)
+            else:
+                sock = self.connect_fn(address, port, timeout)
+            if sock is not None:
+                return sock
+        return None
+
+    def label(self, observer, endpoint, sock):
+        observer.label_socket(sock, ",".join(self.names(endpoint)))
+
+    def add_observer(self, observer):
+        for endpoint, sock in self.sockets.items():
+            self.label(observer, endpoint, sock)
+        self.observers.append(observer)
+
+    def adopt(self, endpoint, sock):
+        self.sockets[endpoint] = sock
+        for observer in self.observers:
+            self.label(observer, endpoint, sock)
+
+    def connect(self, retries=None, timeout=None):
+        """
+        Connects every endpoint without a connection, all at once. Returns
+        the endpoints that could still not be reached.
+        """
+        if retries is None:
+            retries = self.retries
+        if timeout is None:
+            timeout = self.timeout
+        missing = sorted(set(self.endpoints.values()) - set(self.sockets))
+        if len(missing) <= 1:
+            socks = [self.open(endpoint, retries, timeout) for endpoint in missing]
+        else:
+            workers = min(len(missing), MAX_CONNECT_WORKERS)
+            with ThreadPoolExecutor(workers) as executor:
+                socks = list(
+                    executor.map(
+                        lambda endpoint: self.open(endpoint, retries, timeout),
+                        missing,
+                    )
+                )
+        unreachable = []
+        for endpoint, sock in zip(missing, socks):
+            if sock is None:
+                unreachable.append(endpoint)
+            else:
+                self.adopt(endpoint, sock)
+        return unreachable
+
+    def connect_in_background(self, timeout):
+        """
+        Adopts the connections opened in the background since the last call
+        and starts opening the missing ones, trying each once within
+        `timeout` seconds. Peers being connected are left out of the pool
+        meanwhile, so an unreachable peer does not hold up the caller.
+        """
+        for endpoint, future in list(self.pending.items()):
+            if not future.done():
+                continue
+            del self.pending[endpoint]
+            sock = future.result()
+            if sock is None:
+                continue
+            if endpoint in self.sockets:
+                sock.close()
+            else:
+                self.adopt(endpoint, sock)
+        missing = set(self.endpoints.values()) - set(self.sockets) - set(self.pending)
+        if missing and self.executor is None:
+            self.executor = ThreadPoolExecutor(
+                MAX_CONNECT_WORKERS, thread_name_prefix="reconnect"
+            )
+        for endpoint in sorted(missing):
+            self.pending[endpoint] = self.executor.submit(
+                self.open, endpoint, 0, timeout
+            )
+
+    def __getitem__(self, remote_algo):
+        endpoint = self.endpoints[remote_algo]
+        sock = self.sockets.get(endpoint)
+        if sock is None:
+            sock = self.open(endpoint, self.retries, self.timeout)
+            if sock is None:
+                raise RuntimeError(
+                    f"cannot connect to {remote_algo} at {endpoint[0]}:{endpoint[1]}"
+                )
+            self.adopt(endpoint, sock)
+        return sock
+
+    def get(self, remote_algo, default=None):
+        endpoint = self.endpoints.get(remote_algo)
+        return self.sockets.get(endpoint, default)
+
+    def __contains__(self, remote_algo):
+        return self.get(remote_algo) is not None
+
+    def items(self):
+        for remote_algo, endpoint in self.endpoints.items():
+            sock = self.sockets.get(endpoint)
+            if sock is not None:
+                yield remote_algo, sock
+
+    def pop(self, remote_algo, default=None):
+        """
+        Closes the connection of `remote_algo`, and with it the one of every
+        algorithm sharing its endpoint.
+        """
+        sock = self.sockets.pop(self.endpoints.get(remote_algo), None)
+        if sock is None:
+            return default
+        sock.close()
+        return sock
+
+    def reset(self):
+        # Every connection is opened again on its next use
+        for sock in self.sockets.values():
+            sock.close()
+        self.sockets.clear()
+
+    def close(self):
+        self.reset()
+        if self.executor is not None:
+            # Background connections give up within their timeout
+            self.executor.shutdown()
+            self.executor = None
+        for future in self.pending.values():
+            sock = future.result()
+            if sock is not None:
+                sock.close()
+        self.pending.clear()
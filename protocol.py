@@ -1,68 +1,333 @@
+import asyncio
+import hashlib
 import socket
 import struct
 import os
+import pickle
+import sys
+import weakref
+from typing import Any
+
 import asn1tools  # type: ignore
 
+import fastcodec
+
 current_dir = os.path.dirname(os.path.abspath(__file__))
 asn1_file_paths = [
     os.path.join(current_dir, "asn1", "types.asn1"),
     os.path.join(current_dir, "asn1", "protocol.asn1"),
 ]
 
-asn1_compiler = asn1tools.compile_files(
-    asn1_file_paths,
-    codec="der",
-)
 
+def specificationCacheDir():
+    cache_dir = os.environ.get("SMM3NG_CACHE_DIR")
+    if cache_dir:
+        return cache_dir
+    xdg_cache = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(xdg_cache, "smm3ng")
 
-def sendPDU(sock, pdu):
+
+def specificationCachePath(codec):
+    # Any change to the schema, the asn1tools version or the interpreter
+    # (pickle format) gives a new file name, so stale entries are never read
+    digest = hashlib.sha256()
+    for path in asn1_file_paths:
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    digest.update(asn1tools.__version__.encode())
+    digest.update(sys.version.encode())
+    digest.update(codec.encode())
+    return os.path.join(
+        specificationCacheDir(), f"spec-{codec}-{digest.hexdigest()[:32]}.pickle"
+    )
+
+
+def compileSpecification(codec):
+    """
+    Compile the SMM-3NG schema, reusing the pickled result of an earlier
+    start when the schema has not changed. Parsing the .asn1 files is by
+    far the most expensive part of importing this module.
+    """
+    try:
+        cache_path = specificationCachePath(codec)
+    except OSError:
+        cache_path = None
+    if cache_path is not None:
+        try:
+            with open(cache_path, "rb") as f:
+                return pickle.load(f)
+        except Exception:
+            pass  # missing or unreadable cache: compile below
+
+    specification = asn1tools.compile_files(asn1_file_paths, codec=codec)
+
+    if cache_path is not None:
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            # Write under a temporary name so agents starting concurrently
+            # never read a partially written file
+            with open(tmp_path, "wb") as f:
+                pickle.dump(specification, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, cache_path)
+        except Exception:
+            # Caching is best effort
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+    return specification
+
+
+asn1_compiler = compileSpecification("der")
+
+# Codecs a peer data connection may switch to, see negotiateCodec(). The
+# connection to the core, shared memory segments and compressed values are
+# always DER, and only DER has the fastcodec fast path.
+WIRE_CODECS = ("der", "ber", "per", "uper", "oer")
+# codec -> compiled specification, compiled on first use
+specifications = {"der": asn1_compiler}
+# Connections (sockets, asyncio readers and writers) that negotiated a codec
+# other than DER
+socket_codecs: "weakref.WeakKeyDictionary[Any, str]" = weakref.WeakKeyDictionary()
+
+
+def specification(codec):
+    compiled = specifications.get(codec)
+    if compiled is None:
+        if codec not in WIRE_CODECS:
+            raise ValueError(f"unknown wire codec {codec}")
+        compiled = specifications[codec] = compileSpecification(codec)
+    return compiled
+
+
+def parseCodecs(codecs):
+    """
+    Parses a comma-separated list of wire codecs, preferred first.
+    """
+    parsed = [codec.strip() for codec in codecs.split(",") if codec.strip()]
+    for codec in parsed:
+        if codec not in WIRE_CODECS:
+            raise ValueError(f"unknown wire codec {codec}")
+    return parsed or ["der"]
+
+
+def setCodec(conn, codec):
+    if codec == "der":
+        socket_codecs.pop(conn, None)
+    else:
+        socket_codecs[conn] = codec
+
+
+def codecOf(conn):
+    if not socket_codecs:
+        return "der"
+    return socket_codecs.get(conn, "der")
+
+
+# Frames announcing a larger length are rejected before anything is allocated
+DEFAULT_MAX_FRAME_SIZE = 256 * 1024 * 1024
+max_frame_size = DEFAULT_MAX_FRAME_SIZE
+
+INITIAL_RECV_BUFFER_SIZE = 64 * 1024
+# Per-socket receive buffers, dropped together with their socket
+recv_buffers: "weakref.WeakKeyDictionary[Any, bytearray]" = weakref.WeakKeyDictionary()
+
+
+# Callables observer(direction, sock, choice, size) told about every frame
+# sent ("out") or received ("in"); used by the metrics and tracing
+pdu_observers: list = []
+
+
+def addPDUObserver(observer):
+    pdu_observers.append(observer)
+
+
+def removePDUObserver(observer):
+    if observer in pdu_observers:
+        pdu_observers.remove(observer)
+
+
+def notifyPDU(direction, sock, choice, size):
+    for observer in pdu_observers:
+        observer(direction, sock, choice, size)
+
+
+def encodePDU(pdu, codec="der"):
     try:
-        encoded_pdu = asn1_compiler.encode("SMM3NG-PDU", pdu)
+        if codec != "der":
+            return specification(codec).encode("SMM3NG-PDU", pdu)
+        encoded_pdu = fastcodec.encode(pdu)
+        if encoded_pdu is not None:
+            return encoded_pdu
+        return asn1_compiler.encode("SMM3NG-PDU", pdu)
     except Exception as e:
         raise RuntimeError(f"PDU encoding failed: {e}")
+
+
+def decodePDU(pdu_data, codec="der"):
+    try:
+        if codec != "der":
+            return specification(codec).decode("SMM3NG-PDU", bytes(pdu_data))
+        decoded_pdu = fastcodec.decode(pdu_data)
+        if decoded_pdu is not None:
+            return decoded_pdu
+        return asn1_compiler.decode("SMM3NG-PDU", pdu_data)
+    except Exception as e:
+        raise RuntimeError(f"PDU decoding failed: {e}")
+
+
+def encodeFrame(pdu, codec="der"):
+    encoded_pdu = encodePDU(pdu, codec)
+    return struct.pack("<I", len(encoded_pdu)) + encoded_pdu
+
+
+def sendFrame(sock, header, payload):
+    # Header and payload leave in a single scatter/gather sendmsg call, so a
+    # small header is never held back by Nagle waiting for a delayed ACK.
+    # sendmsg may write only part of the frame; the rest is sent from where
+    # it stopped.
+    if not hasattr(sock, "sendmsg"):
+        sock.sendall(header + payload)
+        return
+    total = len(header) + len(payload)
+    sent = sock.sendmsg([header, payload])
+    if sent == total:
+        return
+    with memoryview(header) as header_view, memoryview(payload) as payload_view:
+        while sent < total:
+            if sent < len(header):
+                buffers = [header_view[sent:], payload_view]
+            else:
+                buffers = [payload_view[sent - len(header) :]]
+            sent += sock.sendmsg(buffers)
+
+
+def sendPDU(sock, pdu):
+    encoded_pdu = encodePDU(pdu, codecOf(sock))
     pdu_length = len(encoded_pdu)
-    # Unlike send(), this method continues to send data from bytes until either
-    # all data has been sent or an error occurs.
-    # None is returned on success.
     # The first character of the format string can be used to indicate the
     # byte order, size and alignment of the packed data
-    # (network (= big-endian) standard size no alignment)
+    # ("<" = little-endian standard size no alignment)
     try:
-        sock.send(struct.pack("<I", pdu_length))
-        sock.send(encoded_pdu)
+        sendFrame(sock, struct.pack("<I", pdu_length), encoded_pdu)
     except (struct.error, socket.error) as e:
         raise RuntimeError(f"Failed to send PDU: {e}")
     except Exception as e:
         raise RuntimeError(f"Unexpected error while sending PDU: {e}")
+    if pdu_observers:
+        notifyPDU("out", sock, pdu[0], 4 + pdu_length)
+
+
+def sendEncodedPDU(sock, choice, frame):
+    # Sends a frame built by encodeFrame(), so that a PDU which never
+    # changes is encoded once and the same bytes are sent every time
+    try:
+        sock.sendall(frame)
+    except socket.error as e:
+        raise RuntimeError(f"Failed to send PDU: {e}")
+    if pdu_observers:
+        notifyPDU("out", sock, choice, len(frame))
+
+
+def setMaxFrameSize(size):
+    global max_frame_size
+    max_frame_size = size
+
+
+def checkFrameSize(pdu_length):
+    if pdu_length > max_frame_size:
+        raise RuntimeError(
+            f"PDU of {pdu_length} bytes exceeds the {max_frame_size} bytes frame limit"
+        )
+
+
+def recvInto(sock, view):
+    # Keep reading until the whole view is filled; returns the number of
+    # bytes received before the peer closed the connection
+    received = 0
+    size = len(view)
+    while received < size:
+        nbytes = sock.recv_into(view[received:], size - received)
+        if not nbytes:
+            break
+        received += nbytes
+    return received
 
 
 def recvPDU(sock):
-    pdu_length_data = sock.recv(4)
-    if not pdu_length_data:
+    # Every socket owns a receive buffer that is reused for all its frames
+    # and only grows when a larger PDU arrives
+    buffer = recv_buffers.get(sock)
+    if buffer is None:
+        buffer = recv_buffers[sock] = bytearray(INITIAL_RECV_BUFFER_SIZE)
+    with memoryview(buffer) as view:
+        received = recvInto(sock, view[:4])
+    if received == 0:
         raise ValueError("Connection closed by peer")
-
-    if len(pdu_length_data) != 4:
+    if received != 4:
         raise RuntimeError(
-            f"Invalid PDU length header (got {len(pdu_length_data)} bytes, expected 4)"
+            f"Invalid PDU length header (got {received} bytes, expected 4)"
         )
     # The ‘Standard size’ column refers to the size of the packed value in
     # bytes when using standard size
     # The result is a tuple even if it contains exactly one item
-    pdu_length = struct.unpack("<I", pdu_length_data)[0]
-    # An empty bytes object
-    pdu_data = b""
-    while len(pdu_data) < pdu_length:
-        chunk = sock.recv(pdu_length - len(pdu_data))
-        if not chunk:
+    pdu_length = struct.unpack_from("<I", buffer)[0]
+    checkFrameSize(pdu_length)
+    if pdu_length > len(buffer):
+        buffer = recv_buffers[sock] = bytearray(max(pdu_length, 2 * len(buffer)))
+    with memoryview(buffer) as view, view[:pdu_length] as pdu_data:
+        received = recvInto(sock, pdu_data)
+        if received != pdu_length:
             raise RuntimeError(
-                f"Connection closed before receiving full PDU (got {len(pdu_data)}/{pdu_length} bytes)"
+                f"Connection closed before receiving full PDU (got {received}/{pdu_length} bytes)"
             )
-        pdu_data += chunk
+        # Decoded values never reference the buffer, so it can be reused
+        decoded_pdu = decodePDU(pdu_data, codecOf(sock))
+    if pdu_observers:
+        notifyPDU("in", sock, decoded_pdu[0], 4 + pdu_length)
+    return decoded_pdu
+
+
+# asyncio counterparts of sendPDU / recvPDU sharing the same framing and codec
+
+
+async def sendPDUAsync(writer, pdu):
+    await sendEncodedPDUAsync(writer, pdu[0], encodeFrame(pdu, codecOf(writer)))
+
+
+async def sendEncodedPDUAsync(writer, choice, frame):
+    writer.write(frame)
     try:
-        decoded_pdu = asn1_compiler.decode("SMM3NG-PDU", pdu_data)
-    except Exception as e:
-        raise RuntimeError(f"PDU decoding failed: {e}")
-    print(f"decoded PDU data: {decoded_pdu}")
+        await writer.drain()
+    except (ConnectionError, OSError) as e:
+        raise RuntimeError(f"Failed to send PDU: {e}")
+    if pdu_observers:
+        notifyPDU("out", writer, choice, len(frame))
+
+
+async def recvPDUAsync(reader):
+    try:
+        pdu_length_data = await reader.readexactly(4)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            raise ValueError("Connection closed by peer")
+        raise RuntimeError(
+            f"Invalid PDU length header (got {len(e.partial)} bytes, expected 4)"
+        )
+    pdu_length = struct.unpack("<I", pdu_length_data)[0]
+    checkFrameSize(pdu_length)
+    try:
+        pdu_data = await reader.readexactly(pdu_length)
+    except asyncio.IncompleteReadError as e:
+        raise RuntimeError(
+            f"Connection closed before receiving full PDU (got {len(e.partial)}/{pdu_length} bytes)"
+        )
+    decoded_pdu = decodePDU(pdu_data, codecOf(reader))
+    if pdu_observers:
+        notifyPDU("in", reader, decoded_pdu[0], 4 + pdu_length)
     return decoded_pdu
 
 
@@ -107,3 +372,113 @@ def sendShiftValuesPDU(sock):
 def sendDonePDU(sock):
     pdu = ("done", None)
     sendPDU(sock, pdu)
+
+
+# A peer connection switches to another codec when the connecting side asks
+# for it in-band, with a pullValuesReq (in DER) for the single reserved name
+# CODEC_REQUEST + "oer,uper": the codecs it wants, preferred first. The
+# responder answers with a str variable of that name holding its choice,
+# and both ends use that codec from the next PDU on. Responders predating
+# negotiation answer with no variables, or with a nack for the unknown
+# name, and the connection stays DER.
+#
+# The request may also list features after the codecs, as in
+# CODEC_REQUEST + "der/compress"; the reply ("der/compress") holds the ones
+# the responder supports as well, and only these are used on the connection.
+
+CODEC_REQUEST = "smm3ng:codec="
+# Names travel as PrintableString, which has no ";"
+FEATURE_SEPARATOR = "/"
+# Compressed values, see compress.py
+COMPRESSION_FEATURE = "compress"
+PEER_FEATURES = (COMPRESSION_FEATURE,)
+
+# Features agreed on per socket (or stream), like socket_codecs
+socket_features: "weakref.WeakKeyDictionary[Any, frozenset]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def setFeatures(conn, features):
+    if features:
+        socket_features[conn] = frozenset(features)
+    else:
+        socket_features.pop(conn, None)
+
+
+def featuresOf(conn):
+    return socket_features.get(conn, frozenset())
+
+
+def codecRequest(codecs, features=()):
+    return (
+        "pullValuesReq",
+        [CODEC_REQUEST + FEATURE_SEPARATOR.join([",".join(codecs), *features])],
+    )
+
+
+def answerCodecRequest(pdu):
+    """
+    Returns (reply, codec, features) when `pdu` is a codec request, None
+    otherwise.
+    """
+    if pdu[0] != "pullValuesReq" or len(pdu[1]) != 1:
+        return None
+    name = pdu[1][0]
+    if not name.startswith(CODEC_REQUEST):
+        return None
+    codecs, *requested = name[len(CODEC_REQUEST) :].split(FEATURE_SEPARATOR)
+    chosen = "der"
+    for codec in codecs.split(","):
+        try:
+            specification(codec)
+        except Exception:
+            continue
+        chosen = codec
+        break
+    features = [feature for feature in requested if feature in PEER_FEATURES]
+    value = FEATURE_SEPARATOR.join([chosen, *features])
+    reply = ("pullValuesRep", [{"name": name, "value": ("str", value)}])
+    return reply, chosen, frozenset(features)
+
+
+def chosenCodec(request, reply):
+    """
+    Returns the (codec, features) the reply to `request` agreed on.
+    """
+    if reply[0] != "pullValuesRep":
+        # A nack: the peer knows nothing of negotiation
+        return "der", frozenset()
+    for var in reply[1]:
+        if var["name"] == request[1][0] and var["value"][0] == "str":
+            codec, *features = var["value"][1].split(FEATURE_SEPARATOR)
+            if codec in WIRE_CODECS:
+                requested = request[1][0].split(FEATURE_SEPARATOR)[1:]
+                return codec, frozenset(f for f in features if f in requested)
+    return "der", frozenset()
+
+
+def negotiateCodec(sock, codecs, features=()):
+    """
+    Asks the peer on `sock` for the first of `codecs` it supports and the
+    `features` it supports too, and switches the connection to them.
+    Returns the codec agreed on.
+    """
+    request = codecRequest(codecs, features)
+    sendPDU(sock, request)
+    codec, agreed = chosenCodec(request, recvPDU(sock))
+    specification(codec)
+    setCodec(sock, codec)
+    setFeatures(sock, agreed)
+    return codec
+
+
+async def negotiateCodecAsync(reader, writer, codecs, features=()):
+    request = codecRequest(codecs, features)
+    await sendPDUAsync(writer, request)
+    codec, agreed = chosenCodec(request, await recvPDUAsync(reader))
+    specification(codec)
+    setCodec(reader, codec)
+    setCodec(writer, codec)
+    setFeatures(writer, agreed)
+    return codec
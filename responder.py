@@ -0,0 +1,238 @@
+import selectors
+import socket
+import struct
+import threading
+
+from protocol import (
+    COMPRESSION_FEATURE,
+    answerCodecRequest,
+    checkFrameSize,
+    decodePDU,
+    encodeFrame,
+    notifyPDU,
+    pdu_observers,
+)
+from compress import decompress_value, is_compressed
+from shm import read_variables
+
+RECV_CHUNK = 65536
+
+
+def answer_pdu(pdu, outputs, inputs):
+    """
+    Build the reply to a peer's PDU: pulls are served from `outputs`,
+    pushed variables are stored into `inputs`.
+    """
+    if pdu[0] == "pullValuesReq":
+        return (
+            "pullValuesRep",
+            [
+                {"name": name, "value": outputs[name]}
+                for name in pdu[1]
+                if name in outputs
+            ],
+        )
+    if pdu[0] in ("pushValues", "pushValuesLinuxSHM"):
+        variables = pdu[1]
+        if pdu[0] == "pushValuesLinuxSHM":
+            try:
+                variables = read_variables(pdu[1])
+            except RuntimeError as e:
+                return ("nack", f"cannot read shared memory {pdu[1]}: {e}")
+        values = {}
+        for var in variables:
+            value = var["value"]
+            if is_compressed(value):
+                try:
+                    value = decompress_value(value)
+                except RuntimeError as e:
+                    return ("nack", f"cannot decompress {var['name']}: {e}")
+            values[var["name"]] = value
+        inputs.update(values)
+        return ("ack", None)
+    return ("nack", f"unexpected PDU {pdu[0]}")
+
+
+class _PeerConnection:
+    def __init__(self, sock):
+        self.sock = sock
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+        # Wire codec the peer asked for, see protocol.negotiateCodec()
+        self.codec = "der"
+        # Features agreed on with the peer; replies are only compressed for
+        # peers that asked for compressed values
+        self.features = frozenset()
+
+
+class DataResponder:
+    """
+    Serves other agents' pullValuesReq / pushValues PDUs on the data
+    responder socket. All peer connections are multiplexed by a single
+    selectors loop (epoll on Linux) running next to the control loop.
+
+    The control loop publishes its outputs after every shiftValues and takes
+    the values pushed by peers before running the algorithm.
+    """
+
+    def __init__(self, listen_sock, shm=None, compressor=None, unix_sock=None):
+        self.listen_sock = listen_sock
+        # Optional Unix socket co-located peers connect to, see uds.py
+        self.unix_sock = unix_sock
+        self.listeners = [s for s in (listen_sock, unix_sock) if s is not None]
+        # Optional ShmTransport for large replies to co-located peers
+        self.shm = shm
+        # Optional Compressor for large replies to peers on other hosts
+        self.compressor = compressor
+        self.selector = selectors.DefaultSelector()
+        self._lock = threading.Lock()
+        self._outputs: dict = {}
+        self._inputs: dict = {}
+        self._thread = None
+        self._running = False
+        # Writing to this pair wakes the loop up when stop() is called
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+
+    def publish(self, outputs):
+        with self._lock:
+            self._outputs = dict(outputs)
+
+    def take_inputs(self):
+        with self._lock:
+            inputs, self._inputs = self._inputs, {}
+        return inputs
+
+    def start(self):
+        for sock in self.listeners:
+            sock.setblocking(False)
+            self.selector.register(sock, selectors.EVENT_READ)
+        self._wakeup_r.setblocking(False)
+        self.selector.register(self._wakeup_r, selectors.EVENT_READ)
+        self._running = True
+        self._thread = threading.Thread(
+            target=self.serve_forever, name="data-responder", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        try:
+            self._wakeup_w.send(b"\0")
+        except OSError:
+            pass
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for key in list(self.selector.get_map().values()):
+            if isinstance(key.data, _PeerConnection):
+                self._close(key.data)
+        self.selector.close()
+        if self.shm is not None:
+            self.shm.close()
+        self._wakeup_r.close()
+        self._wakeup_w.close()
+
+    def serve_forever(self):
+        while self._running:
+            for key, mask in self.selector.select():
+                if key.fileobj in self.listeners:
+                    self._accept(key.fileobj)
+                elif key.fileobj is self._wakeup_r:
+                    self._wakeup_r.recv(64)
+                else:
+                    self._service(key.data, mask)
+
+    def _accept(self, listen_sock):
+        try:
+            sock, address = listen_sock.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        sock.setblocking(False)
+        if sock.family in (socket.AF_INET, socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            address = address[0]
+        else:
+            # Unix socket peers run on this host
+            address = "127.0.0.1"
+        conn = _PeerConnection(sock)
+        if self.shm is not None:
+            self.shm.add_peer(conn, address)
+        if self.compressor is not None:
+            self.compressor.add_peer(conn, address)
+        self.selector.register(sock, selectors.EVENT_READ, conn)
+
+    def _close(self, conn):
+        self.selector.unregister(conn.sock)
+        conn.sock.close()
+        if self.shm is not None:
+            self.shm.release(conn)
+        if self.compressor is not None:
+            self.compressor.remove_peer(conn)
+
+    def _service(self, conn, mask):
+        try:
+            if mask & selectors.EVENT_READ:
+                data = conn.sock.recv(RECV_CHUNK)
+                if not data:
+                    self._close(conn)
+                    return
+                conn.inbuf += data
+                self._process_frames(conn)
+            if conn.outbuf:
+                # Replies of all frames processed so far go out in one write
+                sent = conn.sock.send(conn.outbuf)
+                del conn.outbuf[:sent]
+        except (BlockingIOError, InterruptedError):
+            pass
+        except (OSError, RuntimeError) as e:
+            print(f"responder: dropping peer connection: {e}")
+            self._close(conn)
+            return
+        events = selectors.EVENT_READ
+        if conn.outbuf:
+            events |= selectors.EVENT_WRITE
+        self.selector.modify(conn.sock, events, conn)
+
+    def _process_frames(self, conn):
+        offset = 0
+        inbuf = conn.inbuf
+        while len(inbuf) - offset >= 4:
+            (pdu_length,) = struct.unpack_from("<I", inbuf, offset)
+            checkFrameSize(pdu_length)
+            end = offset + 4 + pdu_length
+            if len(inbuf) < end:
+                break
+            with memoryview(inbuf) as view:
+                pdu = decodePDU(view[offset + 4 : end], conn.codec)
+            if pdu_observers:
+                notifyPDU("in", conn.sock, pdu[0], 4 + pdu_length)
+            negotiated = answerCodecRequest(pdu)
+            if negotiated is not None:
+                reply, codec, conn.features = negotiated
+            else:
+                reply, codec = self.handle_pdu(pdu), conn.codec
+            if (
+                reply[0] == "pullValuesRep"
+                and self.shm is not None
+                and self.shm.wants(conn, reply[1])
+            ):
+                reply = ("pullValuesRepLinuxSHM", self.shm.write(conn, reply[1]))
+            elif (
+                reply[0] == "pullValuesRep"
+                and self.compressor is not None
+                and COMPRESSION_FEATURE in conn.features
+            ):
+                reply = ("pullValuesRep", self.compressor.pack(conn, reply[1]))
+            # A codec request is answered in the codec in use, the frames
+            # after it in the new one
+            frame = encodeFrame(reply, conn.codec)
+            conn.codec = codec
+            conn.outbuf += frame
+            if pdu_observers:
+                notifyPDU("out", conn.sock, reply[0], len(frame))
+            offset = end
+        del inbuf[:offset]
+
+    def handle_pdu(self, pdu):
+        with self._lock:
+            return answer_pdu(pdu, self._outputs, self._inputs)
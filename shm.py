@@ -0,0 +1,230 @@
+import ipaddress
+import itertools
+import mmap
+import os
+import socket
+import struct
+import threading
+
+from protocol import asn1_compiler
+
+# Data path for peers on the same host: the variables of a pushValues /
+# pullValuesRep are DER encoded (as a PushValuesPDU, which has the same
+# structure as PullValuesRepPDU) into a POSIX shared memory segment and the
+# TCP connection only carries the segment name in a pushValuesLinuxSHM /
+# pullValuesRepLinuxSHM PDU.
+#
+# Segment layout: 8-byte little-endian payload length followed by the payload.
+# A segment belongs to the agent that writes it and is reused for every PDU
+# sent over the same connection; the protocol is request/reply, so the reader
+# is done with it by the time the next PDU is written.
+
+SHM_DIR = "/dev/shm"
+SEGMENT_HEADER = struct.Struct("<Q")
+MIN_SEGMENT_SIZE = 1024 * 1024
+
+_segment_ids = itertools.count()
+
+
+def shm_available():
+    return os.path.isdir(SHM_DIR)
+
+
+def segment_path(name):
+    return os.path.join(SHM_DIR, name)
+
+
+def new_segment_name():
+    # Names travel as PrintableString, which has no "_"
+    return f"smm3ng-{os.getpid()}-{next(_segment_ids)}"
+
+
+_local_addresses = None
+
+
+def is_local_address(address):
+    global _local_addresses
+    try:
+        if ipaddress.ip_address(address).is_loopback:
+            return True
+    except ValueError:
+        return False
+    if _local_addresses is None:
+        try:
+            _local_addresses = set(socket.gethostbyname_ex(socket.gethostname())[2])
+        except OSError:
+            _local_addresses = set()
+    return address in _local_addresses
+
+
+def payload_size(variables):
+    # Rough size of the values, enough to tell whether shared memory pays off
+    size = 0
+    for var in variables:
+        type_name, value = var["value"]
+        if type_name in ("blob", "str"):
+            size += len(value)
+        elif type_name == "custom":
+            size += len(value["data"])
+    return size
+
+
+class SharedSegment:
+    def __init__(self, name=None, create=True):
+        # `create=False` opens the existing segment `name` for writing
+        self.name = name or new_segment_name()
+        flags = os.O_CREAT | os.O_EXCL | os.O_RDWR if create else os.O_RDWR
+        self.fd = os.open(segment_path(self.name), flags, 0o600)
+        self.map = None
+        self.size = 0
+
+    def write(self, data):
+        needed = SEGMENT_HEADER.size + len(data)
+        if needed > self.size:
+            size = max(MIN_SEGMENT_SIZE, self.size)
+            while size < needed:
+                size *= 2
+            if self.map is not None:
+                self.map.close()
+            os.ftruncate(self.fd, size)
+            self.map = mmap.mmap(self.fd, size)
+            self.size = size
+        SEGMENT_HEADER.pack_into(self.map, 0, len(data))
+        self.map[SEGMENT_HEADER.size : needed] = data
+        return self.name
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        os.close(self.fd)
+        try:
+            os.unlink(segment_path(self.name))
+        except FileNotFoundError:
+            pass
+
+
+class SegmentReader:
+    """
+    Attaches to segments written by peers; mappings are kept open and only
+    remapped when the writer grew the segment. Writers unlink the segment of
+    a connection when it closes and the next connection gets a new one, so
+    mappings of unlinked segments are closed whenever a new name shows up.
+    """
+
+    def __init__(self):
+        self.maps = {}
+        # The control loop and the data responder read from their own threads
+        self.lock = threading.Lock()
+
+    def read(self, name, type_name):
+        def decode(data):
+            try:
+                return asn1_compiler.decode(type_name, data)
+            except Exception as e:
+                raise RuntimeError(f"Shared memory decoding failed: {e}")
+
+        return self.read_with(name, decode)
+
+    def read_with(self, name, decode):
+        """
+        Returns decode(payload) for the payload of segment `name`; the
+        payload view is only valid during the call.
+        """
+        with self.lock:
+            return self._read(name, decode)
+
+    def _read(self, name, decode):
+        if "/" in name or name.startswith("."):
+            raise RuntimeError(f"Invalid shared memory segment name {name}")
+        mapped = self.maps.get(name)
+        if mapped is None or len(mapped) < SEGMENT_HEADER.size:
+            mapped = self._attach(name)
+        (length,) = SEGMENT_HEADER.unpack_from(mapped, 0)
+        if SEGMENT_HEADER.size + length > len(mapped):
+            mapped = self._attach(name)
+        with memoryview(mapped) as view:
+            with view[SEGMENT_HEADER.size : SEGMENT_HEADER.size + length] as data:
+                return decode(data)
+
+    def _attach(self, name):
+        old = self.maps.pop(name, None)
+        if old is not None:
+            old.close()
+        else:
+            self._drop_unlinked()
+        try:
+            fd = os.open(segment_path(name), os.O_RDONLY)
+        except OSError as e:
+            raise RuntimeError(f"Cannot open shared memory segment {name}: {e}")
+        try:
+            mapped = mmap.mmap(fd, os.fstat(fd).st_size, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        self.maps[name] = mapped
+        return mapped
+
+    def _drop_unlinked(self):
+        for name in list(self.maps):
+            if not os.path.exists(segment_path(name)):
+                self.maps.pop(name).close()
+
+    def close(self):
+        with self.lock:
+            for mapped in self.maps.values():
+                mapped.close()
+            self.maps.clear()
+
+
+class ShmTransport:
+    """
+    Chooses shared memory for variables sent to co-located peers when their
+    payload reaches `threshold` bytes, and falls back to plain TCP PDUs
+    otherwise.
+    """
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.local_peers = set()
+        self.segments = {}
+
+    def add_peer(self, key, address):
+        if is_local_address(address):
+            self.local_peers.add(key)
+
+    def wants(self, key, variables):
+        return key in self.local_peers and payload_size(variables) >= self.threshold
+
+    def write(self, key, variables):
+        try:
+            data = asn1_compiler.encode("PushValuesPDU", variables)
+        except Exception as e:
+            raise RuntimeError(f"PDU encoding failed: {e}")
+        segment = self.segments.get(key)
+        if segment is None:
+            segment = self.segments[key] = SharedSegment()
+        return segment.write(data)
+
+    def release(self, key):
+        segment = self.segments.pop(key, None)
+        if segment is not None:
+            segment.close()
+
+    def close(self):
+        for segment in self.segments.values():
+            segment.close()
+        self.segments.clear()
+
+
+def create_shm_transport(threshold):
+    # A threshold of 0 turns the shared memory path off
+    if threshold <= 0 or not shm_available():
+        return None
+    return ShmTransport(threshold)
+
+
+segment_reader = SegmentReader()
+
+
+def read_variables(name):
+    return segment_reader.read(name, "PushValuesPDU")
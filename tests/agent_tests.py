@@ -1,6 +1,9 @@
 from unittest.mock import patch, MagicMock
 from unittest.mock import mock_open, patch
 from agent import print_conn_pdu
+import os
+import socket
+import time
 import unittest
 from unittest.mock import MagicMock, mock_open, patch
 
@@ -8,9 +11,45 @@ from agent import (
     create_data_responder_socket,
     connect_to_core,
     connect_to_peer,
+    drop_peers,
+    peer_connector,
     print_conn_pdu,
+    pull_values,
+    push_values,
     start_agent,
+    with_reconnect,
 )
+from config import AgentConfig
+from deadline import cycle_deadline
+from delta import DeltaPush
+from plan import CyclePlan
+from pool import ConnectionPool
+from protocol import codecOf, encodeFrame, recvPDU, sendPDU
+from responder import DataResponder
+from shm import ShmTransport, segment_path, shm_available
+
+# Mocked peers are TCP connections; no Unix socket is tried first
+TCP_ONLY = AgentConfig(unix_socket_dir="")
+
+
+def make_plan(pull=None, push=None):
+    """
+    CyclePlan of {remoteAlgoName: [(localParamName, remoteParamName), ..]}
+    pull and push bindings
+    """
+
+    def conns(groups):
+        return [
+            {
+                "localParamName": local_name,
+                "remoteAlgoName": remote_algo,
+                "remoteParamName": remote_name,
+            }
+            for remote_algo, bindings in (groups or {}).items()
+            for local_name, remote_name in bindings
+        ]
+
+    return CyclePlan({"pull": conns(pull), "push": conns(push)})
 
 
 class TestAgentFunctions(unittest.TestCase):
@@ -37,6 +76,9 @@ class TestAgentFunctions(unittest.TestCase):
             sock = connect_to_core("Algo", "Class", "tcp://127.0.0.1:1234", 5678)
             self.assertEqual(sock, mock_socket)
             mock_socket.connect.assert_called_with(("127.0.0.1", 1234))
+            mock_socket.setsockopt.assert_called_with(
+                socket.IPPROTO_TCP, socket.TCP_NODELAY, 1
+            )
             mock_sendRegPDU.assert_called_with(mock_socket, "Algo", "Class", 5678)
 
     @patch("socket.socket")
@@ -46,6 +88,38 @@ class TestAgentFunctions(unittest.TestCase):
         sock = connect_to_peer("127.0.0.1", 1234)
         self.assertEqual(sock, mock_socket)
         mock_socket.connect.assert_called_with(("127.0.0.1", 1234))
+        mock_socket.setsockopt.assert_called_with(
+            socket.IPPROTO_TCP, socket.TCP_NODELAY, 1
+        )
+
+    def test_peer_connector_negotiates_codec(self):
+        self.assertIs(peer_connector(["der"]), connect_to_peer)
+        listen_sock = socket.create_server(("127.0.0.1", 0))
+        responder = DataResponder(listen_sock)
+        responder.start()
+        self.addCleanup(listen_sock.close)
+        self.addCleanup(responder.stop)
+        responder.publish({"a": ("integer", 5)})
+        sock = peer_connector(["oer"])(*listen_sock.getsockname())
+        self.addCleanup(sock.close)
+        self.assertEqual(codecOf(sock), "oer")
+        sendPDU(sock, ("pullValuesReq", ["a"]))
+        self.assertEqual(
+            recvPDU(sock), ("pullValuesRep", [{"name": "a", "value": ("integer", 5)}])
+        )
+
+    @patch("agent.connect_to_peer")
+    def test_peer_connector_keeps_peers_nacking_negotiation(self, mock_connect):
+        client, server = socket.socketpair()
+        self.addCleanup(client.close)
+        self.addCleanup(server.close)
+        mock_connect.return_value = client
+        sendPDU(server, ("nack", "unknown variable"))
+        sock = peer_connector(["oer"], "", ["compress"])("127.0.0.1", 1234)
+        # The peer is reachable, only over plain DER
+        self.assertIs(sock, client)
+        self.assertEqual(codecOf(sock), "der")
+        self.assertEqual(recvPDU(server)[0], "pullValuesReq")
 
     """
 	test writing the correct content to the expected file
@@ -98,8 +172,420 @@ class TestAgentFunctions(unittest.TestCase):
         handle.write.assert_has_calls(expected_calls, any_order=False)
 
 
+class TestPullPhase(unittest.TestCase):
+    """
+    test batching pull connections into one request per peer
+    """
+
+    @patch("agent.recvPDU")
+    @patch("agent.sendEncodedPDU")
+    def test_pull_values_batched_per_peer(self, mock_sendEncodedPDU, mock_recvPDU):
+        sock_a = MagicMock()
+        sock_b = MagicMock()
+        peers = {"A": sock_a, "B": sock_b}
+        plan = make_plan(pull={"A": [("x", "p"), ("y", "q")], "B": [("z", "p")]})
+        mock_recvPDU.side_effect = [
+            (
+                "pullValuesRep",
+                [
+                    {"name": "q", "value": ("integer", 2)},
+                    {"name": "p", "value": ("integer", 1)},
+                ],
+            ),
+            ("pullValuesRep", [{"name": "p", "value": ("real", 3.0)}]),
+        ]
+
+        values = pull_values(peers, plan)
+
+        # Both requests are sent before the first reply is read
+        self.assertEqual(
+            mock_sendEncodedPDU.call_args_list,
+            [
+                unittest.mock.call(
+                    sock_a,
+                    "pullValuesReq",
+                    encodeFrame(("pullValuesReq", ["p", "q"])),
+                ),
+                unittest.mock.call(
+                    sock_b, "pullValuesReq", encodeFrame(("pullValuesReq", ["p"]))
+                ),
+            ],
+        )
+        self.assertEqual(
+            values,
+            {"x": ("integer", 1), "y": ("integer", 2), "z": ("real", 3.0)},
+        )
+
+    @patch("agent.recvPDU")
+    @patch("agent.sendEncodedPDU")
+    def test_pull_values_wrong_reply(self, mock_sendEncodedPDU, mock_recvPDU):
+        plan = make_plan(pull={"A": [("x", "p")]})
+        mock_recvPDU.return_value = ("ack", None)
+        with self.assertRaises(ValueError):
+            pull_values({"A": MagicMock()}, plan)
+
+    def test_pull_values_deadline(self):
+        fast, fast_peer = socket.socketpair()
+        slow, slow_peer = socket.socketpair()
+        self.addCleanup(fast_peer.close)
+        self.addCleanup(slow_peer.close)
+        sendPDU(fast_peer, ("pullValuesRep", [{"name": "p", "value": ("integer", 1)}]))
+        peers = {"A": fast, "B": slow}
+        plan = make_plan(pull={"A": [("x", "p")], "B": [("y", "p")], "C": [("z", "p")]})
+        late = []
+
+        started = time.monotonic()
+        values = pull_values(peers, plan, deadline=cycle_deadline(0.1), late=late)
+
+        self.assertLess(time.monotonic() - started, 1.0)
+        self.assertEqual(values, {"x": ("integer", 1)})
+        # The silent peer and the one without a connection are late
+        self.assertEqual(late, ["C", "B"])
+        drop_peers(peers, late)
+        self.assertEqual(peers, {"A": fast})
+        self.assertEqual(slow.fileno(), -1)
+        fast.close()
+
+    def test_shared_socket_is_dropped_at_the_first_timeout(self):
+        sock, peer = socket.socketpair()
+        self.addCleanup(peer.close)
+        socks = [sock]
+        peers = ConnectionPool(lambda address, port: socks.pop(0))
+        peers.add("A", "host", 1)
+        peers.add("B", "host", 1)
+        peers["A"]
+        plan = make_plan(pull={"A": [("x", "p")], "B": [("y", "q")]})
+        late = []
+
+        values = pull_values(peers, plan, deadline=cycle_deadline(0.05), late=late)
+
+        self.assertEqual(values, {})
+        self.assertEqual(late, ["A", "B"])
+        # A's reply, still on its way, can no longer be read as B's
+        self.assertEqual(sock.fileno(), -1)
+        self.assertNotIn("B", peers)
+
+
+class TestPushPhase(unittest.TestCase):
+    """
+    test batching push connections into one PDU per peer
+    """
+
+    @patch("agent.recvStatusPDU")
+    @patch("agent.sendPDU")
+    def test_push_values_batched_per_peer(self, mock_sendPDU, mock_recvStatusPDU):
+        sock_a = MagicMock()
+        sock_b = MagicMock()
+        peers = {"A": sock_a, "B": sock_b}
+        plan = make_plan(push={"A": [("x", "p"), ("y", "q")], "B": [("x", "r")]})
+        output_params = {"x": ("integer", 1), "y": ("real", 2.0)}
+        mock_recvStatusPDU.side_effect = [(True, None), (False, "busy")]
+
+        nacks = push_values(peers, plan, output_params, window=8)
+
+        self.assertEqual(
+            mock_sendPDU.call_args_list,
+            [
+                unittest.mock.call(
+                    sock_a,
+                    (
+                        "pushValues",
+                        [
+                            {"name": "p", "value": ("integer", 1)},
+                            {"name": "q", "value": ("real", 2.0)},
+                        ],
+                    ),
+                ),
+                unittest.mock.call(
+                    sock_b, ("pushValues", [{"name": "r", "value": ("integer", 1)}])
+                ),
+            ],
+        )
+        self.assertEqual(nacks, [("B", "r", "busy")])
+
+    @patch("agent.recvStatusPDU")
+    @patch("agent.sendPDU")
+    def test_push_values_through_shared_memory(self, mock_sendPDU, mock_recvStatusPDU):
+        shm = MagicMock()
+        shm.wants.side_effect = lambda key, variables: key == "A"
+        shm.write.return_value = "smm3ng-1-0"
+        mock_recvStatusPDU.return_value = (True, None)
+        peers = {"A": "a", "B": "b"}
+        plan = make_plan(push={"A": [("x", "x")], "B": [("x", "x")]})
+
+        push_values(peers, plan, {"x": ("blob", b"data")}, 8, shm)
+
+        self.assertEqual(
+            mock_sendPDU.call_args_list,
+            [
+                unittest.mock.call("a", ("pushValuesLinuxSHM", "smm3ng-1-0")),
+                unittest.mock.call(
+                    "b", ("pushValues", [{"name": "x", "value": ("blob", b"data")}])
+                ),
+            ],
+        )
+
+    @patch("agent.recvStatusPDU")
+    @patch("agent.sendPDU")
+    def test_push_values_window(self, mock_sendPDU, mock_recvStatusPDU):
+        events = []
+        mock_sendPDU.side_effect = lambda sock, pdu: events.append(("send", sock))
+
+        def recv_status(sock):
+            events.append(("recv", sock))
+            return (True, None)
+
+        mock_recvStatusPDU.side_effect = recv_status
+        peers = {"A": "a", "B": "b", "C": "c"}
+        plan = make_plan(push={name: [("x", "x")] for name in peers})
+
+        push_values(peers, plan, {"x": ("integer", 1)}, window=2)
+
+        # The third peer is only written once the first status arrived
+        self.assertEqual(
+            events,
+            [
+                ("send", "a"),
+                ("send", "b"),
+                ("recv", "a"),
+                ("send", "c"),
+                ("recv", "b"),
+                ("recv", "c"),
+            ],
+        )
+
+    @patch("agent.recvStatusPDU")
+    @patch("agent.sendPDU")
+    def test_push_values_delta(self, mock_sendPDU, mock_recvStatusPDU):
+        delta = DeltaPush(refresh=3)
+        peers = {"A": "a", "B": "b"}
+        plan = make_plan(push={"A": [("x", "x"), ("y", "y")], "B": [("x", "x")]})
+        mock_recvStatusPDU.return_value = (True, None)
+
+        def cycle(outputs):
+            mock_sendPDU.reset_mock()
+            delta.start_cycle()
+            push_values(peers, plan, outputs, 8, delta=delta)
+            return [c.args for c in mock_sendPDU.call_args_list]
+
+        x1 = {"name": "x", "value": ("integer", 1)}
+        y1 = {"name": "y", "value": ("real", 1.0)}
+        self.assertEqual(
+            cycle({"x": ("integer", 1), "y": ("real", 1.0)}),
+            [("a", ("pushValues", [x1, y1])), ("b", ("pushValues", [x1]))],
+        )
+        # Unchanged values are left out, peers without changes get nothing
+        y2 = {"name": "y", "value": ("real", 2.0)}
+        self.assertEqual(
+            cycle({"x": ("integer", 1), "y": ("real", 2.0)}),
+            [("a", ("pushValues", [y2]))],
+        )
+        # Every third cycle everything is sent again
+        self.assertEqual(
+            cycle({"x": ("integer", 1), "y": ("real", 2.0)}),
+            [("a", ("pushValues", [x1, y2])), ("b", ("pushValues", [x1]))],
+        )
+        # A nack makes the next cycle resend everything to that peer
+        mock_recvStatusPDU.return_value = (False, "busy")
+        x2 = {"name": "x", "value": ("integer", 2)}
+        self.assertEqual(
+            cycle({"x": ("integer", 2), "y": ("real", 2.0)}),
+            [("a", ("pushValues", [x2])), ("b", ("pushValues", [x2]))],
+        )
+        mock_recvStatusPDU.return_value = (True, None)
+        self.assertEqual(
+            cycle({"x": ("integer", 2), "y": ("real", 2.0)}),
+            [("a", ("pushValues", [x2, y2])), ("b", ("pushValues", [x2]))],
+        )
+
+    def test_push_values_deadline(self):
+        fast, fast_peer = socket.socketpair()
+        slow, slow_peer = socket.socketpair()
+        self.addCleanup(fast.close)
+        self.addCleanup(fast_peer.close)
+        self.addCleanup(slow.close)
+        self.addCleanup(slow_peer.close)
+        sendPDU(fast_peer, ("ack", None))
+        delta = DeltaPush()
+        delta.ack("B", [{"name": "x", "value": ("integer", 0)}])
+        peers = {"A": fast, "B": slow}
+        plan = make_plan(push={"A": [("x", "x")], "B": [("x", "x")], "C": [("x", "x")]})
+        late = []
+
+        nacks = push_values(
+            peers,
+            plan,
+            {"x": ("integer", 1)},
+            8,
+            delta=delta,
+            deadline=cycle_deadline(0.1),
+            late=late,
+        )
+
+        self.assertEqual(sorted(late), ["B", "C"])
+        self.assertEqual(
+            sorted((algo, name) for algo, name, _ in nacks), [("B", "x"), ("C", "x")]
+        )
+        # The late peer gets everything again once it is back
+        self.assertNotIn("B", delta.acked)
+        self.assertEqual(recvPDU(slow_peer)[0], "pushValues")
+
+    @unittest.skipUnless(shm_available(), "POSIX shared memory is not available")
+    def test_late_peer_keeps_its_segment(self):
+        sock, peer = socket.socketpair()
+        self.addCleanup(sock.close)
+        self.addCleanup(peer.close)
+        shm = ShmTransport(threshold=1)
+        self.addCleanup(shm.close)
+        shm.add_peer("A", "127.0.0.1")
+        plan = make_plan(push={"A": [("x", "x")]})
+        late = []
+
+        push_values(
+            {"A": sock},
+            plan,
+            {"x": ("blob", b"payload")},
+            8,
+            shm=shm,
+            deadline=cycle_deadline(0.05),
+            late=late,
+        )
+
+        self.assertEqual(late, ["A"])
+        name = recvPDU(peer)[1]
+        # The next push to A does not overwrite what it may still be reading
+        self.assertNotIn("A", shm.segments)
+        self.assertFalse(os.path.exists(segment_path(name)))
+
+    def test_push_values_shared_socket_timeout(self):
+        sock, peer = socket.socketpair()
+        self.addCleanup(peer.close)
+        socks = [sock]
+        peers = ConnectionPool(lambda address, port: socks.pop(0))
+        peers.add("A", "host", 1)
+        peers.add("B", "host", 1)
+        peers["A"]
+        plan = make_plan(push={"A": [("x", "x")], "B": [("x", "y")]})
+        late = []
+
+        push_values(
+            peers,
+            plan,
+            {"x": ("integer", 1)},
+            8,
+            deadline=cycle_deadline(0.05),
+            late=late,
+        )
+
+        # B's status is not taken from A's late ack
+        self.assertEqual(late, ["A", "B"])
+        self.assertEqual(sock.fileno(), -1)
+
+
+class TestReconnect(unittest.TestCase):
+    """
+    test a phase failing on a broken connection being retried on a new one
+    """
+
+    def test_with_reconnect(self):
+        socks = [MagicMock(name="broken"), MagicMock(name="fresh")]
+        peers = ConnectionPool(lambda address, port: socks.pop(0))
+        peers.add("A", "127.0.0.1", 1000)
+        peers.connect()
+        phase = MagicMock(side_effect=[RuntimeError("broken pipe"), "values"])
+
+        self.assertEqual(with_reconnect(peers, phase, "arg"), "values")
+        self.assertEqual(phase.call_count, 2)
+        phase.assert_called_with(peers, "arg")
+        self.assertEqual(peers["A"]._mock_name, "fresh")
+
+        # A second failure is left to the caller
+        phase.side_effect = [RuntimeError("broken pipe"), ValueError("closed")]
+        socks.append(MagicMock())
+        with self.assertRaises(ValueError):
+            with_reconnect(peers, phase)
+
+    @patch("agent.recvStatusPDU")
+    @patch("agent.sendPDU")
+    def test_reconnected_peers_get_every_value(self, mock_sendPDU, mock_recvStatusPDU):
+        socks = [MagicMock(name="old"), MagicMock(name="new")]
+        peers = ConnectionPool(lambda address, port: socks.pop(0))
+        peers.add("A", "127.0.0.1", 1000)
+        plan = make_plan(push={"A": [("x", "x"), ("y", "y")]})
+        mock_recvStatusPDU.return_value = (True, None)
+        delta = DeltaPush()
+
+        def cycle(outputs):
+            mock_sendPDU.reset_mock()
+            delta.start_cycle()
+            args = (plan, outputs, 8, None, None, delta)
+            with_reconnect(peers, push_values, *args, delta=delta)
+            return mock_sendPDU.call_args.args
+
+        cycle({"x": ("integer", 1), "y": ("integer", 1)})
+        # The old connection broke, the new one may lead to a peer that
+        # restarted with no cached inputs: it gets the unchanged value too
+        mock_sendPDU.side_effect = [BrokenPipeError(), None]
+        sock, pdu = cycle({"x": ("integer", 2), "y": ("integer", 1)})
+        self.assertEqual(sock._mock_name, "new")
+        self.assertEqual(
+            pdu[1],
+            [
+                {"name": "x", "value": ("integer", 2)},
+                {"name": "y", "value": ("integer", 1)},
+            ],
+        )
+        self.assertEqual(delta.cycle, 2)
+
+
 class TestStartAgent(unittest.TestCase):
 
+    @patch("agent.DataResponder")
+    @patch("agent.print_conn_pdu")
+    @patch("agent.create_algorithm_instance")
+    @patch("agent.sendNackPDU")
+    @patch("agent.sendAckPDU")
+    @patch("agent.recvPDU")
+    @patch("agent.connect_to_peer")
+    @patch("agent.connect_to_core")
+    @patch("agent.create_data_responder_socket")
+    def test_unreachable_peer_fails_setup(
+        self,
+        mock_create_sock,
+        mock_connect_core,
+        mock_connect_peer,
+        mock_recvPDU,
+        mock_sendAck,
+        mock_sendNack,
+        mock_create_algo,
+        mock_print_conn_pdu,
+        mock_responder,
+    ):
+        mock_create_sock.return_value.getsockname.return_value = ("localhost", 1234)
+        mock_control_sock = MagicMock()
+        mock_connect_core.return_value = mock_control_sock
+        mock_connect_peer.return_value = None
+        conn = {
+            "localParamName": "x",
+            "remoteAlgoName": "A",
+            "remoteParamName": "y",
+            "address": "127.0.0.1",
+            "port": 5000,
+        }
+        mock_recvPDU.side_effect = [("setConn", {"pull": [conn], "push": []})]
+        config = AgentConfig(connect_retries=2, connect_backoff=0.0, unix_socket_dir="")
+
+        with patch("builtins.print"):
+            start_agent("Algo", "Class", "tcp://localhost:9999", config)
+
+        self.assertEqual(mock_connect_peer.call_count, 3)
+        mock_sendNack.assert_called_once_with(
+            mock_control_sock, "cannot connect to 127.0.0.1:5000"
+        )
+        mock_sendAck.assert_not_called()
+        mock_create_algo.assert_not_called()
+
+    @patch("agent.DataResponder")
     @patch("agent.print_conn_pdu")
     @patch("agent.create_algorithm_instance")
     @patch("agent.sendAckPDU")
@@ -116,6 +602,7 @@ class TestStartAgent(unittest.TestCase):
         mock_sendAck,
         mock_create_algo,
         mock_print_conn_pdu,
+        mock_responder,
     ):
 
         # Mock sockets
@@ -139,13 +626,14 @@ class TestStartAgent(unittest.TestCase):
             ("done", None),
         ]
 
-        start_agent("Algo", "Class", "tcp://localhost:9999")
+        start_agent("Algo", "Class", "tcp://localhost:9999", TCP_ONLY)
 
         # Verify connections
         mock_connect_core.assert_called()
         mock_sendAck.assert_called()
         mock_algo.run.assert_called()
 
+    @patch("agent.DataResponder")
     @patch("agent.print_conn_pdu")
     @patch("agent.create_algorithm_instance")
     @patch("agent.sendAckPDU")
@@ -166,6 +654,7 @@ class TestStartAgent(unittest.TestCase):
         mock_sendAckPDU,
         mock_create_algorithm_instance,
         mock_print_conn_pdu,
+        mock_responder,
     ):
         mock_data_sock = MagicMock()
         mock_data_sock.getsockname.return_value = ("127.0.0.1", 5000)
@@ -205,14 +694,17 @@ class TestStartAgent(unittest.TestCase):
             ("done", None),
         ]
 
-        start_agent("TestAlgo", "TestClass", "tcp://localhost:1234")
+        start_agent("TestAlgo", "TestClass", "tcp://localhost:1234", TCP_ONLY)
 
         mock_connect_to_core.assert_called_once()
         mock_connect_to_peer.assert_called_with("127.0.0.1", 5000)
         mock_sendAckPDU.assert_called()
-        mock_sendPDU.assert_any_call(mock_peer_sock, ("pullValuesReq", ["data"]))
+        mock_peer_sock.sendall.assert_any_call(encodeFrame(("pullValuesReq", ["data"])))
         algo_instance.run.assert_called_with({"input_val": ("integer", 0)})
+        # Peer connections are closed once the simulation is done
+        mock_peer_sock.close.assert_called()
 
+    @patch("agent.DataResponder")
     @patch("agent.print_conn_pdu")
     @patch("agent.create_algorithm_instance")
     @patch("agent.sendAckPDU")
@@ -233,6 +725,7 @@ class TestStartAgent(unittest.TestCase):
         mock_sendAckPDU,
         mock_create_algorithm_instance,
         mock_print_conn_pdu,
+        mock_responder,
     ):
         mock_data_sock = MagicMock()
         mock_data_sock.getsockname.return_value = ("127.0.0.1", 5000)
@@ -260,13 +753,14 @@ class TestStartAgent(unittest.TestCase):
         mock_algo = MagicMock()
         mock_create_algorithm_instance.return_value = mock_algo
 
-        start_agent("BadAgent", "BadClass", "tcp://localhost:1234")
+        start_agent("BadAgent", "BadClass", "tcp://localhost:1234", TCP_ONLY)
 
         # Should NOT have called algo.run at all
         mock_algo.run.assert_not_called()
         # Should have connected to peer anyway
         mock_connect_to_peer.assert_called_with("127.0.0.1", 5001)
 
+    @patch("agent.DataResponder")
     @patch("agent.print_conn_pdu")
     @patch("agent.create_algorithm_instance")
     @patch("agent.sendAckPDU")
@@ -287,6 +781,7 @@ class TestStartAgent(unittest.TestCase):
         mock_sendAckPDU,
         mock_create_algorithm_instance,
         mock_print_conn_pdu,
+        mock_responder,
     ):
 
         mock_data_sock = MagicMock()
@@ -331,7 +826,7 @@ class TestStartAgent(unittest.TestCase):
             ("notShiftValues", None),
         ]
 
-        start_agent("BrokenShiftAlgo", "AgentClass", "tcp://localhost:1234")
+        start_agent("BrokenShiftAlgo", "AgentClass", "tcp://localhost:1234", TCP_ONLY)
 
         # Should have exited on bad shiftValues
         mock_connect_to_core.assert_called_once()
@@ -0,0 +1,122 @@
+import asyncio
+import unittest
+
+from arrays import (
+    ARRAY_OID,
+    decode_array,
+    encode_array,
+    from_arrays,
+    to_arrays,
+    uses_arrays,
+)
+
+try:
+    import numpy as np
+except ImportError:
+    np = None  # type: ignore[assignment]
+from async_agent import run_algorithm
+from deadline import StaleValue, is_stale
+from protocol import decodePDU, encodePDU
+
+
+class ArrayAlgorithm:
+    uses_arrays = True
+
+    def run(self, params):
+        return {"sum": params["v"] + params["k"], "n": ("integer", 1)}
+
+
+@unittest.skipUnless(np is not None, "numpy is not installed")
+class TestArrayValues(unittest.TestCase):
+    def assertRoundTrip(self, array):
+        value = encode_array(array)
+        self.assertEqual(value[0], "custom")
+        self.assertEqual(value[1]["type"], ARRAY_OID)
+        decoded = decode_array(value[1]["data"])
+        self.assertEqual(decoded.dtype, array.dtype)
+        self.assertEqual(decoded.shape, array.shape)
+        np.testing.assert_array_equal(decoded, array)
+        return decoded
+
+    def test_round_trip(self):
+        for array in [
+            np.arange(10, dtype=np.float64),
+            np.arange(24, dtype=np.int32).reshape(2, 3, 4),
+            np.array([True, False]),
+            np.array(2.5),
+            np.zeros((0, 3), dtype=np.complex128),
+            np.arange(6, dtype=">u2"),
+        ]:
+            self.assertRoundTrip(array)
+
+    def test_non_contiguous_input(self):
+        array = np.arange(20, dtype=np.float32).reshape(4, 5)[:, ::2]
+        self.assertRoundTrip(array)
+
+    def test_decode_is_a_read_only_aligned_view(self):
+        data = encode_array(np.arange(1000, dtype=np.float64))[1]["data"]
+        decoded = decode_array(data)
+        self.assertFalse(decoded.flags.writeable)
+        self.assertTrue(decoded.flags.aligned)
+        self.assertFalse(decoded.flags.owndata)
+
+    def test_rejects_object_arrays(self):
+        with self.assertRaises(ValueError):
+            encode_array(np.array([object()]))
+
+    def test_rejects_malformed_data(self):
+        data = encode_array(np.arange(4, dtype=np.int64))[1]["data"]
+        for bad in (b"", data[:-1], data + b"\x00", b"\x03|O8\x00" + bytes(12)):
+            with self.assertRaises(ValueError):
+                decode_array(bad)
+
+    def test_through_the_pdu_codec(self):
+        array = np.linspace(0, 1, 100000)
+        pdu = ("pushValues", [{"name": "v", "value": encode_array(array)}])
+        decoded = decodePDU(memoryview(encodePDU(pdu)))
+        np.testing.assert_array_equal(
+            decode_array(decoded[1][0]["value"][1]["data"]), array
+        )
+
+    def test_array_api(self):
+        algo = ArrayAlgorithm()
+        self.assertTrue(uses_arrays(algo))
+        params = {
+            "v": encode_array(np.arange(3.0)),
+            "k": ("real", 0.5),
+            "s": ("str", "kept"),
+        }
+        arrays = to_arrays(params)
+        self.assertEqual(arrays["k"].shape, ())
+        self.assertEqual(arrays["s"], ("str", "kept"))
+        outputs = from_arrays(algo.run(arrays))
+        self.assertEqual(outputs["n"], ("integer", 1))
+        np.testing.assert_array_equal(
+            decode_array(outputs["sum"][1]["data"]), [0.5, 1.5, 2.5]
+        )
+
+    def test_stale_inputs_stay_flagged(self):
+        params = {
+            "v": StaleValue(encode_array(np.arange(3.0))),
+            "k": StaleValue(("real", 0.5)),
+            "s": StaleValue(("str", "kept")),
+            "fresh": ("real", 1.0),
+        }
+        arrays = to_arrays(params)
+        self.assertTrue(all(is_stale(arrays[name]) for name in ("v", "k", "s")))
+        np.testing.assert_array_equal(arrays["v"].value, [0.0, 1.0, 2.0])
+        self.assertEqual(arrays["k"].value, 0.5)
+        self.assertIs(arrays["s"], params["s"])
+        self.assertFalse(is_stale(arrays["fresh"]))
+
+    def test_async_runtime_converts(self):
+        params = {"v": encode_array(np.arange(2.0)), "k": ("integer", 1)}
+        outputs = asyncio.run(run_algorithm(ArrayAlgorithm(), params))
+        np.testing.assert_array_equal(decode_array(outputs["sum"][1]["data"]), [1, 2])
+
+    def test_opt_in(self):
+        class Plain:
+            def run(self, params):
+                return {}
+
+        self.assertFalse(uses_arrays(Plain()))
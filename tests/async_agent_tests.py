@@ -0,0 +1,568 @@
+import asyncio
+import os
+import socket
+import tempfile
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+from algo import ALGORITHMS, register_algorithm
+from async_agent import AgentHost, AsyncAgent, parse_instances, run_algorithm
+from config import AgentConfig
+from custom import FLOAT64_VECTOR_OID
+from deadline import cycle_deadline, is_stale
+from plan import CyclePlan
+from protocol import codecOf, recvPDUAsync, sendPDUAsync
+
+
+class SyncAlgorithm:
+    def run(self, params):
+        return {"out": params["in"]}
+
+
+class AsyncAlgorithm:
+    def __init__(self):
+        self.seen = []
+
+    async def run(self, params):
+        await asyncio.sleep(0)
+        self.seen.append(params)
+        return {"out": ("integer", 2)}
+
+
+class CountingAlgorithm:
+    def __init__(self):
+        self.count = 0
+        self.seen = []
+
+    def run(self, params):
+        self.seen.append(params)
+        self.count += 1
+        return {"out": ("integer", self.count)}
+
+
+class TestRunAlgorithm(unittest.TestCase):
+    def test_sync_and_async_run(self):
+        params = {"in": ("integer", 1)}
+        self.assertEqual(
+            asyncio.run(run_algorithm(SyncAlgorithm(), params)),
+            {"out": ("integer", 1)},
+        )
+        self.assertEqual(
+            asyncio.run(run_algorithm(AsyncAlgorithm(), params)),
+            {"out": ("integer", 2)},
+        )
+
+    def test_custom_codecs(self):
+        # The algorithm sees an array.array and returns it unchanged
+        vector = ("custom", {"type": FLOAT64_VECTOR_OID, "data": b"\0" * 16})
+        self.assertEqual(
+            asyncio.run(run_algorithm(SyncAlgorithm(), {"in": vector})),
+            {"out": vector},
+        )
+
+
+class TestAsyncAgent(unittest.TestCase):
+    """
+    test one full cycle against a stand-in core and upstream peer
+    """
+
+    @patch("async_agent.print_conn_pdu")
+    def test_cycle(self, mock_print_conn_pdu):
+        algo = AsyncAlgorithm()
+        core_log = []
+
+        async def upstream(reader, writer):
+            pdu = await recvPDUAsync(reader)
+            self.assertEqual(pdu, ("pullValuesReq", ["v"]))
+            await sendPDUAsync(
+                writer, ("pullValuesRep", [{"name": "v", "value": ("integer", 5)}])
+            )
+            writer.close()
+
+        async def scenario():
+            peer = await asyncio.start_server(upstream, "127.0.0.1", 0)
+            peer_port = peer.sockets[0].getsockname()[1]
+            done = asyncio.Event()
+
+            async def core(reader, writer):
+                core_log.append(await recvPDUAsync(reader))
+                conns = {
+                    "push": [],
+                    "pull": [
+                        {
+                            "localParamName": "in",
+                            "remoteAlgoName": "up",
+                            "remoteParamName": "v",
+                            "address": "127.0.0.1",
+                            "port": peer_port,
+                        }
+                    ],
+                }
+                await sendPDUAsync(writer, ("setConn", conns))
+                core_log.append(await recvPDUAsync(reader))
+                await sendPDUAsync(writer, ("nextCycle", {"timestamp": 0}))
+                core_log.append(await recvPDUAsync(reader))
+                await sendPDUAsync(writer, ("shiftValues", None))
+                core_log.append(await recvPDUAsync(reader))
+                await sendPDUAsync(writer, ("done", None))
+                core_log.append(await recvPDUAsync(reader))
+                writer.close()
+                done.set()
+
+            server = await asyncio.start_server(core, "127.0.0.1", 0)
+            url = "tcp://127.0.0.1:%d" % server.sockets[0].getsockname()[1]
+            agent = AsyncAgent("down", "AsyncAlgorithm", url)
+            with patch("async_agent.create_algorithm_instance", return_value=algo):
+                await asyncio.wait_for(agent.run(), 5)
+            await done.wait()
+            server.close()
+            peer.close()
+            return agent
+
+        agent = asyncio.run(scenario())
+        self.assertEqual(core_log[0][0], "reg")
+        self.assertEqual(core_log[0][1]["algoName"], "down")
+        self.assertEqual([pdu[0] for pdu in core_log[1:]], ["ack"] * 4)
+        self.assertEqual(algo.seen, [{"in": ("integer", 5)}])
+        self.assertEqual(agent.outputs, {"out": ("integer", 2)})
+
+
+class TestCycleDeadline(unittest.TestCase):
+    """
+    test an upstream peer that answers the first pull and then goes silent
+    """
+
+    def run_two_cycles(self, policy):
+        algo = AsyncAlgorithm()
+        core_log = []
+
+        async def upstream(reader, writer):
+            await recvPDUAsync(reader)
+            await sendPDUAsync(
+                writer, ("pullValuesRep", [{"name": "v", "value": ("integer", 5)}])
+            )
+            await reader.read()
+
+        async def scenario():
+            peer = await asyncio.start_server(upstream, "127.0.0.1", 0)
+            peer_port = peer.sockets[0].getsockname()[1]
+
+            async def core(reader, writer):
+                await recvPDUAsync(reader)
+                conns = {
+                    "push": [],
+                    "pull": [
+                        {
+                            "localParamName": "in",
+                            "remoteAlgoName": "up",
+                            "remoteParamName": "v",
+                            "address": "127.0.0.1",
+                            "port": peer_port,
+                        }
+                    ],
+                }
+                await sendPDUAsync(writer, ("setConn", conns))
+                await recvPDUAsync(reader)
+                for _ in range(2):
+                    await sendPDUAsync(writer, ("nextCycle", {"timestamp": 0}))
+                    core_log.append(await recvPDUAsync(reader))
+                    await sendPDUAsync(writer, ("shiftValues", None))
+                    core_log.append(await recvPDUAsync(reader))
+                await sendPDUAsync(writer, ("done", None))
+                await recvPDUAsync(reader)
+                writer.close()
+
+            server = await asyncio.start_server(core, "127.0.0.1", 0)
+            url = "tcp://127.0.0.1:%d" % server.sockets[0].getsockname()[1]
+            config = AgentConfig(cycle_deadline=0.2, stale_policy=policy)
+            agent = AsyncAgent("down", "AsyncAlgorithm", url, config)
+            with patch("async_agent.create_algorithm_instance", return_value=algo):
+                await asyncio.wait_for(agent.run(), 5)
+            server.close()
+            peer.close()
+
+        with patch("async_agent.print_conn_pdu"), patch("builtins.print"):
+            asyncio.run(scenario())
+        return algo, core_log
+
+    def test_stale_policy(self):
+        algo, core_log = self.run_two_cycles("stale")
+        self.assertEqual([pdu[0] for pdu in core_log], ["ack"] * 4)
+        self.assertEqual(algo.seen, [{"in": ("integer", 5)}] * 2)
+        self.assertFalse(is_stale(algo.seen[0]["in"]))
+        self.assertTrue(is_stale(algo.seen[1]["in"]))
+
+    def test_fail_policy(self):
+        algo, core_log = self.run_two_cycles("fail")
+        self.assertEqual([pdu[0] for pdu in core_log], ["ack", "ack", "nack", "ack"])
+        self.assertIn("up missed the 0.2s cycle deadline", core_log[2][1])
+        self.assertEqual(len(algo.seen), 1)
+
+
+class TestDeadlineScope(unittest.TestCase):
+    def test_one_deadline_for_every_exchange(self):
+        async def scenario():
+            config = AgentConfig(cycle_deadline=0.2, push_window=1)
+            agent = AsyncAgent("down", "Algo", "tcp://127.0.0.1:1", config)
+            names = ["a", "b", "c"]
+            agent.peers = {name: (None, MagicMock()) for name in names}
+            window = asyncio.Semaphore(1)
+            late = []
+            deadline = cycle_deadline(config.cycle_deadline)
+
+            async def push(name):
+                async with window:
+                    return await agent.within_deadline(
+                        name, asyncio.sleep(10), late, deadline
+                    )
+
+            started = time.monotonic()
+            await asyncio.gather(*(push(name) for name in names))
+            return time.monotonic() - started, late
+
+        elapsed, late = asyncio.run(scenario())
+        # Not one deadline per round of `push_window` peers
+        self.assertLess(elapsed, 0.35)
+        self.assertEqual(sorted(late), ["a", "b", "c"])
+
+    def test_dropped_peers_reconnect_in_background(self):
+        async def scenario():
+            config = AgentConfig(cycle_deadline=1.0)
+            agent = AsyncAgent("down", "Algo", "tcp://127.0.0.1:1", config)
+            agent.endpoints = {"up": ("127.0.0.1", 1)}
+            connected = asyncio.Event()
+            stream = (None, MagicMock())
+
+            async def connect_stream(addr, port):
+                await connected.wait()
+                return stream
+
+            agent.connect_stream = connect_stream
+            agent.reconnect_peers()
+            self.assertNotIn("up", agent.peers)
+            connected.set()
+            await agent.reconnecting["up"]
+            agent.reconnect_peers()
+            self.assertIs(agent.peers["up"], stream)
+            self.assertEqual(agent.reconnecting, {})
+
+        asyncio.run(scenario())
+
+
+class SlowSecondStep:
+    def __init__(self):
+        self.count = 0
+
+    def run(self, params):
+        self.count += 1
+        if self.count == 2:
+            time.sleep(10)
+        return {"count": ("integer", self.count)}
+
+
+class TestProcessMode(unittest.TestCase):
+    """
+    test steps running in a worker process, one of them past its timeout
+    """
+
+    def setUp(self):
+        register_algorithm("SlowSecondStep", SlowSecondStep)
+
+    def tearDown(self):
+        ALGORITHMS.pop("SlowSecondStep")
+
+    def test_timeout_nacks_and_peers_are_served(self):
+        core_log = []
+        pulled = []
+
+        async def pull(port):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            await sendPDUAsync(writer, ("pullValuesReq", ["count"]))
+            pulled.append(await recvPDUAsync(reader))
+            writer.close()
+
+        async def scenario():
+            async def core(reader, writer):
+                reg = await recvPDUAsync(reader)
+                await sendPDUAsync(writer, ("setConn", {"push": [], "pull": []}))
+                await recvPDUAsync(reader)
+                for cycle in range(3):
+                    await sendPDUAsync(writer, ("nextCycle", {"timestamp": cycle}))
+                    if cycle == 1:
+                        # Answered while the step is still running
+                        await asyncio.wait_for(pull(reg[1]["port"]), 0.2)
+                    core_log.append(await recvPDUAsync(reader))
+                    await sendPDUAsync(writer, ("shiftValues", None))
+                    core_log.append(await recvPDUAsync(reader))
+                await sendPDUAsync(writer, ("done", None))
+                await recvPDUAsync(reader)
+                writer.close()
+
+            server = await asyncio.start_server(core, "127.0.0.1", 0)
+            url = "tcp://127.0.0.1:%d" % server.sockets[0].getsockname()[1]
+            config = AgentConfig(run_mode="process", run_timeout=0.5)
+            agent = AsyncAgent("slow", "SlowSecondStep", url, config)
+            await asyncio.wait_for(agent.run(), 5)
+            server.close()
+            return agent
+
+        with patch("async_agent.print_conn_pdu"), patch("builtins.print"):
+            agent = asyncio.run(scenario())
+        self.assertEqual(
+            [pdu[0] for pdu in core_log], ["ack", "ack", "nack", "ack", "ack", "ack"]
+        )
+        self.assertIn("more than 0.5s", core_log[2][1])
+        self.assertEqual(
+            pulled, [("pullValuesRep", [{"name": "count", "value": ("integer", 1)}])]
+        )
+        # The worker that replaced the stuck one started from fresh state
+        self.assertEqual(agent.outputs, {"count": ("integer", 1)})
+
+
+class CheckpointedCounter(CountingAlgorithm):
+    def export_state(self):
+        return self.count.to_bytes(8, "little")
+
+    def import_state(self, state):
+        self.count = int.from_bytes(state, "little")
+
+
+class TestCheckpoint(unittest.TestCase):
+    """
+    test an agent restarted from its checkpoint when the simulation starts
+    over from timestamp 0
+    """
+
+    def setUp(self):
+        register_algorithm("CheckpointedCounter", CheckpointedCounter)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def tearDown(self):
+        ALGORITHMS.pop("CheckpointedCounter")
+
+    def run_cycles(self, timestamps, run_mode):
+        core_log = []
+
+        async def scenario():
+            async def core(reader, writer):
+                await recvPDUAsync(reader)
+                await sendPDUAsync(writer, ("setConn", {"push": [], "pull": []}))
+                core_log.append(await recvPDUAsync(reader))
+                for timestamp in timestamps:
+                    await sendPDUAsync(writer, ("nextCycle", {"timestamp": timestamp}))
+                    core_log.append(await recvPDUAsync(reader))
+                    await sendPDUAsync(writer, ("shiftValues", None))
+                    core_log.append(await recvPDUAsync(reader))
+                await sendPDUAsync(writer, ("done", None))
+                await recvPDUAsync(reader)
+                writer.close()
+
+            server = await asyncio.start_server(core, "127.0.0.1", 0)
+            url = "tcp://127.0.0.1:%d" % server.sockets[0].getsockname()[1]
+            config = AgentConfig(
+                checkpoint_path=self.path, checkpoint_interval=2, run_mode=run_mode
+            )
+            agent = AsyncAgent("counter", "CheckpointedCounter", url, config)
+            await asyncio.wait_for(agent.run(), 5)
+            server.close()
+            return agent
+
+        with patch("async_agent.print_conn_pdu"), patch("builtins.print"):
+            agent = asyncio.run(scenario())
+        self.assertTrue(all(pdu[0] == "ack" for pdu in core_log))
+        return agent
+
+    def test_restart(self):
+        for run_mode in ("inline", "process"):
+            with self.subTest(run_mode=run_mode):
+                self.path = os.path.join(self.directory, run_mode + "-{agent}.ckpt")
+                # Snapshots after the 2nd and 4th cycles, at timestamps 1 and 3
+                agent = self.run_cycles(range(5), run_mode)
+                self.assertEqual(agent.outputs, {"out": ("integer", 5)})
+                # Timestamps 0 to 3 are acknowledged without running, peers
+                # get the outputs of the snapshot meanwhile
+                agent = self.run_cycles(range(4), run_mode)
+                self.assertEqual(agent.outputs, {"out": ("integer", 4)})
+                # and the count carries on from the snapshot
+                agent = self.run_cycles(range(6), run_mode)
+                self.assertEqual(agent.outputs, {"out": ("integer", 6)})
+
+
+class TestWireCodec(unittest.TestCase):
+    def test_negotiated_with_peer(self):
+        async def scenario():
+            upstream = AsyncAgent("up", "Algo", "tcp://127.0.0.1:1")
+            upstream.outputs = {"p": ("real", 0.5)}
+            port = await upstream.start_server()
+            config = AgentConfig(wire_codec="uper,oer")
+            agent = AsyncAgent("down", "Algo", "tcp://127.0.0.1:1", config)
+            reader, writer = await agent.connect_stream("127.0.0.1", port)
+            agent.peers["up"] = (reader, writer)
+            pull = {
+                "localParamName": "x",
+                "remoteAlgoName": "up",
+                "remoteParamName": "p",
+                "address": "127.0.0.1",
+                "port": port,
+            }
+            plan = CyclePlan({"pull": [pull], "push": []})
+            try:
+                return codecOf(writer), await agent.pull_from("up", plan)
+            finally:
+                agent.close()
+                upstream.close()
+
+        codec, values = asyncio.run(scenario())
+        self.assertEqual(codec, "uper")
+        self.assertEqual(values, {"x": ("real", 0.5)})
+
+
+class TestUnixSocket(unittest.TestCase):
+    def scenario(self, directory, mode=0o700):
+        async def scenario():
+            config = AgentConfig(unix_socket_dir=directory)
+            upstream = AsyncAgent("up", "Algo", "tcp://127.0.0.1:1", config)
+            upstream.outputs = {"p": ("real", 0.5)}
+            port = await upstream.start_server()
+            path = upstream.unix_path
+            os.chmod(directory, mode)
+            agent = AsyncAgent("down", "Algo", "tcp://127.0.0.1:1", config)
+            reader, writer = await agent.connect_stream("127.0.0.1", port)
+            agent.peers["up"] = (reader, writer)
+            pull = {
+                "localParamName": "x",
+                "remoteAlgoName": "up",
+                "remoteParamName": "p",
+                "address": "127.0.0.1",
+                "port": port,
+            }
+            plan = CyclePlan({"pull": [pull], "push": []})
+            try:
+                family = writer.get_extra_info("socket").family
+                return family, await agent.pull_from("up", plan), path
+            finally:
+                agent.close()
+                upstream.close()
+
+        return asyncio.run(scenario())
+
+    def test_local_peer_over_unix_socket(self):
+        with tempfile.TemporaryDirectory() as directory:
+            family, values, path = self.scenario(directory)
+            self.assertEqual(family, socket.AF_UNIX)
+            self.assertEqual(values, {"x": ("real", 0.5)})
+            self.assertFalse(os.path.exists(path))
+
+    def test_shared_directory_is_not_trusted(self):
+        # Others could have put their own socket there: over TCP
+        with tempfile.TemporaryDirectory() as directory:
+            family, values, _ = self.scenario(directory, 0o755)
+            self.assertEqual(family, socket.AF_INET)
+            self.assertEqual(values, {"x": ("real", 0.5)})
+
+
+class TestAgentHost(unittest.TestCase):
+    """
+    test two co-hosted instances exchanging values in memory
+    """
+
+    def setUp(self):
+        self.algos = {}
+
+        def factory(name):
+            def create():
+                self.algos[name] = CountingAlgorithm()
+                return self.algos[name]
+
+            return create
+
+        register_algorithm("HostProducer", factory("producer"))
+        register_algorithm("HostConsumer", factory("consumer"))
+
+    def tearDown(self):
+        ALGORITHMS.pop("HostProducer")
+        ALGORITHMS.pop("HostConsumer")
+
+    @patch("async_agent.print_conn_pdu")
+    def test_cycles_between_cohosted_instances(self, mock_print_conn_pdu):
+        async def scenario():
+            registered = {}
+            all_registered = asyncio.Event()
+
+            async def core(reader, writer):
+                reg = await recvPDUAsync(reader)
+                registered[reg[1]["algoName"]] = (reader, writer, reg[1]["port"])
+                if len(registered) == 2:
+                    all_registered.set()
+
+            server = await asyncio.start_server(core, "127.0.0.1", 0)
+            url = "tcp://127.0.0.1:%d" % server.sockets[0].getsockname()[1]
+            host = AgentHost([("prod", "HostProducer"), ("cons", "HostConsumer")], url)
+            running = asyncio.ensure_future(host.run())
+            await asyncio.wait_for(all_registered.wait(), 5)
+
+            def conn(local, remote_algo, remote):
+                return {
+                    "localParamName": local,
+                    "remoteAlgoName": remote_algo,
+                    "remoteParamName": remote,
+                    "address": "127.0.0.1",
+                    "port": registered[remote_algo][2],
+                }
+
+            setups = {
+                "prod": {"push": [conn("out", "cons", "pushed")], "pull": []},
+                "cons": {"push": [], "pull": [conn("pulled", "prod", "out")]},
+            }
+
+            async def all_send(pdu):
+                for name, (reader, writer, _) in registered.items():
+                    await sendPDUAsync(writer, pdu)
+                for name, (reader, writer, _) in registered.items():
+                    self.assertEqual(await recvPDUAsync(reader), ("ack", None))
+
+            for name, (reader, writer, _) in registered.items():
+                await sendPDUAsync(writer, ("setConn", setups[name]))
+            for reader, writer, _ in registered.values():
+                self.assertEqual(await recvPDUAsync(reader), ("ack", None))
+            for timestamp in range(2):
+                await all_send(("nextCycle", {"timestamp": timestamp}))
+                await all_send(("shiftValues", None))
+            await all_send(("done", None))
+            await asyncio.wait_for(running, 5)
+            server.close()
+            return host
+
+        host = asyncio.run(scenario())
+        producer, consumer = host.agents
+        self.assertEqual(consumer.local_peers, {"prod": producer})
+        self.assertEqual(producer.local_peers, {"cons": consumer})
+        self.assertEqual(consumer.peers, {})
+        self.assertEqual(producer.peers, {})
+        self.assertEqual(
+            self.algos["consumer"].seen,
+            [{}, {"pulled": ("integer", 1), "pushed": ("integer", 1)}],
+        )
+
+    def test_remote_addresses_are_not_short_circuited(self):
+        host = AgentHost([("a", "HostProducer")], "tcp://127.0.0.1:1")
+        host.ports = {4000: host.agents[0]}
+        self.assertIs(host.local_agent("127.0.0.1", 4000), host.agents[0])
+        self.assertIsNone(host.local_agent("127.0.0.1", 4001))
+        self.assertIsNone(host.local_agent("192.0.2.1", 4000))
+
+
+class TestParseInstances(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(
+            parse_instances(["a:ConsumerAlgorithm", "b:Other"]),
+            [("a", "ConsumerAlgorithm"), ("b", "Other")],
+        )
+
+    def test_invalid(self):
+        for specs in (["a"], [":C"], ["a:"], ["a:C", "a:D"]):
+            with self.assertRaises(ValueError):
+                parse_instances(specs)
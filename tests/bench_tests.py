@@ -0,0 +1,31 @@
+import unittest
+
+from benchmarks.codec_bench import SAMPLES, run_codec_benchmark
+from benchmarks.cycle_bench import run_benchmark, topology_edges
+
+
+class TestCycleBenchmark(unittest.TestCase):
+    def test_topologies(self):
+        self.assertEqual(topology_edges("chain", 3), [(0, 1), (1, 2)])
+        self.assertEqual(topology_edges("fan-in", 3), [(1, 0), (2, 0)])
+        self.assertEqual(topology_edges("fan-out", 3), [(0, 1), (0, 2)])
+        self.assertEqual(len(topology_edges("mesh", 4)), 12)
+
+    def test_end_to_end_with_real_agents(self):
+        # A few real cycles against the stand-in core, in both modes
+        for mode in ("pull", "push"):
+            result = run_benchmark("mesh", 3, "blob1k", mode, cycles=5, warmup=1)
+            self.assertEqual(result["cycles"], 5)
+            self.assertGreater(result["cycles_per_sec"], 0)
+            self.assertLessEqual(
+                result["latency_ms"]["p50"], result["latency_ms"]["max"]
+            )
+
+
+class TestCodecBenchmark(unittest.TestCase):
+    def test_every_pdu_in_every_codec(self):
+        results = run_codec_benchmark(("der", "oer"), number=1)
+        self.assertEqual(len(results), 2 * len(SAMPLES))
+        sizes = {(r["pdu"], r["codec"]): r["bytes"] for r in results}
+        self.assertLess(sizes["ack", "oer"], sizes["ack", "der"])
+        self.assertGreater(results[0]["encode_us"], 0)
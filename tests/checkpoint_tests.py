@@ -0,0 +1,121 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+
+from checkpoint import (
+    SNAPSHOT_SLOT,
+    Checkpointer,
+    Snapshot,
+    SnapshotFile,
+    encode_outputs,
+    restore_checkpoint,
+    slot_offset,
+    supports_checkpoint,
+)
+
+
+class Counter:
+    def __init__(self):
+        self.count = 0
+
+    def run(self, params):
+        self.count += 1
+        return {}
+
+    def export_state(self):
+        return self.count.to_bytes(8, "little")
+
+    def import_state(self, state):
+        if len(state) != 8:
+            raise ValueError("bad state")
+        self.count = int.from_bytes(state, "little")
+
+
+class CheckpointTestCase(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "agent.ckpt")
+
+    def open(self):
+        snapshots = SnapshotFile(self.path)
+        self.addCleanup(snapshots.close)
+        return snapshots
+
+
+class TestSnapshotFile(CheckpointTestCase):
+    def test_round_trip(self):
+        snapshots = self.open()
+        self.assertIsNone(snapshots.read())
+        outputs = {"s": ("integer", 7), "b": ("blob", b"\x00\x01")}
+        snapshots.write(10, 9, b"state", encode_outputs(outputs))
+        self.assertEqual(snapshots.read(), Snapshot(10, 9, b"state", outputs))
+        snapshots.close()
+        self.assertEqual(self.open().read(), Snapshot(10, 9, b"state", outputs))
+
+    def test_torn_write_keeps_previous_snapshot(self):
+        snapshots = self.open()
+        snapshots.write(1, 0, b"first", b"")
+        snapshots.write(2, 1, b"second", b"")
+        self.assertEqual(snapshots.read().state, b"second")
+        # A crash in the middle of writing the data of the second slot
+        offset = SNAPSHOT_SLOT.unpack_from(snapshots.map, slot_offset(1))[3]
+        snapshots.map[offset] ^= 0xFF
+        self.assertEqual(snapshots.read(), Snapshot(1, 0, b"first", {}))
+        # The slot of the oldest snapshot is the next one overwritten
+        snapshots.write(3, 2, b"third", b"")
+        snapshots.map[offset] ^= 0xFF
+        self.assertEqual(snapshots.read().state, b"third")
+
+    def test_growing_snapshots(self):
+        snapshots = self.open()
+        for cycle, size in enumerate((10, 1024 * 1024, 20, 3 * 1024 * 1024), 1):
+            state = os.urandom(size)
+            snapshots.write(cycle, cycle, state, b"")
+            self.assertEqual(snapshots.read(), Snapshot(cycle, cycle, state, {}))
+        snapshots.close()
+        self.assertEqual(self.open().read().cycle, 4)
+
+    def test_not_a_checkpoint_file(self):
+        with open(self.path, "wb") as f:
+            f.write(b"not a checkpoint")
+        with self.assertRaisesRegex(ValueError, "not a checkpoint file"):
+            SnapshotFile(self.path)
+
+
+class TestCheckpointer(CheckpointTestCase):
+    def test_background_writes(self):
+        checkpointer = Checkpointer(self.path, interval=5)
+        self.assertFalse(checkpointer.due(4))
+        self.assertTrue(checkpointer.due(10))
+        for cycle in range(1, 4):
+            checkpointer.save(
+                cycle, cycle * 10, b"%d" % cycle, {"c": ("integer", cycle)}
+            )
+        # Closing writes the last snapshot saved
+        checkpointer.close()
+        self.assertEqual(
+            self.open().read(), Snapshot(3, 30, b"3", {"c": ("integer", 3)})
+        )
+        with self.assertRaises(ValueError):
+            Checkpointer(self.path, interval=0)
+
+    def test_restore(self):
+        checkpointer = Checkpointer(self.path)
+        self.addCleanup(checkpointer.close)
+        algo = Counter()
+        self.assertIsNone(restore_checkpoint(checkpointer, algo))
+        checkpointer.file.write(5, 4, (5).to_bytes(8, "little"), b"")
+        self.assertEqual(restore_checkpoint(checkpointer, algo).timestamp, 4)
+        self.assertEqual(algo.count, 5)
+        checkpointer.file.write(6, 5, b"short", b"")
+        with self.assertRaisesRegex(RuntimeError, "cycle 6: bad state"):
+            restore_checkpoint(checkpointer, algo)
+
+    def test_supports_checkpoint(self):
+        self.assertTrue(supports_checkpoint(Counter()))
+        self.assertFalse(supports_checkpoint(object()))
+        self.assertFalse(supports_checkpoint(MagicMock()))
+        runner = MagicMock(checkpointable=True)
+        self.assertTrue(supports_checkpoint(runner))
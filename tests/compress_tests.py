@@ -0,0 +1,210 @@
+import os
+import socket
+import unittest
+from unittest.mock import patch
+
+from agent import push_values
+
+from compress import (
+    BACKOFF_VALUES,
+    CODEC_OIDS,
+    PROBE_VALUES,
+    Compressor,
+    compress_data,
+    decompress_value,
+    decompress_values,
+    is_compressed,
+)
+from config import AgentConfig
+from plan import CyclePlan
+from protocol import (
+    PEER_FEATURES,
+    answerCodecRequest,
+    codecRequest,
+    negotiateCodec,
+    recvPDU,
+    sendPDU,
+)
+from responder import DataResponder, answer_pdu
+
+REMOTE = "192.0.2.1"
+TELEMETRY = b"temperature=21.5;pressure=101.3;" * 1000
+
+
+def variables(value):
+    return [{"name": "v", "value": value}]
+
+
+class TestCompressor(unittest.TestCase):
+    def test_round_trip_every_codec(self):
+        values = [
+            ("blob", TELEMETRY),
+            ("custom", {"type": "1.2.3.4", "data": TELEMETRY}),
+        ]
+        for codec in CODEC_OIDS:
+            compressor = Compressor(codec, threshold=1024)
+            compressor.add_peer("P", REMOTE)
+            for value in values:
+                packed = compressor.pack("P", variables(value))[0]["value"]
+                self.assertTrue(is_compressed(packed), codec)
+                self.assertEqual(packed[1]["type"], CODEC_OIDS[codec])
+                self.assertLess(len(packed[1]["data"]), len(TELEMETRY) / 10)
+                self.assertEqual(decompress_value(packed), value)
+
+    def test_small_values_and_local_peers_left_alone(self):
+        compressor = Compressor(threshold=1024)
+        compressor.add_peer("remote", REMOTE)
+        compressor.add_peer("local", "127.0.0.1")
+        small = variables(("blob", b"x" * 100))
+        self.assertIs(compressor.pack("remote", small), small)
+        large = variables(("blob", TELEMETRY))
+        self.assertIs(compressor.pack("local", large), large)
+        self.assertIs(compressor.pack("unknown", large), large)
+        mixed = small + [{"name": "i", "value": ("integer", 1)}]
+        self.assertIs(compressor.pack("remote", mixed), mixed)
+
+    def test_value_sent_to_several_peers_compressed_once(self):
+        compressor = Compressor(threshold=1024)
+        compressor.add_peer("A", REMOTE)
+        compressor.add_peer("B", REMOTE)
+        large = variables(("blob", TELEMETRY))
+        with patch("compress.compress_data", wraps=compress_data) as z:
+            first = compressor.pack("A", large)
+            second = compressor.pack("B", large)
+        self.assertEqual(z.call_count, 1)
+        self.assertIs(first[0]["value"], second[0]["value"])
+
+    def test_adaptive_backs_off_for_incompressible_data(self):
+        compressor = Compressor(threshold=1024)
+        compressor.add_peer("P", REMOTE)
+
+        def send():
+            value = ("blob", os.urandom(4096))
+            return is_compressed(compressor.pack("P", variables(value))[0]["value"])
+
+        self.assertTrue(all(send() for _ in range(PROBE_VALUES)))
+        self.assertFalse(any(send() for _ in range(BACKOFF_VALUES)))
+        # Probing again
+        self.assertTrue(send())
+
+    def test_non_adaptive_always_compresses(self):
+        compressor = Compressor(threshold=1024, adaptive=False)
+        compressor.add_peer("P", REMOTE)
+        for _ in range(PROBE_VALUES * 2):
+            value = ("blob", os.urandom(2048))
+            packed = compressor.pack("P", variables(value))[0]["value"]
+            self.assertTrue(is_compressed(packed))
+
+    def test_decompressed_size_is_limited(self):
+        compressor = Compressor(threshold=1)
+        compressor.add_peer("P", REMOTE)
+        bomb = compressor.pack("P", variables(("blob", bytes(1 << 20))))[0]["value"]
+        with patch("protocol.max_frame_size", 1024):
+            with self.assertRaises(RuntimeError):
+                decompress_value(bomb)
+
+    def test_decompress_values(self):
+        params = {"a": ("integer", 1)}
+        self.assertIs(decompress_values(params), params)
+        compressor = Compressor(threshold=1)
+        compressor.add_peer("P", REMOTE)
+        packed = compressor.pack("P", variables(("blob", b"abc")))[0]["value"]
+        self.assertEqual(
+            decompress_values({"a": ("integer", 1), "b": packed}),
+            {"a": ("integer", 1), "b": ("blob", b"abc")},
+        )
+
+    def test_unknown_codec(self):
+        with self.assertRaises(ValueError):
+            Compressor("snappy")
+
+
+class TestReceiving(unittest.TestCase):
+    def test_pushed_values_are_decompressed(self):
+        compressor = Compressor(threshold=1)
+        compressor.add_peer("P", REMOTE)
+        inputs = {}
+        packed = compressor.pack("P", variables(("blob", TELEMETRY)))
+        self.assertEqual(answer_pdu(("pushValues", packed), {}, inputs), ("ack", None))
+        self.assertEqual(inputs, {"v": ("blob", TELEMETRY)})
+
+    def test_corrupt_value_is_nacked(self):
+        inputs = {}
+        corrupt = ("custom", {"type": CODEC_OIDS["zlib"], "data": b"not zlib"})
+        status = answer_pdu(("pushValues", variables(corrupt)), {}, inputs)
+        self.assertEqual(status[0], "nack")
+        self.assertEqual(inputs, {})
+
+
+class TestNegotiation(unittest.TestCase):
+    # Peers that do not know the compression OIDs (C++ agents, agents
+    # predating negotiation) never get compressed values
+    def socketpair(self):
+        client, server = socket.socketpair()
+        self.addCleanup(client.close)
+        self.addCleanup(server.close)
+        return client, server
+
+    def push(self, reply):
+        client, server = self.socketpair()
+        sendPDU(server, reply)
+        negotiateCodec(client, ["der"], PEER_FEATURES)
+        recvPDU(server)
+        compressor = Compressor(threshold=1)
+        compressor.add_peer("P", REMOTE)
+        push = {
+            "localParamName": "v",
+            "remoteAlgoName": "P",
+            "remoteParamName": "v",
+            "address": REMOTE,
+            "port": 1,
+        }
+        plan = CyclePlan({"push": [push], "pull": []})
+        sendPDU(server, ("ack", None))
+        push_values(
+            {"P": client},
+            plan,
+            {"v": ("blob", TELEMETRY)},
+            8,
+            None,
+            compressor=compressor,
+        )
+        return recvPDU(server)[1][0]["value"]
+
+    def test_push_to_peer_without_compression(self):
+        # What a responder predating negotiation answers
+        self.assertEqual(self.push(("pullValuesRep", [])), ("blob", TELEMETRY))
+
+    def test_push_to_peer_with_compression(self):
+        reply, _, _ = answerCodecRequest(codecRequest(["der"], PEER_FEATURES))
+        self.assertTrue(is_compressed(self.push(reply)))
+
+    @patch("compress.is_local_address", return_value=False)
+    def test_replies(self, mock_is_local_address):
+        listen_sock = socket.create_server(("127.0.0.1", 0))
+        self.addCleanup(listen_sock.close)
+        responder = DataResponder(listen_sock, compressor=Compressor(threshold=1))
+        responder.start()
+        self.addCleanup(responder.stop)
+        responder.publish({"v": ("blob", TELEMETRY)})
+
+        def pull(features):
+            sock = socket.create_connection(listen_sock.getsockname())
+            self.addCleanup(sock.close)
+            if features is not None:
+                negotiateCodec(sock, ["der"], features)
+            sendPDU(sock, ("pullValuesReq", ["v"]))
+            return recvPDU(sock)[1][0]["value"]
+
+        self.assertEqual(pull(None), ("blob", TELEMETRY))
+        self.assertEqual(pull(()), ("blob", TELEMETRY))
+        self.assertTrue(is_compressed(pull(PEER_FEATURES)))
+
+
+class TestConfig(unittest.TestCase):
+    def test_from_env(self):
+        config = AgentConfig.from_env(
+            {"SMM3NG_COMPRESSION": "lzma", "SMM3NG_COMPRESSION_ADAPTIVE": "off"}
+        )
+        self.assertEqual(config.compression, "lzma")
+        self.assertFalse(config.compression_adaptive)
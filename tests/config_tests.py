@@ -0,0 +1,16 @@
+import unittest
+
+from config import AgentConfig
+
+
+class TestAgentConfig(unittest.TestCase):
+    def test_defaults_without_environment(self):
+        self.assertEqual(AgentConfig.from_env({}), AgentConfig())
+
+    def test_values_from_environment(self):
+        config = AgentConfig.from_env({"SMM3NG_PUSH_WINDOW": "4"})
+        self.assertEqual(config.push_window, 4)
+
+    def test_invalid_value(self):
+        with self.assertRaises(ValueError):
+            AgentConfig.from_env({"SMM3NG_PUSH_WINDOW": "many"})
@@ -0,0 +1,109 @@
+import array
+import unittest
+
+from custom import (
+    CODECS,
+    FLOAT64_VECTOR_OID,
+    INT64_VECTOR_OID,
+    LazyCustom,
+    from_algorithm,
+    register_codec,
+    register_record,
+    to_algorithm,
+    unregister_codec,
+)
+from deadline import StaleValue, is_stale
+from protocol import decodePDU, encodePDU
+
+POSE_OID = "1.3.6.1.4.1.54321.99.1"
+
+
+def wire(outputs):
+    # What the peer receives for the encoded outputs
+    pdu = ("pushValues", [{"name": n, "value": v} for n, v in outputs.items()])
+    return {var["name"]: var["value"] for var in decodePDU(encodePDU(pdu))[1]}
+
+
+class TestVectors(unittest.TestCase):
+    def test_round_trip(self):
+        outputs = from_algorithm(
+            {
+                "xs": array.array("d", [0.5, -1.0, 1e300]),
+                "ids": array.array("q", [1, -2, 2**62]),
+                "n": ("integer", 3),
+            }
+        )
+        self.assertEqual(outputs["xs"][1]["type"], FLOAT64_VECTOR_OID)
+        self.assertEqual(outputs["ids"][1]["type"], INT64_VECTOR_OID)
+        self.assertEqual(len(outputs["xs"][1]["data"]), 24)
+        self.assertEqual(outputs["n"], ("integer", 3))
+        inputs = to_algorithm(wire(outputs))
+        self.assertEqual(inputs["xs"], array.array("d", [0.5, -1.0, 1e300]))
+        self.assertEqual(inputs["ids"], array.array("q", [1, -2, 2**62]))
+        self.assertEqual(inputs["n"], ("integer", 3))
+
+    def test_untouched_values(self):
+        params = {
+            "other": ("custom", {"type": "1.2.3", "data": b"\x01"}),
+            "blob": ("blob", b"\x01"),
+            "floats": array.array("f", [1.0]),
+        }
+        self.assertEqual(to_algorithm(params), params)
+        self.assertIsNot(to_algorithm(params), params)
+        self.assertIs(from_algorithm(params), params)
+
+    def test_malformed_vector(self):
+        params = {"xs": ("custom", {"type": FLOAT64_VECTOR_OID, "data": b"\x00" * 7})}
+        with self.assertRaisesRegex(ValueError, "cannot decode xs"):
+            to_algorithm(params)
+
+    def test_stale_values_are_decoded(self):
+        value = from_algorithm({"xs": array.array("d", [1.0])})["xs"]
+        inputs = to_algorithm({"xs": StaleValue(value)})
+        # Still flagged as stale once decoded
+        self.assertTrue(is_stale(inputs["xs"]))
+        self.assertEqual(inputs["xs"].value, array.array("d", [1.0]))
+        fresh = to_algorithm({"xs": value})
+        self.assertFalse(is_stale(fresh["xs"]))
+
+
+class TestRecords(unittest.TestCase):
+    def setUp(self):
+        self.Pose = register_record(
+            POSE_OID, "Pose", [("x", "d"), ("y", "d"), ("id", "q"), ("ok", "?")]
+        )
+        self.addCleanup(unregister_codec, POSE_OID)
+
+    def test_round_trip(self):
+        outputs = from_algorithm({"pose": self.Pose(1.5, -2.0, 7, True)})
+        self.assertEqual(outputs["pose"][1]["type"], POSE_OID)
+        self.assertEqual(len(outputs["pose"][1]["data"]), 25)
+        pose = to_algorithm(wire(outputs))["pose"]
+        self.assertEqual(pose, self.Pose(1.5, -2.0, 7, True))
+        self.assertEqual(pose.id, 7)
+        with self.assertRaisesRegex(ValueError, "cannot encode pose"):
+            from_algorithm({"pose": self.Pose("a", 0.0, 0, False)})
+
+    def test_lazy_decode(self):
+        decoded = []
+
+        def decode(data):
+            decoded.append(data)
+            return data.upper()
+
+        register_codec(POSE_OID, bytes, decode, lazy=True)
+        params = {"p": ("custom", {"type": POSE_OID, "data": b"abc"})}
+        value = to_algorithm(params)["p"]
+        self.assertIsInstance(value, LazyCustom)
+        # Forwarded unchanged, without being decoded
+        self.assertEqual(from_algorithm({"q": value})["q"], params["p"])
+        self.assertEqual(decoded, [])
+        self.assertEqual(value.value, b"ABC")
+        self.assertEqual(value.value, b"ABC")
+        self.assertEqual(decoded, [b"abc"])
+
+    def test_register_again_replaces(self):
+        register_codec(POSE_OID, bytes, bytes)
+        self.assertEqual(CODECS[POSE_OID].types, ())
+        outputs = {"pose": self.Pose(1.0, 2.0, 3, False)}
+        self.assertIs(from_algorithm(outputs), outputs)
@@ -0,0 +1,49 @@
+import time
+import unittest
+
+from deadline import (
+    LastValues,
+    StaleValue,
+    check_policy,
+    cycle_deadline,
+    is_stale,
+    late_reason,
+    remaining,
+)
+
+
+class TestDeadline(unittest.TestCase):
+    def test_cycle_deadline(self):
+        self.assertIsNone(cycle_deadline(0))
+        deadline = cycle_deadline(0.5)
+        self.assertGreater(deadline, time.monotonic())
+        self.assertLessEqual(remaining(deadline), 0.5)
+        # A passed deadline still gives a positive socket timeout
+        self.assertGreater(remaining(time.monotonic() - 1), 0)
+
+    def test_check_policy(self):
+        check_policy("stale")
+        check_policy("fail")
+        with self.assertRaises(ValueError):
+            check_policy("ignore")
+
+    def test_stale_inputs(self):
+        last = LastValues()
+        pull_groups = {"A": {"p": ["x", "y"]}, "B": {"p": ["z"]}}
+        self.assertEqual(last.stale_inputs(pull_groups, ["A"]), {})
+
+        last.update({"x": ("integer", 1), "y": ("integer", 1), "z": ("real", 1.0)})
+        stale = last.stale_inputs(pull_groups, ["A"])
+        self.assertEqual(stale, {"x": ("integer", 1), "y": ("integer", 1)})
+        self.assertTrue(all(is_stale(value) for value in stale.values()))
+        self.assertFalse(is_stale(("integer", 1)))
+
+        # Stale values never replace the last value actually received
+        last.update({"x": StaleValue(("integer", 0)), "z": ("real", 2.0)})
+        self.assertEqual(last.values["x"], ("integer", 1))
+        self.assertEqual(last.values["z"], ("real", 2.0))
+
+    def test_late_reason(self):
+        self.assertEqual(
+            late_reason(["B", "A"], 0.5), "A, B missed the 0.5s cycle deadline"
+        )
@@ -0,0 +1,44 @@
+import unittest
+
+from delta import DeltaPush, InputCache, same_value
+
+
+class TestDelta(unittest.TestCase):
+    def test_same_value(self):
+        self.assertTrue(same_value(("integer", 1), ("integer", 1)))
+        self.assertTrue(same_value(("blob", b"ab"), ("blob", b"ab")))
+        self.assertFalse(same_value(None, ("integer", 1)))
+        self.assertFalse(same_value(("integer", 1), ("real", 1.0)))
+        self.assertFalse(same_value(("real", 0.0), ("real", -0.0)))
+        self.assertFalse(same_value(("real", float("nan")), ("real", float("nan"))))
+
+    def test_changed_only_after_ack(self):
+        delta = DeltaPush()
+        variables = [{"name": "a", "value": ("integer", 1)}]
+        self.assertEqual(delta.changed("P", variables), variables)
+        self.assertEqual(delta.changed("P", variables), variables)
+        delta.ack("P", variables)
+        self.assertEqual(delta.changed("P", variables), [])
+        self.assertEqual(delta.changed("Q", variables), variables)
+        delta.forget("P")
+        self.assertEqual(delta.changed("P", variables), variables)
+
+    def test_refresh(self):
+        delta = DeltaPush(refresh=2)
+        variables = [{"name": "a", "value": ("integer", 1)}]
+        delta.start_cycle()
+        delta.ack("P", variables)
+        self.assertEqual(delta.changed("P", variables), [])
+        delta.start_cycle()
+        self.assertEqual(delta.changed("P", variables), variables)
+
+    def test_input_cache_keeps_last_values(self):
+        cache = InputCache()
+        self.assertEqual(
+            cache.merge({"a": ("integer", 1), "b": ("integer", 2)}),
+            {"a": ("integer", 1), "b": ("integer", 2)},
+        )
+        merged = cache.merge({"b": ("integer", 3)})
+        self.assertEqual(merged, {"a": ("integer", 1), "b": ("integer", 3)})
+        merged["a"] = ("integer", 0)
+        self.assertEqual(cache.merge({})["a"], ("integer", 1))
@@ -0,0 +1,163 @@
+import math
+import random
+import unittest
+
+import fastcodec
+from protocol import asn1_compiler
+
+INTEGERS = [0, 1, -1, 127, 128, -128, -129, 255, 256, 2**31, -(2**63), 2**200, -(2**70)]
+REALS = [
+    0.0,
+    -0.0,
+    1.0,
+    -1.0,
+    0.5,
+    1.5,
+    -2.75,
+    3.141592653589793,
+    1e-300,
+    -1e300,
+    5e-324,
+    1.7976931348623157e308,
+    math.inf,
+    -math.inf,
+]
+
+
+def generic(pdu):
+    return asn1_compiler.encode("SMM3NG-PDU", pdu)
+
+
+class TestFastCodec(unittest.TestCase):
+    """
+    the fast path must produce exactly the bytes of the generic DER codec
+    and decode them to the same values
+    """
+
+    def assertSameAsGeneric(self, pdu):
+        encoded = fastcodec.encode(pdu)
+        self.assertIsNotNone(encoded, pdu)
+        self.assertEqual(encoded, generic(pdu), pdu)
+        decoded = fastcodec.decode(encoded)
+        self.assertEqual(decoded, asn1_compiler.decode("SMM3NG-PDU", encoded), pdu)
+        self.assertEqual(decoded, pdu)
+        # Receive buffers hand out memoryviews
+        self.assertEqual(fastcodec.decode(memoryview(encoded)), pdu)
+
+    def test_null_pdus(self):
+        for choice in ("ack", "shiftValues", "done"):
+            self.assertSameAsGeneric((choice, None))
+
+    def test_next_cycle(self):
+        for timestamp in INTEGERS:
+            self.assertSameAsGeneric(("nextCycle", {"timestamp": timestamp}))
+
+    def test_integer_variables(self):
+        for number in INTEGERS:
+            self.assertSameAsGeneric(
+                ("pushValues", [{"name": "x", "value": ("integer", number)}])
+            )
+
+    def test_boolean_variables(self):
+        for flag in (True, False):
+            self.assertSameAsGeneric(
+                ("pullValuesRep", [{"name": "flag", "value": ("boolean", flag)}])
+            )
+
+    def test_real_variables(self):
+        for number in REALS:
+            self.assertSameAsGeneric(
+                ("pushValues", [{"name": "r", "value": ("real", number)}])
+            )
+
+    def test_random_mixed_variables(self):
+        rng = random.Random(42)
+        for _ in range(300):
+            variables = []
+            for i in range(rng.randint(0, 40)):
+                kind = rng.choice(["integer", "boolean", "real"])
+                if kind == "integer":
+                    value = rng.randint(-(2**70), 2**70)
+                elif kind == "boolean":
+                    value = rng.random() < 0.5
+                else:
+                    value = rng.uniform(-1e6, 1e6) * 10 ** rng.randint(-200, 200)
+                variables.append({"name": f"v{i}", "value": (kind, value)})
+            choice = rng.choice(["pushValues", "pullValuesRep"])
+            self.assertSameAsGeneric((choice, variables))
+
+    def test_custom_variables(self):
+        for oid, data in [
+            ("1.3.6.1.4.1.54321.1.1", b""),
+            ("1.2.840.113549", b"abc"),
+            ("2.5.4.3", b"\x00" * 70000),
+            ("0.39", b"x"),
+        ]:
+            self.assertSameAsGeneric(
+                (
+                    "pushValues",
+                    [
+                        {"name": "c", "value": ("custom", {"type": oid, "data": data})},
+                        {"name": "i", "value": ("integer", 1)},
+                    ],
+                )
+            )
+        # Invalid OIDs are left to the generic encoder to reject
+        for oid in ("1", "3.1", "1.40", "1.x", "1..2"):
+            self.assertIsNone(
+                fastcodec.encode(
+                    (
+                        "pushValues",
+                        [
+                            {
+                                "name": "c",
+                                "value": ("custom", {"type": oid, "data": b""}),
+                            }
+                        ],
+                    )
+                ),
+                oid,
+            )
+
+    def test_long_lengths(self):
+        variables = [{"name": "n" * 300, "value": ("integer", i)} for i in range(500)]
+        self.assertSameAsGeneric(("pushValues", variables))
+
+    def test_other_pdus_fall_back(self):
+        for pdu in [
+            ("nack", "reason"),
+            ("reg", {"algoName": "a", "className": "b", "port": 1}),
+            ("pullValuesReq", ["a"]),
+            ("pushValues", [{"name": "b", "value": ("blob", b"x")}]),
+            ("pushValues", [{"name": "s", "value": ("str", "x")}]),
+        ]:
+            self.assertIsNone(fastcodec.encode(pdu), pdu)
+            self.assertIsNone(fastcodec.decode(generic(pdu)), pdu)
+        # NaN is encoded on the fast path, decoded by the generic codec
+        nan_pdu = ("pushValues", [{"name": "n", "value": ("real", math.nan)}])
+        self.assertEqual(fastcodec.encode(nan_pdu), generic(nan_pdu))
+        self.assertIsNone(fastcodec.decode(generic(nan_pdu)))
+        # Python ints given as REAL are left to the generic encoder
+        self.assertIsNone(
+            fastcodec.encode(("pushValues", [{"name": "i", "value": ("real", 1)}]))
+        )
+
+    def test_cached_names(self):
+        pdu = ("pushValues", [{"name": "cached", "value": ("integer", 1)}])
+        for _ in range(2):
+            self.assertSameAsGeneric(pdu)
+        for name in ("caché", b"cached", None):
+            self.assertIsNone(
+                fastcodec.encode(
+                    ("pushValues", [{"name": name, "value": ("integer", 1)}])
+                )
+            )
+
+    def test_empty_variable_sets(self):
+        for choice in ("pushValues", "pullValuesRep"):
+            self.assertSameAsGeneric((choice, []))
+
+    def test_malformed_input_falls_back(self):
+        encoded = generic(("pushValues", [{"name": "x", "value": ("integer", 5)}]))
+        for data in [b"", b"\x80", encoded[:-1], encoded + b"\x00", b"\xa6\x00"]:
+            self.assertIsNone(fastcodec.decode(data), data)
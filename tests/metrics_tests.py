@@ -0,0 +1,148 @@
+import os
+import socket
+import tempfile
+import unittest
+
+import protocol
+from config import AgentConfig
+from metrics import (
+    AgentMetrics,
+    Histogram,
+    MetricsExporter,
+    MetricsRegistry,
+    create_agent_metrics,
+    write_textfile,
+)
+from protocol import recvPDU, sendPDU
+
+
+class TestHistogram(unittest.TestCase):
+    def test_buckets_are_cumulative(self):
+        histogram = Histogram(buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 0.5, 5.0):
+            histogram.observe(value)
+        lines = histogram.render("t", (("phase", "run"),))
+        self.assertIn('t_bucket{phase="run",le="0.1"} 1', lines)
+        self.assertIn('t_bucket{phase="run",le="1.0"} 3', lines)
+        self.assertIn('t_bucket{phase="run",le="+Inf"} 4', lines)
+        self.assertIn('t_count{phase="run"} 4', lines)
+        self.assertIn('t_sum{phase="run"} 6.05', lines)
+
+
+class TestMetricsRegistry(unittest.TestCase):
+    def test_same_labels_return_same_metric(self):
+        registry = MetricsRegistry()
+        a = registry.counter("c", "help", peer="x", direction="in")
+        b = registry.counter("c", "help", direction="in", peer="x")
+        self.assertIs(a, b)
+
+    def test_render_prometheus_text(self):
+        registry = MetricsRegistry()
+        registry.counter("smm3ng_cycles_total", "Completed cycles", agent="a").inc(3)
+        text = registry.render()
+        self.assertIn("# HELP smm3ng_cycles_total Completed cycles\n", text)
+        self.assertIn("# TYPE smm3ng_cycles_total counter\n", text)
+        self.assertIn('smm3ng_cycles_total{agent="a"} 3\n', text)
+
+    def test_label_values_are_escaped(self):
+        registry = MetricsRegistry()
+        registry.counter("c", "help", peer='a"b').inc()
+        self.assertIn('c{peer="a\\"b"} 1', registry.render())
+
+
+class TestAgentMetrics(unittest.TestCase):
+    def setUp(self):
+        self.metrics = AgentMetrics("algo")
+        self.metrics.install()
+        self.a, self.b = socket.socketpair()
+
+    def tearDown(self):
+        self.metrics.uninstall()
+        self.a.close()
+        self.b.close()
+
+    def test_pdus_are_counted_per_peer(self):
+        self.metrics.label_socket(self.a, "core")
+        sendPDU(self.a, ("ack", None))
+        recvPDU(self.b)
+        text = self.metrics.registry.render()
+        self.assertIn(
+            'smm3ng_pdus_total{agent="algo",direction="out",pdu="ack",peer="core"} 1',
+            text,
+        )
+        self.assertIn(
+            'smm3ng_pdus_total{agent="algo",direction="in",pdu="ack",peer="inbound"} 1',
+            text,
+        )
+        self.assertIn(
+            'smm3ng_bytes_total{agent="algo",direction="out",peer="core"} 6', text
+        )
+
+    def test_uninstall_stops_counting(self):
+        self.metrics.uninstall()
+        sendPDU(self.a, ("ack", None))
+        recvPDU(self.b)
+        self.assertNotIn("smm3ng_pdus_total{", self.metrics.registry.render())
+        self.metrics.install()
+
+    def test_phases(self):
+        self.metrics.phase("run", 0.002)
+        self.metrics.peer_phase("pull", "producer", 0.001)
+        text = self.metrics.registry.render()
+        self.assertIn('smm3ng_phase_seconds_count{agent="algo",phase="run"} 1', text)
+        self.assertIn(
+            'smm3ng_peer_phase_seconds_count{agent="algo",peer="producer",phase="pull"} 1',
+            text,
+        )
+
+
+class TestMetricsExporter(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.registry = MetricsRegistry()
+        self.registry.counter("c", "help").inc()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_write_textfile(self):
+        path = os.path.join(self.dir.name, "agent.prom")
+        write_textfile(self.registry, path)
+        with open(path) as f:
+            self.assertEqual(f.read(), self.registry.render())
+        self.assertEqual(os.listdir(self.dir.name), ["agent.prom"])
+
+    def test_textfile_written_on_stop(self):
+        path = os.path.join(self.dir.name, "agent.prom")
+        exporter = MetricsExporter(self.registry, path, interval=60)
+        exporter.start()
+        exporter.stop()
+        with open(path) as f:
+            self.assertIn("c 1", f.read())
+
+    def test_unix_socket(self):
+        path = os.path.join(self.dir.name, "metrics.sock")
+        exporter = MetricsExporter(self.registry, f"unix:{path}")
+        exporter.start()
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+                client.connect(path)
+                data = b""
+                while chunk := client.recv(4096):
+                    data += chunk
+            self.assertEqual(data.decode(), self.registry.render())
+        finally:
+            exporter.stop()
+        self.assertFalse(os.path.exists(path))
+
+
+class TestCreateAgentMetrics(unittest.TestCase):
+    def test_disabled_by_default(self):
+        self.assertEqual(create_agent_metrics("algo", AgentConfig()), (None, None))
+
+    def test_agent_placeholder(self):
+        config = AgentConfig(metrics_path="/tmp/{agent}.prom")
+        metrics, exporter = create_agent_metrics("algo", config)
+        self.assertEqual(metrics.algoName, "algo")
+        self.assertEqual(exporter.target, "/tmp/algo.prom")
+        self.assertNotIn(metrics.observe_pdu, protocol.pdu_observers)
@@ -0,0 +1,68 @@
+import unittest
+
+from plan import CyclePlan
+from protocol import encodeFrame
+
+
+def conn(local_name, remote_algo, remote_name):
+    return {
+        "localParamName": local_name,
+        "remoteAlgoName": remote_algo,
+        "remoteParamName": remote_name,
+        "address": "127.0.0.1",
+        "port": 1000,
+    }
+
+
+class TestCyclePlan(unittest.TestCase):
+    def test_pull_requests(self):
+        plan = CyclePlan(
+            {
+                "pull": [conn("x", "A", "p"), conn("y", "A", "p"), conn("z", "B", "q")],
+                "push": [],
+            }
+        )
+        self.assertEqual(plan.pull_groups, {"A": {"p": ["x", "y"]}, "B": {"q": ["z"]}})
+        self.assertEqual(
+            plan.pull_requests,
+            {
+                "A": ({"p": ["x", "y"]}, encodeFrame(("pullValuesReq", ["p"]))),
+                "B": ({"q": ["z"]}, encodeFrame(("pullValuesReq", ["q"]))),
+            },
+        )
+        self.assertEqual(plan.pull_frame("B"), plan.pull_requests["B"][1])
+        frame = plan.pull_frame("A", "oer")
+        self.assertEqual(frame, encodeFrame(("pullValuesReq", ["p"]), "oer"))
+        # Encoded once per peer and codec
+        self.assertIs(plan.pull_frame("A", "oer"), frame)
+
+    def test_push_variables(self):
+        plan = CyclePlan(
+            {
+                "pull": [],
+                "push": [conn("x", "A", "p"), conn("y", "A", "q"), conn("x", "B", "r")],
+            }
+        )
+        # Every output is looked up once, whatever the number of peers
+        self.assertEqual(plan.output_names, ["x", "y"])
+        self.assertEqual(
+            plan.push_bindings, {"A": [(0, "p"), (1, "q")], "B": [(0, "r")]}
+        )
+        self.assertEqual(
+            list(plan.push_variables({"x": ("integer", 1), "y": ("real", 2.0)})),
+            [
+                (
+                    "A",
+                    [
+                        {"name": "p", "value": ("integer", 1)},
+                        {"name": "q", "value": ("real", 2.0)},
+                    ],
+                ),
+                ("B", [{"name": "r", "value": ("integer", 1)}]),
+            ],
+        )
+        # Outputs the algorithm did not return are left out
+        self.assertEqual(
+            list(plan.push_variables({"y": ("real", 2.0)})),
+            [("A", [{"name": "q", "value": ("real", 2.0)}]), ("B", [])],
+        )
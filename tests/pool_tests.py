@@ -0,0 +1,135 @@
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+from agent import pull_values
+from plan import CyclePlan
+from pool import ConnectionPool
+
+
+class FakeConnect:
+    """
+    connect_to_peer stand-in failing the first `failures` attempts per port
+    """
+
+    def __init__(self, failures=0, delay=0.0):
+        self.failures = failures
+        self.delay = delay
+        self.calls: list = []
+        self.lock = threading.Lock()
+
+    def __call__(self, address, port, timeout=None):
+        with self.lock:
+            self.calls.append((address, port))
+            attempts = self.calls.count((address, port))
+        time.sleep(self.delay)
+        if attempts <= self.failures:
+            return None
+        return MagicMock(name=f"{address}:{port}")
+
+
+class TestConnectionPool(unittest.TestCase):
+    def test_endpoints_are_shared(self):
+        connect = FakeConnect()
+        pool = ConnectionPool(connect)
+        pool.add("A", "127.0.0.1", 1000)
+        pool.add("B", "127.0.0.1", 1000)
+        pool.add("C", "127.0.0.1", 1001)
+
+        self.assertEqual(pool.connect(), [])
+        self.assertEqual(len(connect.calls), 2)
+        self.assertIs(pool["A"], pool["B"])
+        self.assertIsNot(pool["A"], pool["C"])
+        self.assertEqual(dict(pool.items()).keys(), {"A", "B", "C"})
+
+    def test_concurrent_connects(self):
+        connect = FakeConnect(delay=0.2)
+        pool = ConnectionPool(connect)
+        for port in range(8):
+            pool.add(f"P{port}", "127.0.0.1", port)
+
+        started = time.monotonic()
+        self.assertEqual(pool.connect(), [])
+        self.assertLess(time.monotonic() - started, 1.0)
+
+    def test_connect_in_background(self):
+        connect = FakeConnect(delay=0.2)
+        pool = ConnectionPool(connect)
+        self.addCleanup(pool.close)
+        pool.add("A", "127.0.0.1", 1000)
+
+        started = time.monotonic()
+        pool.connect_in_background(timeout=1.0)
+        # An unreachable peer does not hold up the cycle
+        self.assertLess(time.monotonic() - started, 0.1)
+        self.assertNotIn("A", pool)
+        pool.connect_in_background(timeout=1.0)
+        self.assertEqual(len(connect.calls), 1)
+        pool.pending[("127.0.0.1", 1000)].result()
+        pool.connect_in_background(timeout=1.0)
+        self.assertIn("A", pool)
+        self.assertEqual(pool.pending, {})
+
+    def test_retries_with_backoff(self):
+        connect = FakeConnect(failures=2)
+        pool = ConnectionPool(connect, retries=2, backoff=0.01)
+        pool.add("A", "127.0.0.1", 1000)
+        self.assertEqual(pool.connect(), [])
+        self.assertEqual(len(connect.calls), 3)
+
+        connect = FakeConnect(failures=10)
+        pool = ConnectionPool(connect, retries=2, backoff=0.01)
+        pool.add("A", "127.0.0.1", 1000)
+        self.assertEqual(pool.connect(), [("127.0.0.1", 1000)])
+        self.assertNotIn("A", pool)
+        with self.assertRaises(RuntimeError):
+            pool["A"]
+
+    def test_reconnect_after_drop(self):
+        pool = ConnectionPool(FakeConnect())
+        observer = MagicMock()
+        pool.add("A", "127.0.0.1", 1000)
+        pool.add("B", "127.0.0.1", 1000)
+        pool.connect()
+        pool.add_observer(observer)
+        first = pool["A"]
+        observer.label_socket.assert_called_once_with(first, "A,B")
+
+        # Dropping one algorithm closes the connection it shares
+        self.assertIs(pool.pop("B"), first)
+        first.close.assert_called_once()
+        self.assertIsNone(pool.get("A"))
+        self.assertIsNone(pool.pop("A"))
+
+        second = pool["A"]
+        self.assertIsNot(second, first)
+        self.assertIs(pool.get("B"), second)
+        observer.label_socket.assert_called_with(second, "A,B")
+
+        pool.reset()
+        second.close.assert_called_once()
+        self.assertEqual(list(pool.items()), [])
+
+    def test_phase_reconnects_dropped_peer(self):
+        pool = ConnectionPool(FakeConnect())
+        pool.add("A", "127.0.0.1", 1000)
+        pool.connect()
+        pool.pop("A")
+        plan = CyclePlan(
+            {
+                "pull": [
+                    {
+                        "localParamName": "x",
+                        "remoteAlgoName": "A",
+                        "remoteParamName": "p",
+                    }
+                ],
+                "push": [],
+            }
+        )
+        with patch("agent.sendEncodedPDU") as mock_send, patch(
+            "agent.recvPDU", return_value=("pullValuesRep", [])
+        ):
+            pull_values(pool, plan)
+        self.assertIs(mock_send.call_args.args[0], pool.get("A"))
@@ -1,27 +1,70 @@
+import os
+import shutil
 import socket
 import struct
+import tempfile
 import unittest
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
+
+import protocol
 
 from protocol import (
+    DEFAULT_MAX_FRAME_SIZE,
+    WIRE_CODECS,
+    answerCodecRequest,
     asn1_compiler,
+    chosenCodec,
+    codecOf,
+    codecRequest,
+    compileSpecification,
+    decodePDU,
+    encodeFrame,
+    encodePDU,
+    featuresOf,
+    negotiateCodec,
+    parseCodecs,
+    recv_buffers,
     recvPDU,
     recvStatusPDU,
     sendAckPDU,
     sendDonePDU,
+    sendEncodedPDU,
     sendNackPDU,
     sendNextCycle,
     sendPDU,
     sendRegPDU,
     sendShiftValuesPDU,
+    setCodec,
+    setMaxFrameSize,
 )
 
 
+def feed(mock_socket, chunks):
+    """
+    Make recv_into on a mock socket deliver the given byte chunks, as a
+    stream socket would, one chunk (or the part that fits) per call.
+    """
+    pending = list(chunks)
+
+    def recv_into(view, nbytes=0):
+        if not pending:
+            return 0
+        chunk = pending.pop(0)
+        size = min(len(chunk), nbytes or len(view))
+        view[:size] = chunk[:size]
+        if size < len(chunk):
+            pending.insert(0, chunk[size:])
+        return size
+
+    mock_socket.recv_into.side_effect = recv_into
+
+
 class TestPDUSocketFunctions(unittest.TestCase):
     # A mock socket is used so that tests are fast, isolated, and do not depend on network
     # runs before evety single test: every test gets a fresh mock
     def setUp(self):
         self.mock_socket = MagicMock()
+        self.mock_socket.sendmsg.side_effect = lambda buffers: sum(map(len, buffers))
 
     """
     test successfully sending and receiving PDU
@@ -32,10 +75,13 @@ class TestPDUSocketFunctions(unittest.TestCase):
         sendPDU(self.mock_socket, pdu)
         encoded = asn1_compiler.encode("SMM3NG-PDU", pdu)
         # Mock recv responses before calling recvPDU
-        self.mock_socket.recv.side_effect = [
-            struct.pack("<I", len(encoded)),  # PDU length
-            encoded,  # actual PDU data
-        ]
+        feed(
+            self.mock_socket,
+            [
+                struct.pack("<I", len(encoded)),  # PDU length
+                encoded,  # actual PDU data
+            ],
+        )
         received_pdu = recvPDU(self.mock_socket)
         self.assertEqual(received_pdu, pdu)
 
@@ -46,20 +92,55 @@ class TestPDUSocketFunctions(unittest.TestCase):
 
     def test_send_with_socket_error(self):
         pdu = ("ack", None)
-        # Whenever sendPDU calls sock.send(...), it will raise socket.error("Mock socket error")
-        self.mock_socket.send.side_effect = socket.error("Mock socket error")
+        # Whenever sendPDU calls sock.sendmsg(...), it will raise socket.error("Mock socket error")
+        self.mock_socket.sendmsg.side_effect = socket.error("Mock socket error")
         with self.assertRaises(RuntimeError):
             sendPDU(self.mock_socket, pdu)
 
+    def test_send_single_call(self):
+        pdu = ("nextCycle", {"timestamp": 1})
+        sendPDU(self.mock_socket, pdu)
+        encoded = asn1_compiler.encode("SMM3NG-PDU", pdu)
+        self.mock_socket.sendmsg.assert_called_once_with(
+            [struct.pack("<I", len(encoded)), encoded]
+        )
+        self.mock_socket.send.assert_not_called()
+
+    def test_send_encoded_pdu(self):
+        pdu = ("pullValuesReq", ["a", "b"])
+        frame = encodeFrame(pdu)
+        encoded = asn1_compiler.encode("SMM3NG-PDU", pdu)
+        self.assertEqual(frame, struct.pack("<I", len(encoded)) + encoded)
+        sendEncodedPDU(self.mock_socket, "pullValuesReq", frame)
+        self.mock_socket.sendall.assert_called_once_with(frame)
+        self.mock_socket.sendall.side_effect = socket.error("Mock socket error")
+        with self.assertRaises(RuntimeError):
+            sendEncodedPDU(self.mock_socket, "pullValuesReq", frame)
+
+    def test_send_partial_writes(self):
+        pdu = ("nack", "partial write")
+        written = bytearray()
+
+        # The kernel accepts at most 3 bytes per call
+        def sendmsg(buffers):
+            data = b"".join(bytes(b) for b in buffers)[:3]
+            written.extend(data)
+            return len(data)
+
+        self.mock_socket.sendmsg.side_effect = sendmsg
+        sendPDU(self.mock_socket, pdu)
+        encoded = asn1_compiler.encode("SMM3NG-PDU", pdu)
+        self.assertEqual(bytes(written), struct.pack("<I", len(encoded)) + encoded)
+
     def test_send_with_struct_error(self):
         pdu = ("ack", None)
-        self.mock_socket.send.side_effect = struct.error("Mock socket error")
+        self.mock_socket.sendmsg.side_effect = struct.error("Mock socket error")
         with self.assertRaises(RuntimeError):
             sendPDU(self.mock_socket, pdu)
 
     def test_send_with_exception(self):
         pdu = ("ack", None)
-        self.mock_socket.send.side_effect = Exception("Mock socket error")
+        self.mock_socket.sendmsg.side_effect = Exception("Mock socket error")
         with self.assertRaises(RuntimeError):
             sendPDU(self.mock_socket, pdu)
 
@@ -68,46 +149,82 @@ class TestPDUSocketFunctions(unittest.TestCase):
     """
 
     def test_recv_with_closed_connection(self):
-        self.mock_socket.recv.return_value = b""
+        feed(self.mock_socket, [])
         with self.assertRaises(ValueError):
             recvPDU(self.mock_socket)
 
     def test_recv_with_incomplete_length_header(self):
-        self.mock_socket.recv.return_value = b"\x08\x00"
+        # Connection closed in the middle of the header
+        feed(self.mock_socket, [b"\x08\x00"])
         with self.assertRaises(RuntimeError):
             recvPDU(self.mock_socket)
 
+    def test_recv_with_split_length_header(self):
+        pdu = ("nextCycle", {"timestamp": 7})
+        encoded = asn1_compiler.encode("SMM3NG-PDU", pdu)
+        header = struct.pack("<I", len(encoded))
+        # A short header read is retried instead of failing
+        feed(
+            self.mock_socket,
+            [header[:1], header[1:3], header[3:] + encoded[:2], encoded[2:]],
+        )
+        self.assertEqual(recvPDU(self.mock_socket), pdu)
+
     def test_recv_partial_pdu_data(self):
         length = struct.pack("<I", 8)
-        self.mock_socket.recv.side_effect = [
-            length,
-            b"abc",  # Partial data
-            b"",  # Simulate socket closing
-        ]
+        feed(
+            self.mock_socket,
+            [
+                length,
+                b"abc",  # Partial data
+            ],
+        )
         with self.assertRaises(RuntimeError) as cm:
             recvPDU(self.mock_socket)
         self.assertIn("Connection closed before receiving full PDU", str(cm.exception))
 
+    def test_recv_oversized_frame(self):
+        feed(self.mock_socket, [struct.pack("<I", 1024)])
+        setMaxFrameSize(512)
+        try:
+            with self.assertRaises(RuntimeError):
+                recvPDU(self.mock_socket)
+        finally:
+            setMaxFrameSize(DEFAULT_MAX_FRAME_SIZE)
+
+    def test_recv_buffer_reused_and_grown(self):
+        small = ("ack", None)
+        large = ("pushValues", [{"name": "b", "value": ("blob", b"x" * 200000)}])
+        frames = []
+        for pdu in (small, large, small):
+            encoded = asn1_compiler.encode("SMM3NG-PDU", pdu)
+            frames += [struct.pack("<I", len(encoded)), encoded]
+        feed(self.mock_socket, frames)
+        self.assertEqual(recvPDU(self.mock_socket), small)
+        buffer = recv_buffers[self.mock_socket]
+        self.assertEqual(recvPDU(self.mock_socket), large)
+        grown = recv_buffers[self.mock_socket]
+        self.assertIsNot(buffer, grown)
+        self.assertEqual(recvPDU(self.mock_socket), small)
+        self.assertIs(recv_buffers[self.mock_socket], grown)
+
     """
     tests sending and receiving status PDUs
     """
 
     def test_send_ack_pdu(self):
         sendAckPDU(self.mock_socket)
-        self.mock_socket.send.assert_called()
+        self.mock_socket.sendmsg.assert_called()
 
     def test_send_nack_pdu(self):
         reason = "Invalid input"
         sendNackPDU(self.mock_socket, reason)
-        self.mock_socket.send.assert_called()
+        self.mock_socket.sendmsg.assert_called()
 
     def test_recv_ack_pdu(self):
         pdu = ("ack", None)
         encoded = asn1_compiler.encode("SMM3NG-PDU", pdu)
-        self.mock_socket.recv.side_effect = [
-            struct.pack("<I", len(encoded)),
-            encoded,
-        ]
+        feed(self.mock_socket, [struct.pack("<I", len(encoded)), encoded])
         status, reason = recvStatusPDU(self.mock_socket)
         self.assertTrue(status)
         self.assertIsNone(reason)
@@ -115,10 +232,7 @@ class TestPDUSocketFunctions(unittest.TestCase):
     def test_recv_nack_pdu(self):
         pdu = ("nack", "Invalid input")
         encoded = asn1_compiler.encode("SMM3NG-PDU", pdu)
-        self.mock_socket.recv.side_effect = [
-            struct.pack("<I", len(encoded)),
-            encoded,
-        ]
+        feed(self.mock_socket, [struct.pack("<I", len(encoded)), encoded])
         status, reason = recvStatusPDU(self.mock_socket)
         self.assertFalse(status)
         self.assertEqual(reason, "Invalid input")
@@ -126,10 +240,7 @@ class TestPDUSocketFunctions(unittest.TestCase):
     def test_recv_non_status_pdu(self):
         pdu = ("done", None)
         encoded = asn1_compiler.encode("SMM3NG-PDU", pdu)
-        self.mock_socket.recv.side_effect = [
-            struct.pack("<I", len(encoded)),
-            encoded,
-        ]
+        feed(self.mock_socket, [struct.pack("<I", len(encoded)), encoded])
         with self.assertRaises(ValueError):
             recvStatusPDU(self.mock_socket)
 
@@ -139,20 +250,148 @@ class TestPDUSocketFunctions(unittest.TestCase):
 
     def test_send_shift_values_pdu(self):
         sendShiftValuesPDU(self.mock_socket)
-        self.mock_socket.send.assert_called()
+        self.mock_socket.sendmsg.assert_called()
 
     def test_send_done_pdu(self):
         sendDonePDU(self.mock_socket)
-        self.mock_socket.send.assert_called()
+        self.mock_socket.sendmsg.assert_called()
 
     def test_send_reg_pdu(self):
         algo_name = "Algo1"
         class_name = "ClassA"
         port = 8080
         sendRegPDU(self.mock_socket, algo_name, class_name, port)
-        self.mock_socket.send.assert_called()
+        self.mock_socket.sendmsg.assert_called()
 
     def test_send_next_cycle_pdu(self):
         timestamp = 1234567890
         sendNextCycle(self.mock_socket, timestamp)
-        self.mock_socket.send.assert_called()
+        self.mock_socket.sendmsg.assert_called()
+
+
+class TestSpecificationCache(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.env = patch.dict(os.environ, {"SMM3NG_CACHE_DIR": self.cache_dir})
+        self.env.start()
+
+    def tearDown(self):
+        self.env.stop()
+        shutil.rmtree(self.cache_dir)
+
+    def test_second_start_loads_cached_specification(self):
+        compileSpecification("der")
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+        with patch("protocol.asn1tools.compile_files") as mock_compile:
+            specification = compileSpecification("der")
+        mock_compile.assert_not_called()
+        pdu = ("nextCycle", {"timestamp": 3})
+        self.assertEqual(
+            specification.encode("SMM3NG-PDU", pdu),
+            asn1_compiler.encode("SMM3NG-PDU", pdu),
+        )
+
+    def test_schema_change_invalidates_cache(self):
+        schema_dir = tempfile.mkdtemp()
+        try:
+            paths = []
+            for path in protocol.asn1_file_paths:
+                paths.append(shutil.copy(path, schema_dir))
+            with patch("protocol.asn1_file_paths", paths):
+                compileSpecification("der")
+                with open(paths[0], "a") as f:
+                    f.write("\n")
+                with patch(
+                    "protocol.asn1tools.compile_files", return_value="fresh"
+                ) as mock_compile:
+                    self.assertEqual(compileSpecification("der"), "fresh")
+                mock_compile.assert_called_once()
+        finally:
+            shutil.rmtree(schema_dir)
+
+    def test_corrupted_cache_is_recompiled(self):
+        compileSpecification("der")
+        (name,) = os.listdir(self.cache_dir)
+        with open(os.path.join(self.cache_dir, name), "wb") as f:
+            f.write(b"garbage")
+        specification = compileSpecification("der")
+        self.assertEqual(specification.encode("SMM3NG-PDU", ("ack", None)), b"\x80\x00")
+
+
+class TestWireCodecs(unittest.TestCase):
+    PDUS = [
+        ("ack", None),
+        ("nextCycle", {"timestamp": -(2**40)}),
+        (
+            "pushValues",
+            [
+                {"name": "r", "value": ("real", 1.5)},
+                {"name": "b", "value": ("blob", b"\x00\xff")},
+                {"name": "c", "value": ("custom", {"type": "1.2.3", "data": b"x"})},
+            ],
+        ),
+    ]
+
+    def test_round_trip(self):
+        for codec in WIRE_CODECS:
+            for pdu in self.PDUS:
+                with self.subTest(codec=codec, pdu=pdu[0]):
+                    self.assertEqual(decodePDU(encodePDU(pdu, codec), codec), pdu)
+        self.assertLess(
+            len(encodePDU(self.PDUS[2], "oer")), len(encodePDU(self.PDUS[2]))
+        )
+        with self.assertRaisesRegex(RuntimeError, "unknown wire codec xer"):
+            encodePDU(("ack", None), "xer")
+
+    def test_parse_codecs(self):
+        self.assertEqual(parseCodecs("oer, uper"), ["oer", "uper"])
+        self.assertEqual(parseCodecs(""), ["der"])
+        with self.assertRaisesRegex(ValueError, "unknown wire codec jer"):
+            parseCodecs("oer,jer")
+
+    def test_answer_codec_request(self):
+        request = codecRequest(["xer", "uper", "oer"])
+        reply, codec, features = answerCodecRequest(request)
+        self.assertEqual(codec, "uper")
+        self.assertEqual(features, frozenset())
+        self.assertEqual(reply[1], [{"name": request[1][0], "value": ("str", "uper")}])
+        self.assertEqual(answerCodecRequest(codecRequest(["xer"]))[1], "der")
+        # Unknown features are left out of the reply
+        request = codecRequest(["der"], ["compress", "teleport"])
+        reply, codec, features = answerCodecRequest(request)
+        self.assertEqual((codec, features), ("der", frozenset(["compress"])))
+        self.assertEqual(reply[1][0]["value"], ("str", "der/compress"))
+        self.assertEqual(chosenCodec(request, reply), ("der", features))
+        # Strict peers check that names are valid PrintableStrings
+        for pdu in (request, reply):
+            asn1_compiler.encode("SMM3NG-PDU", pdu, check_constraints=True)
+        self.assertIsNone(answerCodecRequest(("pullValuesReq", ["a"])))
+        self.assertIsNone(answerCodecRequest(("ack", None)))
+
+    def test_negotiate_codec(self):
+        client, server = socket.socketpair()
+        self.addCleanup(client.close)
+        self.addCleanup(server.close)
+        # A responder predating negotiation has no such variable
+        sendPDU(server, ("pullValuesRep", []))
+        self.assertEqual(negotiateCodec(client, ["oer"]), "der")
+        self.assertEqual(recvPDU(server), codecRequest(["oer"]))
+        self.assertEqual(featuresOf(client), frozenset())
+        # Nor does one that nacks the unknown name
+        sendPDU(server, ("nack", "unknown variable"))
+        self.assertEqual(negotiateCodec(client, ["oer"], ["compress"]), "der")
+        recvPDU(server)
+        self.assertEqual(codecOf(client), "der")
+        self.assertEqual(featuresOf(client), frozenset())
+        reply, codec, _ = answerCodecRequest(codecRequest(["oer"], ["compress"]))
+        sendPDU(server, reply)
+        self.assertEqual(negotiateCodec(client, ["oer"], ["compress"]), "oer")
+        self.assertEqual(codecOf(client), "oer")
+        self.assertEqual(featuresOf(client), frozenset(["compress"]))
+        recvPDU(server)
+        setCodec(server, codec)
+        pdu = self.PDUS[2]
+        sendPDU(client, pdu)
+        self.assertEqual(recvPDU(server), pdu)
+        setCodec(client, "der")
+        self.assertEqual(codecOf(client), "der")
@@ -0,0 +1,90 @@
+import socket
+import unittest
+
+from protocol import negotiateCodec, recvPDU, recvStatusPDU, sendPDU
+from responder import DataResponder
+
+
+class TestDataResponder(unittest.TestCase):
+    # Real loopback sockets: the responder is an event loop over them
+    def setUp(self):
+        self.listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listen_sock.bind(("127.0.0.1", 0))
+        self.listen_sock.listen(5)
+        self.responder = DataResponder(self.listen_sock)
+        self.responder.start()
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        self.responder.stop()
+        self.listen_sock.close()
+
+    def connect(self):
+        client = socket.create_connection(self.listen_sock.getsockname())
+        self.clients.append(client)
+        return client
+
+    def test_serves_pull_from_published_outputs(self):
+        self.responder.publish({"a": ("integer", 1), "b": ("real", 2.5)})
+        client = self.connect()
+        sendPDU(client, ("pullValuesReq", ["b", "missing", "a"]))
+        self.assertEqual(
+            recvPDU(client),
+            (
+                "pullValuesRep",
+                [
+                    {"name": "b", "value": ("real", 2.5)},
+                    {"name": "a", "value": ("integer", 1)},
+                ],
+            ),
+        )
+
+    def test_negotiated_codec(self):
+        self.responder.publish({"a": ("real", 0.5)})
+        client = self.connect()
+        self.assertEqual(negotiateCodec(client, ["uper", "oer"]), "uper")
+        sendPDU(client, ("pullValuesReq", ["a"]))
+        self.assertEqual(
+            recvPDU(client), ("pullValuesRep", [{"name": "a", "value": ("real", 0.5)}])
+        )
+        sendPDU(client, ("pushValues", [{"name": "x", "value": ("integer", 3)}]))
+        self.assertEqual(recvStatusPDU(client), (True, None))
+        self.assertEqual(self.responder.take_inputs(), {"x": ("integer", 3)})
+
+    def test_stores_pushed_values_as_inputs(self):
+        client = self.connect()
+        sendPDU(client, ("pushValues", [{"name": "x", "value": ("str", "hi")}]))
+        self.assertEqual(recvStatusPDU(client), (True, None))
+        self.assertEqual(self.responder.take_inputs(), {"x": ("str", "hi")})
+        # Inputs are handed over once
+        self.assertEqual(self.responder.take_inputs(), {})
+
+    def test_many_peers_and_pipelined_requests(self):
+        self.responder.publish({"a": ("integer", 7)})
+        clients = [self.connect() for _ in range(10)]
+        for client in clients:
+            sendPDU(client, ("pullValuesReq", ["a"]))
+            sendPDU(client, ("pullValuesReq", ["a"]))
+        for client in clients:
+            for _ in range(2):
+                self.assertEqual(
+                    recvPDU(client),
+                    ("pullValuesRep", [{"name": "a", "value": ("integer", 7)}]),
+                )
+
+    def test_unreadable_segment_is_nacked_with_the_error(self):
+        client = self.connect()
+        sendPDU(client, ("pushValuesLinuxSHM", "smm3ng-missing"))
+        ok, reason = recvStatusPDU(client)
+        self.assertFalse(ok)
+        self.assertIn("cannot read shared memory smm3ng-missing: ", reason)
+        self.assertIn("No such file", reason)
+
+    def test_unexpected_pdu_is_nacked(self):
+        client = self.connect()
+        sendPDU(client, ("done", None))
+        ok, reason = recvStatusPDU(client)
+        self.assertFalse(ok)
+        self.assertIn("done", reason)
@@ -0,0 +1,102 @@
+import socket
+import unittest
+
+from protocol import recvPDU, recvStatusPDU, sendPDU
+from responder import DataResponder
+from shm import (
+    SegmentReader,
+    SharedSegment,
+    ShmTransport,
+    asn1_compiler,
+    read_variables,
+    shm_available,
+)
+
+
+def variables(size):
+    return [{"name": "b", "value": ("blob", b"\x01" * size)}]
+
+
+@unittest.skipUnless(shm_available(), "POSIX shared memory is not available")
+class TestSharedSegment(unittest.TestCase):
+    def setUp(self):
+        self.segment = SharedSegment()
+        self.reader = SegmentReader()
+
+    def tearDown(self):
+        self.reader.close()
+        self.segment.close()
+
+    def test_write_and_read_in_place(self):
+        data = asn1_compiler.encode("PushValuesPDU", variables(10))
+        name = self.segment.write(data)
+        self.assertEqual(self.reader.read(name, "PushValuesPDU"), variables(10))
+
+    def test_reader_follows_growing_segment(self):
+        small = asn1_compiler.encode("PushValuesPDU", variables(10))
+        name = self.segment.write(small)
+        self.reader.read(name, "PushValuesPDU")
+        large = asn1_compiler.encode("PushValuesPDU", variables(3 * 1024 * 1024))
+        self.segment.write(large)
+        self.assertEqual(
+            self.reader.read(name, "PushValuesPDU"), variables(3 * 1024 * 1024)
+        )
+
+    def test_unlinked_segments_are_unmapped(self):
+        data = asn1_compiler.encode("PushValuesPDU", variables(10))
+        # A peer reconnecting five times, with a new segment every time
+        for _ in range(5):
+            segment = SharedSegment()
+            self.reader.read(segment.write(data), "PushValuesPDU")
+            segment.close()
+        name = self.segment.write(data)
+        self.reader.read(name, "PushValuesPDU")
+        self.assertEqual(list(self.reader.maps), [name])
+
+    def test_missing_segment(self):
+        with self.assertRaises(RuntimeError):
+            self.reader.read("smm3ng-missing", "PushValuesPDU")
+
+
+@unittest.skipUnless(shm_available(), "POSIX shared memory is not available")
+class TestShmTransport(unittest.TestCase):
+    def test_only_large_values_for_local_peers(self):
+        transport = ShmTransport(threshold=100)
+        transport.add_peer("local", "127.0.0.1")
+        transport.add_peer("remote", "192.0.2.1")
+        self.assertTrue(transport.wants("local", variables(100)))
+        self.assertFalse(transport.wants("local", variables(99)))
+        self.assertFalse(transport.wants("remote", variables(100)))
+        transport.close()
+
+    def test_responder_uses_shared_memory(self):
+        listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listen_sock.bind(("127.0.0.1", 0))
+        listen_sock.listen(5)
+        responder = DataResponder(listen_sock, ShmTransport(threshold=100))
+        responder.start()
+        client = socket.create_connection(listen_sock.getsockname())
+        sender = ShmTransport(threshold=100)
+        try:
+            # Large pull replies come back as a segment name
+            responder.publish({"big": ("blob", b"x" * 1000), "small": ("integer", 1)})
+            sendPDU(client, ("pullValuesReq", ["big"]))
+            rep_pdu = recvPDU(client)
+            self.assertEqual(rep_pdu[0], "pullValuesRepLinuxSHM")
+            self.assertEqual(
+                read_variables(rep_pdu[1]),
+                [{"name": "big", "value": ("blob", b"x" * 1000)}],
+            )
+            sendPDU(client, ("pullValuesReq", ["small"]))
+            self.assertEqual(recvPDU(client)[0], "pullValuesRep")
+
+            # Pushed segments are read into the inputs
+            name = sender.write("peer", variables(1000))
+            sendPDU(client, ("pushValuesLinuxSHM", name))
+            self.assertEqual(recvStatusPDU(client), (True, None))
+            self.assertEqual(responder.take_inputs(), {"b": ("blob", b"\x01" * 1000)})
+        finally:
+            client.close()
+            sender.close()
+            responder.stop()
+            listen_sock.close()
@@ -0,0 +1,116 @@
+import io
+import os
+import socket
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+
+import protocol
+from config import AgentConfig
+from protocol import recvPDU, sendPDU
+from tracer import Tracer, create_tracer, main, read_trace
+
+
+class TestTracer(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "agent.trace")
+        self.a, self.b = socket.socketpair()
+
+    def tearDown(self):
+        self.a.close()
+        self.b.close()
+        self.dir.cleanup()
+
+    def exchange(self, pdu):
+        sendPDU(self.a, pdu)
+        return recvPDU(self.b)
+
+    def test_records_pdu_events(self):
+        tracer = Tracer(self.path, capacity=16, level="debug", algoName="algo")
+        tracer.install()
+        tracer.label_socket(self.a, "core")
+        try:
+            self.exchange(("nextCycle", {"timestamp": 1}))
+        finally:
+            tracer.close()
+        header, records = read_trace(self.path)
+        self.assertEqual(header["agent"], "algo")
+        self.assertEqual(header["pid"], os.getpid())
+        self.assertEqual(
+            [(r["seq"], r["direction"], r["peer"], r["pdu"]) for r in records],
+            [(1, "out", "core", "nextCycle"), (2, "in", "", "nextCycle")],
+        )
+        self.assertEqual(records[0]["level"], "info")
+        self.assertEqual(records[0]["size"], records[1]["size"])
+
+    def test_ring_keeps_last_records(self):
+        tracer = Tracer(self.path, capacity=4, level="debug")
+        for i in range(10):
+            tracer.record(3, "out", "peer", "ack", i)
+        tracer.close()
+        _, records = read_trace(self.path)
+        self.assertEqual([r["seq"] for r in records], [7, 8, 9, 10])
+        self.assertEqual([r["size"] for r in records], [6, 7, 8, 9])
+
+    def test_level_filters_events(self):
+        tracer = Tracer(self.path, capacity=16, level="info")
+        tracer.install()
+        try:
+            self.exchange(("ack", None))
+            self.exchange(("nack", "bad"))
+            self.exchange(("shiftValues", None))
+        finally:
+            tracer.close()
+        _, records = read_trace(self.path)
+        self.assertEqual(
+            [r["pdu"] for r in records], ["nack", "nack", "shiftValues", "shiftValues"]
+        )
+
+    def test_sampling_applies_to_debug_events(self):
+        tracer = Tracer(self.path, capacity=64, level="debug", sample=4)
+        for _ in range(8):
+            tracer.observe_pdu("out", self.a, "pushValues", 10)
+        tracer.observe_pdu("out", self.a, "done", 6)
+        tracer.close()
+        _, records = read_trace(self.path)
+        self.assertEqual([r["pdu"] for r in records], ["pushValues"] * 2 + ["done"])
+
+    def test_close_uninstalls(self):
+        tracer = Tracer(self.path, capacity=4)
+        tracer.install()
+        tracer.close()
+        self.assertNotIn(tracer.observe_pdu, protocol.pdu_observers)
+
+    def test_invalid_level(self):
+        with self.assertRaises(ValueError):
+            Tracer(self.path, level="verbose")
+
+    def test_create_tracer(self):
+        self.assertIsNone(create_tracer("algo", AgentConfig()))
+        config = AgentConfig(trace_path=os.path.join(self.dir.name, "{agent}.trace"))
+        tracer = create_tracer("algo", config)
+        try:
+            self.assertEqual(tracer.path, os.path.join(self.dir.name, "algo.trace"))
+            self.assertIn(tracer.observe_pdu, protocol.pdu_observers)
+        finally:
+            tracer.close()
+
+    def test_reader_tool(self):
+        tracer = Tracer(self.path, capacity=8, level="debug", algoName="algo")
+        for _ in range(3):
+            tracer.record(2, "in", "core", "nextCycle", 8)
+        tracer.close()
+        out = io.StringIO()
+        with redirect_stdout(out):
+            self.assertEqual(main([self.path, "--limit", "2"]), 0)
+        lines = out.getvalue().splitlines()
+        self.assertIn("agent algo", lines[0])
+        self.assertEqual(len(lines), 3)
+        self.assertIn("nextCycle", lines[1])
+
+    def test_reader_rejects_other_files(self):
+        with open(self.path, "wb") as f:
+            f.write(b"\0" * 128)
+        with self.assertRaises(ValueError):
+            read_trace(self.path)
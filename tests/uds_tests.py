@@ -0,0 +1,110 @@
+import os
+import socket
+import tempfile
+import unittest
+from unittest.mock import ANY, MagicMock, patch
+
+from agent import peer_connector
+from protocol import recvPDU, sendPDU
+from responder import DataResponder
+from uds import (
+    close_unix_listener,
+    connect_unix,
+    create_unix_listener,
+    unix_socket_path,
+)
+
+
+class UnixTestCase(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.dir = os.path.join(directory.name, "sockets")
+
+
+class TestUnixSockets(UnixTestCase):
+    def test_connect(self):
+        listener = create_unix_listener(self.dir, 4000)
+        self.assertEqual(listener.getsockname(), unix_socket_path(self.dir, 4000))
+        self.assertEqual(os.stat(self.dir).st_mode & 0o777, 0o700)
+        client = connect_unix(self.dir, "127.0.0.1", 4000, timeout=1.0)
+        self.assertEqual(client.family, socket.AF_UNIX)
+        self.assertIsNone(client.gettimeout())
+        client.close()
+        close_unix_listener(listener)
+        self.assertFalse(os.path.exists(unix_socket_path(self.dir, 4000)))
+
+    def test_no_unix_socket(self):
+        listener = create_unix_listener(self.dir, 4000)
+        self.addCleanup(close_unix_listener, listener)
+        # Another port, or an agent on another host
+        self.assertIsNone(connect_unix(self.dir, "127.0.0.1", 4001))
+        self.assertIsNone(connect_unix(self.dir, "192.0.2.1", 4000))
+
+    def test_directory_of_others_is_not_trusted(self):
+        listener = create_unix_listener(self.dir, 4000)
+        self.addCleanup(close_unix_listener, listener)
+        os.chmod(self.dir, 0o755)
+        self.assertIsNone(connect_unix(self.dir, "127.0.0.1", 4000))
+        os.chmod(self.dir, 0o700)
+        with patch("os.getuid", return_value=os.getuid() + 1):
+            self.assertIsNone(connect_unix(self.dir, "127.0.0.1", 4000))
+        client = connect_unix(self.dir, "127.0.0.1", 4000)
+        self.assertIsNotNone(client)
+        client.close()
+        # The next listener makes its directory private again
+        os.chmod(self.dir, 0o755)
+        create_unix_listener(self.dir, 4001).close()
+        self.assertEqual(os.stat(self.dir).st_mode & 0o777, 0o700)
+
+    def test_stale_socket_is_replaced(self):
+        stale = create_unix_listener(self.dir, 4000)
+        stale.close()  # an agent that crashed leaves its socket behind
+        self.assertIsNone(connect_unix(self.dir, "127.0.0.1", 4000))
+        listener = create_unix_listener(self.dir, 4000)
+        self.addCleanup(close_unix_listener, listener)
+        client = connect_unix(self.dir, "127.0.0.1", 4000)
+        self.assertIsNotNone(client)
+        client.close()
+
+
+class TestResponder(UnixTestCase):
+    def setUp(self):
+        super().setUp()
+        self.listen_sock = socket.create_server(("127.0.0.1", 0))
+        self.addCleanup(self.listen_sock.close)
+        self.port = self.listen_sock.getsockname()[1]
+        self.shm = MagicMock()
+        self.shm.wants.return_value = False
+        unix_sock = create_unix_listener(self.dir, self.port)
+        self.addCleanup(close_unix_listener, unix_sock)
+        responder = DataResponder(self.listen_sock, self.shm, unix_sock=unix_sock)
+        responder.start()
+        self.addCleanup(responder.stop)
+        responder.publish({"a": ("integer", 5)})
+
+    def pull(self, sock):
+        self.addCleanup(sock.close)
+        sendPDU(sock, ("pullValuesReq", ["a"]))
+        return recvPDU(sock)
+
+    def test_local_peers_connect_over_unix_socket(self):
+        sock = peer_connector(["der"], self.dir)("127.0.0.1", self.port)
+        self.assertEqual(sock.family, socket.AF_UNIX)
+        self.assertEqual(
+            self.pull(sock),
+            ("pullValuesRep", [{"name": "a", "value": ("integer", 5)}]),
+        )
+        # Unix socket peers are on this host, where shared memory works
+        self.shm.add_peer.assert_called_once_with(ANY, "127.0.0.1")
+
+    def test_tcp_fallback(self):
+        # As with an agent that could not create its Unix socket
+        os.unlink(unix_socket_path(self.dir, self.port))
+        sock = peer_connector(["der"], self.dir)("127.0.0.1", self.port)
+        self.assertEqual(sock.family, socket.AF_INET)
+        self.assertEqual(self.pull(sock)[0], "pullValuesRep")
+        # Negotiating a codec, without Unix sockets at all
+        sock = peer_connector(["oer"], "")("127.0.0.1", self.port)
+        self.assertEqual(sock.family, socket.AF_INET)
+        self.assertEqual(self.pull(sock)[0], "pullValuesRep")
@@ -0,0 +1,138 @@
+import os
+import time
+import unittest
+from unittest.mock import patch
+
+from algo import ALGORITHMS, register_algorithm
+from config import AgentConfig
+from worker import Worker, WorkerPool, create_runner
+
+
+class CountingStep:
+    def __init__(self):
+        self.count = 0
+
+    def run(self, params):
+        if "sleep" in params:
+            time.sleep(params["sleep"][1])
+        if "fail" in params:
+            raise ValueError("bad input")
+        self.count += 1
+        return {"count": ("integer", self.count), "pid": ("integer", os.getpid())}
+
+
+class CheckpointedStep(CountingStep):
+    def export_state(self):
+        return self.count.to_bytes(8, "little")
+
+    def import_state(self, state):
+        self.count = int.from_bytes(state, "little")
+
+
+class StatelessStep:
+    stateless = True
+
+    def run(self, params):
+        return {"echo": params["in"], "pid": ("integer", os.getpid())}
+
+
+class BrokenStep:
+    def __init__(self):
+        raise ValueError("no license")
+
+
+class TestWorker(unittest.TestCase):
+    def setUp(self):
+        register_algorithm("CountingStep", CountingStep)
+        register_algorithm("StatelessStep", StatelessStep)
+        register_algorithm("BrokenStep", BrokenStep)
+        register_algorithm("CheckpointedStep", CheckpointedStep)
+
+    def tearDown(self):
+        for name in ("CountingStep", "StatelessStep", "BrokenStep", "CheckpointedStep"):
+            ALGORITHMS.pop(name)
+
+    def test_state_is_kept_in_the_worker(self):
+        worker = Worker("CountingStep")
+        self.addCleanup(worker.close)
+        self.assertFalse(worker.stateless)
+        first = worker.run({})
+        self.assertNotEqual(first["pid"][1], os.getpid())
+        self.assertEqual(first["count"], ("integer", 1))
+        self.assertEqual(worker.run({})["count"], ("integer", 2))
+
+    def test_large_values_through_shared_memory(self):
+        pool = WorkerPool("StatelessStep")
+        self.addCleanup(pool.close)
+        for size in (10, 5 * 1024 * 1024, 100):
+            blob = ("blob", os.urandom(size))
+            self.assertEqual(pool.run({"in": blob})["echo"], blob)
+
+    def test_errors(self):
+        pool = WorkerPool("CountingStep")
+        self.addCleanup(pool.close)
+        with self.assertRaisesRegex(RuntimeError, "ValueError: bad input"):
+            pool.run({"fail": ("boolean", True)})
+        # The worker survives an exception in the step
+        self.assertEqual(pool.run({})["count"], ("integer", 1))
+        with self.assertRaisesRegex(RuntimeError, "no license"):
+            Worker("BrokenStep")
+
+    def test_timeout_replaces_the_worker(self):
+        pool = WorkerPool("CountingStep", timeout=0.2)
+        self.addCleanup(pool.close)
+        pid = pool.run({})["pid"][1]
+        started = time.monotonic()
+        with self.assertRaisesRegex(RuntimeError, "more than 0.2s"):
+            pool.run({"sleep": ("real", 10.0)})
+        self.assertLess(time.monotonic() - started, 5.0)
+        # A fresh worker, with fresh state, takes the next step
+        result = pool.run({})
+        self.assertNotEqual(result["pid"][1], pid)
+        self.assertEqual(result["count"], ("integer", 1))
+
+    def test_replacements_are_not_forked_from_the_agent(self):
+        pool = WorkerPool("CountingStep", timeout=0.2)
+        self.addCleanup(pool.close)
+        # The agent's threads may hold locks by now: its launcher forks
+        with patch("os.fork", side_effect=AssertionError("forked the agent")):
+            with self.assertRaisesRegex(RuntimeError, "more than 0.2s"):
+                pool.run({"sleep": ("real", 10.0)})
+            result = pool.run({})
+        self.assertEqual(result["count"], ("integer", 1))
+        with self.assertRaises(ChildProcessError):
+            os.waitpid(result["pid"][1], os.WNOHANG)
+
+    def test_pool_size(self):
+        stateless = WorkerPool("StatelessStep", size=3)
+        self.addCleanup(stateless.close)
+        self.assertEqual(len(stateless.workers), 3)
+        # A stateful algorithm never gets more than one worker
+        stateful = WorkerPool("CountingStep", size=3)
+        self.addCleanup(stateful.close)
+        self.assertEqual(len(stateful.workers), 1)
+
+    def test_state_export_and_import(self):
+        pool = WorkerPool("CheckpointedStep")
+        self.addCleanup(pool.close)
+        self.assertTrue(pool.checkpointable)
+        pool.run({})
+        pool.run({})
+        state = pool.export_state()
+        restored = WorkerPool("CheckpointedStep")
+        self.addCleanup(restored.close)
+        restored.import_state(state)
+        self.assertEqual(restored.run({})["count"], ("integer", 3))
+        plain = WorkerPool("CountingStep")
+        self.addCleanup(plain.close)
+        self.assertFalse(plain.checkpointable)
+        with self.assertRaisesRegex(RuntimeError, "AttributeError"):
+            plain.export_state()
+
+    def test_create_runner(self):
+        self.assertIsNone(create_runner("CountingStep", AgentConfig()))
+        with self.assertRaises(ValueError):
+            create_runner("CountingStep", AgentConfig(run_mode="thread"))
+        runner = create_runner("CountingStep", AgentConfig(run_mode="process"))
+        self.addCleanup(runner.close)
+        self.assertIsInstance(runner, WorkerPool)
@@ -0,0 +1,109 @@
+import multiprocessing
+import os
+import socket
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+from benchmarks.stand_in_core import StandInCore
+from zygote import bind, launch, validate_request, zygote_socket_path
+
+
+def wait_for_socket(path, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                probe.connect(path)
+            return
+        except (FileNotFoundError, ConnectionRefusedError):
+            time.sleep(0.01)
+    raise TimeoutError(f"nothing listening on {path}")
+
+
+def zygote_process(path):
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    from zygote import serve
+
+    serve(path)
+
+
+class TestZygote(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "zygote.sock")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_no_zygote(self):
+        self.assertIsNone(launch("start", ["a", "C", "tcp://127.0.0.1:1"], self.path))
+
+    def test_validate_request(self):
+        fds = [0, 1, 2]
+        validate_request({"command": "start", "args": ["a", "C", "url"]}, fds)
+        validate_request({"command": "host", "args": ["url", "a:C", "b:C"]}, fds)
+        for request, request_fds in (
+            ({"command": "rm", "args": ["a", "C", "url"]}, fds),
+            ({"command": "start", "args": ["a", "C"]}, fds),
+            ({"command": "start", "args": "a C url"}, fds),
+            ({"command": "host", "args": ["url", "a"]}, fds),
+            ({"command": "start", "args": ["a", "C", "url"]}, []),
+        ):
+            with self.assertRaises(ValueError):
+                validate_request(request, request_fds)
+
+    def test_bind_refuses_live_socket(self):
+        listen_sock = bind(self.path)
+        try:
+            self.assertEqual(os.stat(self.path).st_mode & 0o077, 0)
+            with self.assertRaises(RuntimeError):
+                bind(self.path)
+        finally:
+            listen_sock.close()
+        # A stale socket file is replaced
+        bind(self.path).close()
+
+    def test_private_directory_without_runtime_dir(self):
+        private = os.path.join(self.dir.name, "smm3ng-zygote")
+        env = {"PATH": os.environ.get("PATH", "")}
+        with patch.dict(os.environ, env, clear=True):
+            with patch("zygote.private_tmp_dir", return_value=private):
+                path = zygote_socket_path()
+                self.assertEqual(os.path.dirname(path), private)
+                bind(path).close()
+        self.assertEqual(os.stat(private).st_mode & 0o777, 0o700)
+
+    def test_launch_refuses_listener_of_another_user(self):
+        listen_sock = bind(self.path)
+        self.addCleanup(listen_sock.close)
+        with patch("os.getuid", return_value=os.getuid() + 1):
+            with self.assertRaisesRegex(RuntimeError, "not a zygote of this user"):
+                launch("start", ["a", "C", "tcp://127.0.0.1:1"], self.path)
+        # Nothing of the request was sent
+        conn, _ = listen_sock.accept()
+        with conn:
+            self.assertEqual(conn.recv(4096), b"")
+
+    def test_agent_forked_by_zygote_runs_cycles(self):
+        core = StandInCore()
+        context = multiprocessing.get_context("fork")
+        zygote = context.Process(target=zygote_process, args=(self.path,), daemon=True)
+        zygote.start()
+        try:
+            wait_for_socket(self.path)
+            with self.assertRaises(RuntimeError):
+                launch("start", ["only-two", "args"], self.path)
+            pid = launch("start", ["z1", "ConsumerAlgorithm", core.url], self.path)
+            self.assertIsInstance(pid, int)
+            self.assertNotEqual(pid, zygote.pid)
+            core.accept_agents(1)
+            core.setup({"z1": {"push": [], "pull": []}})
+            core.cycle(0)
+            core.finish()
+        finally:
+            core.close()
+            zygote.terminate()
+            zygote.join()
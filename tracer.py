@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""
+Dump a PDU trace ring written by an agent started with SMM3NG_TRACE_PATH.
+
+    python3 tracer.py /tmp/smm3ng-consumer.trace [--limit 100] [--json]
+"""
+
+import argparse
+import itertools
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+import weakref
+
+import protocol
+
+# PDU events (direction, peer, PDU choice, frame size, timestamp) are packed
+# into fixed-size records of a ring in a memory-mapped file, so tracing costs
+# one struct.pack_into per sampled frame and nothing is lost when the agent
+# dies: the file is read back offline with this module's main().
+#
+# File layout: a HEADER_SIZE header (TRACE_HEADER) followed by `capacity`
+# records (TRACE_RECORD). Records carry an increasing sequence number starting
+# at 1; a slot with sequence 0 was never written.
+
+TRACE_MAGIC = b"SMM3TRC1"
+TRACE_HEADER = struct.Struct("<8sIIQQ32s")
+HEADER_SIZE = 64
+# seq, time_ns, level, direction, frame size, PDU choice, peer
+TRACE_RECORD = struct.Struct("<QQBB2xI16s24s")
+
+LEVELS = {"error": 1, "info": 2, "debug": 3}
+LEVEL_NAMES = {number: name for name, number in LEVELS.items()}
+DIRECTIONS = {"in": 0, "out": 1}
+DIRECTION_NAMES = {number: name for name, number in DIRECTIONS.items()}
+
+# Control plane PDUs exchanged with the core, once per phase
+INFO_PDUS = {"reg", "setConn", "nextCycle", "shiftValues", "done"}
+
+
+def pdu_level(choice):
+    if choice == "nack":
+        return LEVELS["error"]
+    if choice in INFO_PDUS:
+        return LEVELS["info"]
+    return LEVELS["debug"]
+
+
+def describe_socket(sock):
+    try:
+        peer = sock.getpeername()
+    except (AttributeError, OSError):
+        return ""
+    if isinstance(peer, tuple):
+        return f"{peer[0]}:{peer[1]}"
+    return str(peer)
+
+
+class Tracer:
+    """
+    Records PDU events of the configured level and above into a ring of
+    `capacity` records. Debug events (peer data PDUs and acks) are sampled:
+    only one in `sample` is kept.
+    """
+
+    def __init__(self, path, capacity=65536, level="info", sample=1, algoName=""):
+        if level not in LEVELS:
+            raise ValueError(f"unknown trace level {level}")
+        if capacity <= 0 or sample <= 0:
+            raise ValueError("trace capacity and sampling must be positive")
+        self.path = path
+        self.capacity = capacity
+        self.level = LEVELS[level]
+        self.sample = sample
+        self._seq = itertools.count(1)
+        self._debug_events = itertools.count()
+        # socket -> peer label
+        self.peer_labels: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+        size = HEADER_SIZE + capacity * TRACE_RECORD.size
+        fd = os.open(path, os.O_CREAT | os.O_TRUNC | os.O_RDWR, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        TRACE_HEADER.pack_into(
+            self.map,
+            0,
+            TRACE_MAGIC,
+            TRACE_RECORD.size,
+            capacity,
+            os.getpid(),
+            time.time_ns(),
+            algoName.encode("utf-8")[:32],
+        )
+
+    def label_socket(self, sock, peer):
+        self.peer_labels[sock] = peer
+
+    def peer_label(self, sock):
+        try:
+            label = self.peer_labels.get(sock)
+        except TypeError:
+            return describe_socket(sock)  # not weak-referenceable
+        if label is None:
+            label = self.peer_labels[sock] = describe_socket(sock)
+        return label
+
+    def observe_pdu(self, direction, sock, choice, size):
+        level = pdu_level(choice)
+        if level > self.level:
+            return
+        if level == LEVELS["debug"] and next(self._debug_events) % self.sample:
+            return
+        self.record(level, direction, self.peer_label(sock), choice, size)
+
+    def record(self, level, direction, peer, choice, size):
+        # next() on itertools.count is atomic, so the control loop and the
+        # data responder thread never get the same slot
+        seq = next(self._seq)
+        offset = HEADER_SIZE + (seq - 1) % self.capacity * TRACE_RECORD.size
+        TRACE_RECORD.pack_into(
+            self.map,
+            offset,
+            seq,
+            time.time_ns(),
+            level,
+            DIRECTIONS[direction],
+            min(size, 0xFFFFFFFF),
+            choice.encode("ascii", "replace")[:16],
+            peer.encode("utf-8", "replace")[:24],
+        )
+
+    def install(self):
+        protocol.addPDUObserver(self.observe_pdu)
+
+    def uninstall(self):
+        protocol.removePDUObserver(self.observe_pdu)
+
+    def close(self):
+        self.uninstall()
+        self.map.flush()
+        self.map.close()
+
+
+def create_tracer(algoName, config):
+    """
+    Returns an installed Tracer, or None when no trace_path is configured.
+    """
+    if not config.trace_path:
+        return None
+    path = config.trace_path.replace("{agent}", algoName)
+    tracer = Tracer(
+        path,
+        config.trace_records,
+        config.trace_level,
+        config.trace_sample,
+        algoName,
+    )
+    tracer.install()
+    return tracer
+
+
+def read_trace(path):
+    """
+    Returns (header, records) of a trace file, records in the order they
+    were written. Only the last `capacity` records survive in the ring.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    if len(data) < HEADER_SIZE:
+        raise ValueError(f"{path} is not a trace file")
+    magic, record_size, capacity, pid, started_ns, algoName = TRACE_HEADER.unpack_from(
+        data, 0
+    )
+    if magic != TRACE_MAGIC or record_size != TRACE_RECORD.size:
+        raise ValueError(f"{path} is not a trace file")
+    header = {
+        "agent": algoName.rstrip(b"\0").decode("utf-8", "replace"),
+        "pid": pid,
+        "started_ns": started_ns,
+        "capacity": capacity,
+    }
+    records = []
+    for index in range(capacity):
+        offset = HEADER_SIZE + index * record_size
+        if offset + record_size > len(data):
+            break
+        seq, time_ns, level, direction, size, choice, peer = TRACE_RECORD.unpack_from(
+            data, offset
+        )
+        if seq == 0:
+            continue
+        records.append(
+            {
+                "seq": seq,
+                "time_ns": time_ns,
+                "level": LEVEL_NAMES.get(level, str(level)),
+                "direction": DIRECTION_NAMES.get(direction, str(direction)),
+                "peer": peer.rstrip(b"\0").decode("utf-8", "replace"),
+                "pdu": choice.rstrip(b"\0").decode("ascii", "replace"),
+                "size": size,
+            }
+        )
+    records.sort(key=lambda record: record["seq"])
+    return header, records
+
+
+def format_record(record):
+    seconds, nanoseconds = divmod(record["time_ns"], 1_000_000_000)
+    stamp = time.strftime("%H:%M:%S", time.localtime(seconds))
+    arrow = "<-" if record["direction"] == "in" else "->"
+    return (
+        f"{stamp}.{nanoseconds // 1000:06d} {record['seq']:>10} "
+        f"{record['level']:<5} {arrow} {record['peer'] or '-':<24} "
+        f"{record['pdu']:<16} {record['size']}"
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("path")
+    parser.add_argument("--limit", type=int, help="only show the last N records")
+    parser.add_argument("--json", action="store_true", help="one JSON object per line")
+    args = parser.parse_args(argv)
+
+    try:
+        header, records = read_trace(args.path)
+    except (OSError, ValueError) as e:
+        print(e, file=sys.stderr)
+        return 1
+    if args.limit is not None:
+        records = records[-args.limit :] if args.limit > 0 else []
+    if args.json:
+        for record in records:
+            print(json.dumps(record))
+        return 0
+    print(
+        f"# agent {header['agent']} pid {header['pid']}, "
+        f"{len(records)} of {header['capacity']} records"
+    )
+    for record in records:
+        print(format_record(record))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
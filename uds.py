@@ -0,0 +1,94 @@
+import os
+import socket
+import stat
+
+from shm import is_local_address
+
+# Unix domain sockets for peers on the same host: next to its TCP data
+# port, every agent listens on <unix_socket_dir>/<port>.sock. The setConn
+# connections only give a peer's address and TCP port, and no two agents of
+# a host share a port, so an agent connecting to a local address tries that
+# path first and falls back to TCP when nobody listens there (an agent of
+# another user, an older agent, a stale file). Frames are the same on both.
+#
+# The directory is shared by the agents of one user and only accessible to
+# them; a socket left behind by an agent that crashed is replaced by the
+# next agent given the same port. Agents connect through it only when it is
+# theirs and private, as another user could have created it first.
+
+
+def unix_socket_path(directory, port):
+    return os.path.join(directory, f"{port}.sock")
+
+
+def is_private_directory(directory):
+    """
+    Whether `directory` is a directory of the current user that nobody else
+    can access.
+    """
+    try:
+        st = os.lstat(directory)
+    except OSError:
+        return False
+    return (
+        stat.S_ISDIR(st.st_mode)
+        and st.st_uid == os.getuid()
+        and st.st_mode & 0o077 == 0
+    )
+
+
+def create_unix_listener(directory, port):
+    """
+    Returns a socket listening on the Unix socket of data port `port`, or
+    None when it cannot be created; peers then connect over TCP.
+    """
+    path = unix_socket_path(directory, port)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        if os.lstat(directory).st_uid != os.getuid():
+            raise OSError(f"{directory} belongs to another user")
+        os.chmod(directory, 0o700)
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        sock.bind(path)
+        sock.listen(5)
+        return sock
+    except OSError as e:
+        print(f"Error creating Unix socket {path}: {e}")
+        sock.close()
+        return None
+
+
+def remove_unix_socket(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+def close_unix_listener(sock):
+    path = sock.getsockname()
+    sock.close()
+    remove_unix_socket(path)
+
+
+def connect_unix(directory, addr, data_port, timeout=None):
+    """
+    Returns a socket connected to the Unix socket of the agent listening on
+    `addr`:`data_port`, or None when it is not on this host, has none or
+    `directory` is not private.
+    """
+    if not is_local_address(addr) or not is_private_directory(directory):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(unix_socket_path(directory, data_port))
+        sock.settimeout(None)
+        return sock
+    except OSError:
+        sock.close()
+        return None
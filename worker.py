@@ -0,0 +1,395 @@
+import json
+import os
+import pickle
+import queue
+import signal
+import socket
+import sys
+import threading
+import time
+import weakref
+from multiprocessing import Pipe
+from multiprocessing.connection import Connection
+
+from algo import create_algorithm_instance
+from arrays import uses_arrays
+from checkpoint import supports_checkpoint
+from custom import from_algorithm, to_algorithm
+from shm import SegmentReader, SharedSegment, shm_available
+
+# Process execution mode (SMM3NG_RUN_MODE=process): algo.run executes in a
+# worker process forked from the agent, so a CPU-bound step no longer holds
+# the GIL of the process answering the core and the peers. Inputs and
+# outputs are pickled into two shared memory segments per worker, the pipe
+# to the worker only carries the segment names.
+#
+# With SMM3NG_RUN_TIMEOUT, a step that takes longer is abandoned: the worker
+# is killed, the cycle is nacked and a fresh worker (with fresh algorithm
+# state) takes over. Algorithms declaring `stateless = True` may run on a
+# pool of SMM3NG_RUN_WORKERS workers, any of which can take any step.
+#
+# Messages to a worker are (command, data): "run" a step, or "export" and
+# "import" the algorithm state for checkpoints.
+#
+# Workers are forked before the agent starts any thread. Replacements are
+# needed later, when a thread of the agent may hold a lock that the child
+# would inherit locked, so every pool also forks a launcher at startup: it
+# forks the replacements and passes the agent end of their pipe back over a
+# Unix socket (SCM_RIGHTS).
+
+RUN_MODES = ("inline", "process")
+# Agent ends of the workers' pipes: a worker forked later must not keep
+# them open, or the workers before it never see their pipe close
+_agent_conns: "weakref.WeakSet" = weakref.WeakSet()
+# Seconds a worker gets to exit once its pipe is closed
+CLOSE_TIMEOUT = 1.0
+MAX_LAUNCH_REPLY = 256
+
+
+def is_stateless(algo):
+    return getattr(algo, "stateless", False) is True
+
+
+def dump(data, segment):
+    # Returns the message carrying `data`: through `segment` when there is
+    # one, in the message itself otherwise
+    payload = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+    if segment is None:
+        return (None, payload)
+    return (segment.write(payload), None)
+
+
+def load(message, reader):
+    name, payload = message
+    if name is None:
+        return pickle.loads(payload)
+    return reader.read_with(name, pickle.loads)
+
+
+def exited(pid, child):
+    if not child:
+        # Workers started by a launcher are reaped by the kernel
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+        return False
+    try:
+        return os.waitpid(pid, os.WNOHANG)[0] != 0
+    except ChildProcessError:
+        return True
+
+
+def kill_process(pid, child):
+    try:
+        os.kill(pid, signal.SIGKILL)
+        if child:
+            os.waitpid(pid, 0)
+    except (ProcessLookupError, ChildProcessError):
+        return
+    while not child and not exited(pid, child):
+        time.sleep(0.01)
+
+
+def stop_process(pid, child):
+    # Waits for a process whose pipe was closed to exit, killing it after
+    # CLOSE_TIMEOUT
+    deadline = time.monotonic() + CLOSE_TIMEOUT
+    while time.monotonic() < deadline:
+        if exited(pid, child):
+            return
+        time.sleep(0.01)
+    kill_process(pid, child)
+
+
+def serve_worker(className, conn, outputs):
+    # Never returns: the agent's stack must not unwind in the worker
+    status = 0
+    try:
+        # Ctrl-C reaches the whole process group; the agent shuts us down
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        if isinstance(outputs, str):
+            # A launcher passes the name of the segment
+            outputs = SharedSegment(outputs, create=False)
+        try:
+            algo = create_algorithm_instance(className)
+        except Exception as e:
+            conn.send(("error", f"cannot create {className}: {e}"))
+            return
+        arrays_api = uses_arrays(algo)
+        conn.send(("ready", (is_stateless(algo), supports_checkpoint(algo))))
+        reader = SegmentReader()
+        while True:
+            try:
+                command, message = conn.recv()
+            except EOFError:
+                break
+            try:
+                data = load(message, reader)
+                if command == "export":
+                    result = algo.export_state()
+                elif command == "import":
+                    result = algo.import_state(data)
+                else:
+                    result = from_algorithm(
+                        algo.run(to_algorithm(data, arrays_api)), arrays_api
+                    )
+                reply = ("ok", dump(result, outputs))
+            except Exception as e:
+                reply = ("error", f"{type(e).__name__}: {e}")
+            conn.send(reply)
+    except BaseException as e:
+        print(f"worker {className}: {e}", file=sys.stderr)
+        status = 1
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(status)
+
+
+def serve_launcher(className, sock):
+    # Never returns, as serve_worker
+    status = 0
+    try:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+        while True:
+            request = sock.recv(MAX_LAUNCH_REPLY)
+            if not request:
+                break
+            outputs = json.loads(request)["outputs"]
+            conn, child_conn = Pipe()
+            try:
+                pid = os.fork()
+            except OSError as e:
+                conn.close()
+                child_conn.close()
+                sock.send(json.dumps({"error": str(e)}).encode())
+                continue
+            if pid == 0:
+                sock.close()
+                conn.close()
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                serve_worker(className, child_conn, outputs)
+            child_conn.close()
+            reply = json.dumps({"pid": pid}).encode()
+            socket.send_fds(sock, [reply], [conn.fileno()])
+            conn.close()
+    except BaseException as e:
+        print(f"worker launcher {className}: {e}", file=sys.stderr)
+        status = 1
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(status)
+
+
+class WorkerLauncher:
+    """
+    Process forked while the agent has no thread yet, which forks the
+    `className` workers the agent starts later.
+    """
+
+    def __init__(self, className):
+        self.className = className
+        # Pool steps run from several threads
+        self.lock = threading.Lock()
+        self.sock, child_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.pid = os.fork()
+        if self.pid == 0:
+            for conn in list(_agent_conns) + [self.sock]:
+                conn.close()
+            serve_launcher(className, child_sock)
+        child_sock.close()
+        _agent_conns.add(self.sock)
+
+    def launch(self, outputs):
+        """
+        Starts a worker writing its results to the `outputs` SharedSegment,
+        if any. Returns its pid and the agent end of its pipe.
+        """
+        request = {"outputs": outputs.name if outputs is not None else None}
+        with self.lock:
+            try:
+                self.sock.send(json.dumps(request).encode())
+                reply, fds, _, _ = socket.recv_fds(self.sock, MAX_LAUNCH_REPLY, 1)
+            except OSError as e:
+                raise RuntimeError(f"worker launcher failed: {e}")
+        if not reply:
+            raise RuntimeError("worker launcher exited")
+        decoded = json.loads(reply)
+        if "error" in decoded:
+            raise RuntimeError(decoded["error"])
+        return decoded["pid"], Connection(fds[0])
+
+    def close(self):
+        self.sock.close()
+        stop_process(self.pid, child=True)
+
+
+class Worker:
+    """
+    One worker process running the steps of a `className` instance, forked
+    from the agent or started by `launcher`.
+    """
+
+    def __init__(self, className, launcher=None):
+        self.className = className
+        self.inputs = self.outputs = None
+        if shm_available():
+            self.inputs = SharedSegment()
+            self.outputs = SharedSegment()
+        self.reader = SegmentReader()
+        self.closed = False
+        self.child = launcher is None
+        self.pid = None
+        if launcher is not None:
+            try:
+                self.pid, self.conn = launcher.launch(self.outputs)
+            except RuntimeError:
+                self.conn = None
+                self.close()
+                raise
+        else:
+            self.conn, child_conn = Pipe()
+            self.pid = os.fork()
+            if self.pid == 0:
+                for conn in list(_agent_conns) + [self.conn]:
+                    conn.close()
+                serve_worker(className, child_conn, self.outputs)
+            child_conn.close()
+        _agent_conns.add(self.conn)
+        try:
+            status, detail = self.conn.recv()
+        except EOFError:
+            status, detail = "error", "worker exited"
+        if status != "ready":
+            self.close()
+            raise RuntimeError(detail)
+        self.stateless, self.checkpointable = detail
+
+    def run(self, params, timeout=0.0):
+        return self.call("run", params, timeout)
+
+    def call(self, command, data, timeout=0.0):
+        try:
+            self.conn.send((command, dump(data, self.inputs)))
+            if timeout > 0 and not self.conn.poll(timeout):
+                self.kill()
+                raise RuntimeError(f"{self.className} ran for more than {timeout}s")
+            status, detail = self.conn.recv()
+        except (OSError, EOFError):
+            self.kill()
+            raise RuntimeError(f"{self.className} worker exited")
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            raise RuntimeError(f"cannot pass inputs to the worker: {e}")
+        if status != "ok":
+            raise RuntimeError(detail)
+        return load(detail, self.reader)
+
+    @property
+    def alive(self):
+        return self.pid is not None
+
+    def kill(self):
+        if self.pid is not None:
+            kill_process(self.pid, self.child)
+            self.pid = None
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.conn is not None:
+            self.conn.close()
+        if self.pid is not None:
+            stop_process(self.pid, self.child)
+            self.pid = None
+        self.reader.close()
+        for segment in (self.inputs, self.outputs):
+            if segment is not None:
+                segment.close()
+
+
+class WorkerPool:
+    """
+    Runs the steps of a `className` algorithm in worker processes: one for
+    a stateful algorithm, `size` for a stateless one. A worker that timed
+    out or died is replaced before the next step.
+    """
+
+    def __init__(self, className, size=1, timeout=0.0):
+        self.className = className
+        self.timeout = timeout
+        self.launcher = None
+        first = Worker(className)
+        self.stateless = first.stateless
+        # Whether the algorithm has export_state/import_state, see checkpoint.py
+        self.checkpointable = first.checkpointable
+        self.workers = [first]
+        try:
+            while self.stateless and len(self.workers) < size:
+                self.workers.append(Worker(className))
+            # Replacements are not forked from the agent, see above
+            self.launcher = WorkerLauncher(className)
+        except (OSError, RuntimeError):
+            self.close()
+            raise
+        self.idle: queue.SimpleQueue = queue.SimpleQueue()
+        for worker in self.workers:
+            self.idle.put(worker)
+
+    def run(self, params):
+        return self.call("run", params)
+
+    def export_state(self):
+        return self.call("export", None)
+
+    def call(self, command, data):
+        worker = self.idle.get()
+        try:
+            return worker.call(command, data, self.timeout)
+        finally:
+            if not worker.alive:
+                worker = self.replace(worker)
+            self.idle.put(worker)
+
+    def import_state(self, state):
+        # Every worker of a stateless pool may take the next step
+        for worker in self.workers:
+            worker.call("import", state, self.timeout)
+
+    def replace(self, worker):
+        worker.close()
+        try:
+            fresh = Worker(self.className, self.launcher)
+        except (OSError, RuntimeError) as e:
+            # The dead worker fails the next step, which tries again
+            print(f"worker {self.className}: cannot start a new worker: {e}")
+            return worker
+        self.workers[self.workers.index(worker)] = fresh
+        return fresh
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+        self.workers.clear()
+        if self.launcher is not None:
+            self.launcher.close()
+            self.launcher = None
+
+
+def create_runner(className, config):
+    """
+    Returns the WorkerPool running `className` in process mode, or None when
+    steps run inline in the agent.
+    """
+    if config.run_mode not in RUN_MODES:
+        raise ValueError(f"unknown run mode {config.run_mode}")
+    if config.run_mode == "inline":
+        return None
+    return WorkerPool(className, max(config.run_workers, 1), config.run_timeout)
@@ -0,0 +1,271 @@
+import importlib
+import json
+import os
+import socket
+import stat
+import struct
+import sys
+
+# Pre-warmed launcher: the zygote imports the agent modules and compiles the
+# ASN.1 schema once, then forks a ready agent for every request it gets on a
+# Unix socket. `main.py start` asks the zygote first and only falls back to
+# starting a fresh interpreter when none is listening.
+#
+# Request: one JSON line {"command", "args", "cwd", "env"} sent together
+# with the client's stdin/stdout/stderr (SCM_RIGHTS), so the agent writes
+# where a directly started one would. Reply: one JSON line {"pid"} or
+# {"error"}.
+#
+# Requests carry the environment and the terminal of the caller, so they are
+# only sent to a zygote of the same user (SO_PEERCRED). Without
+# $XDG_RUNTIME_DIR, the socket lives in a directory of /tmp that only its
+# owner can access.
+
+COMMANDS = ("start", "start-async", "host")
+MAX_REQUEST_SIZE = 1024 * 1024
+
+
+def zygote_socket_path():
+    path = os.environ.get("SMM3NG_ZYGOTE_SOCKET")
+    if path:
+        return path
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, f"smm3ng-zygote-{os.getuid()}.sock")
+    return os.path.join(private_tmp_dir(), "zygote.sock")
+
+
+def private_tmp_dir():
+    return os.path.join("/tmp", f"smm3ng-zygote-{os.getuid()}")
+
+
+def make_private_dir(directory):
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    st = os.lstat(directory)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid():
+        raise RuntimeError(f"{directory} belongs to another user")
+    os.chmod(directory, 0o700)
+
+
+def peer_uid(sock):
+    creds = sock.getsockopt(
+        socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+    )
+    return struct.unpack("3i", creds)[1]
+
+
+def run_command(command, args, config):
+    """
+    Runs an agent command in the current process; `args` are the command
+    line arguments following the command name.
+    """
+    if command == "host":
+        from async_agent import parse_instances, start_agent_host
+
+        start_agent_host(parse_instances(args[1:]), args[0], config)
+    elif command == "start-async":
+        from async_agent import start_async_agent
+
+        start_async_agent(args[0], args[1], args[2], config)
+    else:
+        from agent import start_agent
+
+        start_agent(args[0], args[1], args[2], config)
+
+
+def preload(modules=()):
+    # Everything a child needs is imported before the first fork
+    import agent  # noqa: F401
+    import async_agent  # noqa: F401
+
+    for module in modules:
+        importlib.import_module(module)
+
+
+def recv_request(conn):
+    data, fds, _, _ = socket.recv_fds(conn, MAX_REQUEST_SIZE, 3)
+    while not data.endswith(b"\n"):
+        if not data or len(data) > MAX_REQUEST_SIZE:
+            break
+        chunk = conn.recv(MAX_REQUEST_SIZE)
+        if not chunk:
+            break
+        data += chunk
+    return data, fds
+
+
+def validate_request(request, fds):
+    if request.get("command") not in COMMANDS:
+        raise ValueError(f"unknown command {request.get('command')}")
+    args = request.get("args")
+    if not isinstance(args, list) or not all(isinstance(a, str) for a in args):
+        raise ValueError("args must be a list of strings")
+    if len(args) < (2 if request["command"] == "host" else 3):
+        raise ValueError(f"not enough arguments for {request['command']}")
+    if request["command"] == "host":
+        from async_agent import parse_instances
+
+        parse_instances(args[1:])
+    if len(fds) != 3:
+        raise ValueError("stdin, stdout and stderr must be passed along")
+
+
+def spawn(request, fds, listen_sock, conn):
+    """
+    Double-forks a detached agent and returns its pid.
+    """
+    read_end, write_end = os.pipe()
+    child = os.fork()
+    if child == 0:
+        os.close(read_end)
+        status = 1
+        try:
+            listen_sock.close()
+            conn.close()
+            os.setsid()
+            grandchild = os.fork()
+            if grandchild == 0:
+                os.close(write_end)
+                run_child(request, fds)
+            os.write(write_end, str(grandchild).encode())
+            status = 0
+        finally:
+            os._exit(status)
+    os.close(write_end)
+    for fd in fds:
+        os.close(fd)
+    try:
+        with os.fdopen(read_end, "rb") as pipe:
+            pid = pipe.read()
+    finally:
+        os.waitpid(child, 0)
+    if not pid:
+        raise RuntimeError("failed to fork the agent")
+    return int(pid)
+
+
+def run_child(request, fds):
+    # Never returns: the zygote's stack must not unwind in the child
+    status = 0
+    try:
+        for target, fd in enumerate(fds):
+            os.dup2(fd, target)
+            os.close(fd)
+        sys.stdin = open(0, closefd=False)
+        sys.stdout = open(1, "w", closefd=False)
+        sys.stderr = open(2, "w", closefd=False)
+        os.chdir(request.get("cwd") or "/")
+        os.environ.clear()
+        os.environ.update(request.get("env") or {})
+
+        from config import AgentConfig
+
+        config = AgentConfig.from_env()
+        run_command(request["command"], request["args"], config)
+    except BaseException as e:
+        print(f"zygote: agent failed: {e}", file=sys.stderr)
+        status = 1
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(status)
+
+
+def handle(conn, listen_sock):
+    data, fds = recv_request(conn)
+    try:
+        request = json.loads(data)
+        if not isinstance(request, dict):
+            raise ValueError("request must be a JSON object")
+        validate_request(request, fds)
+    except ValueError as e:
+        for fd in fds:
+            os.close(fd)
+        return {"error": str(e)}
+    try:
+        return {"pid": spawn(request, fds, listen_sock, conn)}
+    except (OSError, RuntimeError) as e:
+        return {"error": str(e)}
+
+
+def bind(path):
+    if os.path.dirname(path) == private_tmp_dir():
+        make_private_dir(os.path.dirname(path))
+    listen_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    if os.path.exists(path):
+        # Only replace a socket nobody listens on any more
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                probe.connect(path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            os.unlink(path)
+        else:
+            listen_sock.close()
+            raise RuntimeError(f"a zygote is already listening on {path}")
+    old_umask = os.umask(0o077)
+    try:
+        listen_sock.bind(path)
+    finally:
+        os.umask(old_umask)
+    listen_sock.listen(128)
+    return listen_sock
+
+
+def serve(path=None, modules=(), ready=None):
+    path = path or zygote_socket_path()
+    preload(modules)
+    listen_sock = bind(path)
+    if ready is not None:
+        ready()
+    try:
+        while True:
+            conn, _ = listen_sock.accept()
+            with conn:
+                try:
+                    reply = handle(conn, listen_sock)
+                    conn.sendall(json.dumps(reply).encode() + b"\n")
+                except OSError as e:
+                    print(f"zygote: dropping request: {e}", file=sys.stderr)
+    finally:
+        listen_sock.close()
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+def launch(command, args, path=None):
+    """
+    Asks the zygote to start an agent. Returns the agent's pid, or None when
+    no zygote is listening; raises RuntimeError when the zygote refused.
+    """
+    path = path or zygote_socket_path()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            return None
+        if peer_uid(sock) != os.getuid():
+            raise RuntimeError(f"{path} is not a zygote of this user")
+        request = {
+            "command": command,
+            "args": list(args),
+            "cwd": os.getcwd(),
+            "env": dict(os.environ),
+        }
+        socket.send_fds(sock, [json.dumps(request).encode() + b"\n"], [0, 1, 2])
+        reply = b""
+        while not reply.endswith(b"\n"):
+            chunk = sock.recv(4096)
+            if not chunk:
+                raise RuntimeError("zygote closed the connection")
+            reply += chunk
+    finally:
+        sock.close()
+    decoded = json.loads(reply)
+    if "error" in decoded:
+        raise RuntimeError(f"zygote: {decoded['error']}")
+    return decoded["pid"]